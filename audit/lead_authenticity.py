@@ -3,8 +3,11 @@ from audit.utils import check_input_fields, load_leads_by_fields
 from collector.models import LeadField
 from django.utils.translation import ugettext as _
 from audit.error import AuditError
+from utils.db_router import primary_reads
 
 
+# audited leads may be just submitted, replicas may not have them yet
+@primary_reads()
 def check_lead_authenticity(pixel, check_fields):
     """
     :param pixel: пиксел для которого проверяем лиды
@@ -3,8 +3,11 @@ from audit.models import Audit, DuplicationRequiredFieldSet
 from audit.utils import check_input_fields, load_leads_by_fields
 from collector.models.analytics import LeadField, Lead
 from django.utils.translation import ugettext as _
+from utils.db_router import primary_reads
 
 
+# audited leads may be just submitted, replicas may not have them yet
+@primary_reads()
 def check_lead_duplication(user, fields):
     """
     Finds leads by fields and check duplications and sales
@@ -4,7 +4,9 @@ from django.contrib.postgres.fields import JSONField
 from django.db.models.deletion import PROTECT
 
 from collector.models.analytics import Lead
+from collector.analytics_cache import invalidate_users
 from collector.models.dictionaries import Field
+from collector.rollups import refresh_lead_hour_stat, lead_pixel_hours
 
 User = get_user_model()
 
@@ -32,10 +34,14 @@ class Audit(models.Model):
 
     @classmethod
     def _inc_leads_salecount(cls, user, leads):
+        sold_leads = []
         for lead in leads:
             if lead.pixel.project.user != user and not cls._did_user_audit_lead(user, lead):
                 lead.metrik_lead_salecount += 1
                 lead.save(force_update=True, update_fields=('metrik_lead_salecount',))
+                sold_leads.append(lead)
+        refresh_lead_hour_stat(lead_pixel_hours(sold_leads))
+        invalidate_users(lead.pixel.project.user_id for lead in sold_leads)
 
     @staticmethod
     def _did_user_audit_lead(user, lead):
@@ -1,29 +1,56 @@
+import threading
+import uuid
 from collections import OrderedDict
+from functools import reduce
+from operator import or_
 
+from django.conf import settings
 from django.template.defaultfilters import date as _date
-from django.db.models.functions.base import Coalesce, Concat
+from django.db.models.functions.base import Coalesce
+from django.db.models.functions.window import Lag
 from django.db.models.functions.datetime import TruncHour, TruncDay, TruncMonth, Trunc, TruncYear
-from django.db.models import Q
+from django.db import connections, router
+from django.db.models import Q, Window
 from django.utils import timezone
-from datetime import date, datetime, timedelta
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from datetime import date, datetime, time, timedelta
 from django.contrib.auth import get_user_model
 from django.db.models.aggregates import Count, Sum
-from django.db.models.expressions import When, Value, Case, F, ExpressionWrapper
-from django.db.models.fields import CharField, DurationField
+from django.db.models.expressions import When, Value, Case, F, ExpressionWrapper, RawSQL
+from django.db.models.fields import BooleanField, CharField, DurationField
 from django.utils.translation import ugettext as _, get_language
 
+from collector.analytics_cache import cached_analytics, GLOBAL_SCOPE
+from collector.analytics_guard import guarded_analytics, check_query_cost
+from collector.columnar import get_lead_columns
 from collector.models import LEAD_AGE_GROUPS, Lead, LEAD_DURATION_GROUPS, CONSUMER_ORIGIN_GROUPS
-from collector.models.analytics import LeadUtm, LeadOpenstat
-from collector.models.dictionaries import DeviceType
+from collector.models.analytics import LeadUrlLabel, UrlLabelValue, UserUrlLabel, url_label_kind
+from collector.models.dictionaries import DeviceType, Device, City, OSGroup, BrowserGroup
+from collector.models.rollups import LeadHourStat, LeadHourSketch, LeadPeriodSketch, LeadPeriodTotal, \
+    LeadUserPeriodTotal
+from utils.db import dictfetchall
+from utils.hll import HyperLogLog
 
 
 User = get_user_model()
 
+# lead ages change with time, not only with new leads,
+# keys of callers passing lead_age_now() change every settings.ANALYTICS_LEAD_AGE_STEP
+LEAD_AGE_CACHE_TIMEOUT = 60
+
+# label autocomplete is called on every key press
+URL_LABEL_LIST_LIMIT = 20
+URL_LABEL_LIST_MAX_LIMIT = 100
+URL_LABEL_LIST_CACHE_TIMEOUT = 60
+
 
 class AnalyticsError(Exception):
     pass
 
 
+@cached_analytics
+@guarded_analytics
 def total_visits(user: User, date_from: date, date_to: date,
                     projects: list = None,
                     label_type=None, label_values=None,
@@ -41,22 +68,24 @@ def total_visits(user: User, date_from: date, date_to: date,
     :param now:
     :return:
     """
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = leads_qs.filter(
         Q(session_started__range=(date_from, date_to)) | Q(created__range=(date_from, date_to))
     )
     if projects:
-        leads_qs = leads_qs.filter(pixel__project__in=tuple(projects))
+        leads_qs = leads_qs.filter(project__in=tuple(projects))
     if os_groups:
-        leads_qs = leads_qs.filter(os_version__family__group__in=tuple(os_groups))
+        leads_qs = leads_qs.filter(os_group__in=tuple(os_groups))
     if browser_groups:
-        leads_qs = leads_qs.filter(browser__family__group__in=tuple(browser_groups))
+        leads_qs = leads_qs.filter(browser_group__in=tuple(browser_groups))
     if traffic_channels:
         leads_qs = leads_qs.filter(traffic_channel__in=tuple(traffic_channels))
-    leads_qs = _set_url_label_filter(leads_qs, label_type, label_values)
+    leads_qs = _set_url_label_filter(leads_qs, label_type, label_values, user)
     return leads_qs.count()
 
 
+@cached_analytics
+@guarded_analytics
 def total_conversions(user: User, date_from: date, date_to: date,
                     projects: list = None,
                     label_type=None, label_values=None,
@@ -74,20 +103,31 @@ def total_conversions(user: User, date_from: date, date_to: date,
     :param now:
     :return:
     """
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    columns = _lead_columns(user, date_from, date_to, label_type, label_values)
+    if columns is not None:
+        return columns.count(columns.mask(date_from, date_to, projects,
+                                          os_groups, browser_groups, traffic_channels))
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        stat_qs = LeadHourStat.objects.filter(user=user)
+        stat_qs = _apply_rollup_common_filters(stat_qs, date_from, date_to, projects,
+                                               os_groups, browser_groups, traffic_channels)
+        return stat_qs.aggregate(leads_count=Sum('leads'))['leads_count'] or 0
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
+                                          browser_groups, traffic_channels, user=user)
     return leads_qs.count()
 
 
+@cached_analytics
+@guarded_analytics
 def total_devices(user: User, date_from: date, date_to: date,
                     projects: list = None,
                     label_type=None, label_values=None,
                     os_groups=None, browser_groups=None,
-                    traffic_channels=None, now: datetime=None):
+                    traffic_channels=None, now: datetime=None, approximate=False):
     """
-    returns total leads count with created in range
+    returns count of distinct devices of leads with created in range
     :param user: User
     :param date_from: Date
     :param date_to: Date
@@ -96,75 +136,220 @@ def total_devices(user: User, date_from: date, date_to: date,
     :param label_type: type of url labels (utm | openstat)
     :param label_values: dict of url labels values
     :param now:
+    :param approximate: merge HyperLogLog sketches of whole months and days (LeadPeriodSketch)
+        and of the rest hours (LeadHourSketch) instead of exact count, standard error is 1.6%
+        (within 5% for 99.7% of counts), it is exact count anyway when sketches can not answer the filters
     :return:
     """
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    columns = _lead_columns(user, date_from, date_to, label_type, label_values)
+    if columns is not None:
+        return columns.distinct_devices(columns.mask(date_from, date_to, projects,
+                                                     os_groups, browser_groups, traffic_channels))
+    if approximate and not (os_groups or browser_groups or traffic_channels) \
+            and _use_lead_rollups(date_from, date_to, label_type, label_values):
+        sketch_filters = []
+        for unit, start, end in _sketch_ranges(_to_utc(date_from), _to_utc(date_to)):
+            if unit == 'hour':
+                sketch_filters.append((LeadHourSketch, Q(hour__gte=start, hour__lt=end)))
+            else:
+                sketch_filters.append((LeadPeriodSketch, Q(unit=unit, started__gte=start, started__lt=end)))
+        devices = HyperLogLog()
+        for model in (LeadPeriodSketch, LeadHourSketch):
+            model_filters = [sketch_filter for sketch_model, sketch_filter in sketch_filters if sketch_model is model]
+            if not model_filters:
+                continue
+            sketch_qs = model.objects.filter(reduce(or_, model_filters), user=user)
+            if projects:
+                sketch_qs = sketch_qs.filter(project__in=tuple(projects))
+            for sketch in sketch_qs.values_list('devices', flat=True).iterator():
+                devices.merge_bytes(sketch)
+        return devices.count()
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
+                                          browser_groups, traffic_channels, user=user)
     return leads_qs.aggregate(Count('device_id',distinct=True)).get('device_id__count')
 
 
-def _lead_age_boundary(now, seconds):
+def _sketch_ranges(date_from: datetime, date_to: datetime):
     """
-    :param now: dateime
-    :param seconds: int
-    :return: datetime - boundary for lead age group
+    split whole hours range into the coarsest sketch periods, utc months and days inside it and the rest hours
+    :param date_from: utc hour start
+    :param date_to: utc, its hour is included
+    :return: list of (LeadPeriodSketch unit or 'hour', start, end), end is excluded
+    >>> utc = timezone.utc
+    >>> for unit, start, end in _sketch_ranges(datetime(2018, 1, 30, 22, tzinfo=utc),
+    ...                                        datetime(2018, 4, 2, 0, 59, 59, tzinfo=utc)):
+    ...     print(unit, start.isoformat(), end.isoformat())
+    hour 2018-01-30T22:00:00+00:00 2018-01-31T00:00:00+00:00
+    day 2018-01-31T00:00:00+00:00 2018-02-01T00:00:00+00:00
+    month 2018-02-01T00:00:00+00:00 2018-04-01T00:00:00+00:00
+    day 2018-04-01T00:00:00+00:00 2018-04-02T00:00:00+00:00
+    hour 2018-04-02T00:00:00+00:00 2018-04-02T01:00:00+00:00
     """
-    return now - timedelta(seconds=seconds)
+    end = date_to.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    ranges = []
+    start = date_from
+    while start < end:
+        unit = 'hour'
+        for period in ('month', 'day'):
+            if LeadPeriodSketch.period_start(start, period) == start \
+                    and LeadPeriodSketch.period_end(start, period) <= end:
+                unit = period
+                break
+        period_end = start + timedelta(hours=1) if unit == 'hour' else LeadPeriodSketch.period_end(start, unit)
+        if ranges and ranges[-1][0] == unit:
+            ranges[-1] = (unit, ranges[-1][1], period_end)
+        else:
+            ranges.append((unit, start, period_end))
+        start = period_end
+    return ranges
 
 
-def _lead_age_groups_case(groups: list = None, now: datetime = None):
+def _lead_columns(user: User, date_from: date, date_to: date, label_type=None, label_values=None):
     """
-    returns Case object for time groups
-    Case (
-        when created__range=(5,30), then='5 to 30 mins'
-        when created__range=(1,4), then='1 to 4 hours'
-        ...
-        default='Others'
-    )
-    :param groups:
-    :param now:
-    :return:
+    in-memory columns of user leads (collector.columnar) if they can answer,
+    they have no url labels and need aware datetimes range
+    :return: LeadColumns or None
     """
-    if now is None:
-        now = timezone.now()
-    if not groups:
-        groups = LEAD_AGE_GROUPS.keys();
+    if label_type and label_values and _get_url_label_filter(label_type, label_values):
+        return None
+    if not isinstance(date_from, datetime) or not isinstance(date_to, datetime):
+        return None
+    if timezone.is_naive(date_from) or timezone.is_naive(date_to):
+        return None
+    return get_lead_columns(user.pk)
 
-    group_whens = []
+
+def lead_age_now(now: datetime = None):
+    """
+    current time truncated to settings.ANALYTICS_LEAD_AGE_STEP seconds, lead ages are
+    counted from it, so statements and cache keys of lead_age_totals repeat within a step
+    >>> lead_age_now(datetime(2018, 3, 1, 15, 42, 7, 15, tzinfo=timezone.utc))
+    datetime.datetime(2018, 3, 1, 15, 42, tzinfo=<UTC>)
+    """
+    now = _to_utc(now or timezone.now())
+    step = settings.ANALYTICS_LEAD_AGE_STEP
+    if not step:
+        return now
+    seconds = int(now.timestamp())
+    return datetime.fromtimestamp(seconds - seconds % step, timezone.utc)
+
+
+def _lead_age_thresholds(groups: list = None):
+    """
+    lower bounds of LEAD_AGE_GROUPS in seconds and group name of every bucket
+    of width_bucket over them, not requested groups are 'Others'
+    :return: (ascending list of seconds, list of group names by bucket number)
+    >>> thresholds, names = _lead_age_thresholds(['less_5_minutes', 'more_1_year'])
+    >>> thresholds[:3], names[:3], names[-1]
+    ([0, 300, 1800], ['Others', 'less_5_minutes', 'Others'], 'more_1_year')
+    """
+    if not groups:
+        groups = LEAD_AGE_GROUPS.keys()
     for group_id in groups:
-        try:
-            group = LEAD_AGE_GROUPS[group_id]
-        except KeyError:
+        if group_id not in LEAD_AGE_GROUPS:
             raise AnalyticsError(_('Invalid group parameter'))
-        if group.operator == 'range':
-            expr_value = (_lead_age_boundary(now, group.val1), _lead_age_boundary(now, group.val2))
-        else:
-            expr_value = _lead_age_boundary(now, group.val1)
-        group_whens.append(
-            When(**{'created__' + group.operator: expr_value, 'then': Value(group_id)})
-        )
+    bounds = sorted((group.val2 if group.operator == 'range' else group.val1, group_id)
+                    for group_id, group in LEAD_AGE_GROUPS.items())
+    thresholds = [lower for lower, group_id in bounds]
+    # bucket 0 is age below the first bound, leads created after now
+    names = ['Others'] + [group_id if group_id in groups else 'Others' for lower, group_id in bounds]
+    return thresholds, names
 
-    return Case(*group_whens, default=Value('Others'), output_field=CharField())
+
+def _lead_age_bucket(now: datetime, thresholds: list, model, field):
+    """
+    width_bucket of age of datetime field at now in seconds, bucket i is age from
+    thresholds[i - 1] up to thresholds[i], one comparison per threshold unlike CASE
+    """
+    column = '"{}"."{}"'.format(model._meta.db_table, model._meta.get_field(field).column)
+    # thresholds are constants of LEAD_AGE_GROUPS, inlined as array literal
+    array = ', '.join(str(int(seconds)) for seconds in thresholds)
+    return RawSQL(
+        'width_bucket(extract(epoch from %s::timestamptz - {})::float8, ARRAY[{}]::float8[])'
+        .format(column, array),
+        (now,)
+    )
 
 
 def _apply_lead_common_filters(leads_qs, date_from: date, date_to: date,
                                projects: list = None, label_type=None, label_values=None,
-                               os_groups=None, browser_groups=None, traffic_channels=None):
+                               os_groups=None, browser_groups=None, traffic_channels=None,
+                               user=None):
+    """
+    :param user: owner of leads_qs leads, label filter scans label index of the user
+    """
     leads_qs = leads_qs.filter(created__range=(date_from, date_to))
     if projects:
-        leads_qs = leads_qs.filter(pixel__project__in=tuple(projects))
+        leads_qs = leads_qs.filter(project__in=tuple(projects))
     if os_groups:
-        leads_qs = leads_qs.filter(os_version__family__group__in=tuple(os_groups))
+        leads_qs = leads_qs.filter(os_group__in=tuple(os_groups))
     if browser_groups:
-        leads_qs = leads_qs.filter(browser__family__group__in=tuple(browser_groups))
+        leads_qs = leads_qs.filter(browser_group__in=tuple(browser_groups))
     if traffic_channels:
         leads_qs = leads_qs.filter(traffic_channel__in=tuple(traffic_channels))
-    leads_qs = _set_url_label_filter(leads_qs, label_type, label_values)
+    leads_qs = _set_url_label_filter(leads_qs, label_type, label_values, user, date_from, date_to)
     return leads_qs
 
 
+def _use_lead_rollups(date_from: datetime, date_to: datetime, label_type=None, label_values=None):
+    """
+    hourly rollups (LeadHourStat) have no url labels and keep created with hour precision,
+    so they answer only without label filter and for whole hours range
+    (date_to is hh:59:59, leads of its last second fractions are counted)
+    >>> utc = timezone.utc
+    >>> _use_lead_rollups(datetime(2017, 1, 1, tzinfo=utc), datetime(2017, 1, 31, 23, 59, 59, tzinfo=utc))
+    True
+    >>> _use_lead_rollups(datetime(2017, 1, 1, tzinfo=utc), datetime(2017, 1, 31, 23, 59, 59, tzinfo=utc),
+    ...                   'utm', {'utm_source': 'google'})
+    False
+    >>> _use_lead_rollups(datetime(2017, 1, 1, tzinfo=utc), datetime(2017, 1, 31, 23, 59, 59, tzinfo=utc),
+    ...                   'utm', {})
+    True
+    >>> _use_lead_rollups(datetime(2017, 1, 1, 0, 30, tzinfo=utc), datetime(2017, 1, 31, 23, 59, 59, tzinfo=utc))
+    False
+    >>> _use_lead_rollups(date(2017, 1, 1), date(2017, 1, 31))
+    False
+    """
+    if not settings.ANALYTICS_LEAD_ROLLUPS:
+        return False
+    if label_type and label_values and _get_url_label_filter(label_type, label_values):
+        return False
+    if not isinstance(date_from, datetime) or not isinstance(date_to, datetime):
+        return False
+    date_from = _to_utc(date_from)
+    date_to = _to_utc(date_to)
+    return (date_from.minute, date_from.second, date_from.microsecond) == (0, 0, 0) \
+        and (date_to.minute, date_to.second) == (59, 59)
+
+
+def _to_utc(value: datetime):
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value.astimezone(timezone.utc)
+
+
+def _apply_rollup_common_filters(stat_qs, date_from: datetime, date_to: datetime,
+                                 projects: list = None, os_groups=None, browser_groups=None,
+                                 traffic_channels=None):
+    """
+    same as _apply_lead_common_filters but for LeadHourStat
+    """
+    stat_qs = stat_qs.filter(hour__range=(date_from, date_to))
+    if projects:
+        stat_qs = stat_qs.filter(project__in=tuple(projects))
+    if os_groups:
+        stat_qs = stat_qs.filter(os_group__in=tuple(os_groups))
+    if browser_groups:
+        stat_qs = stat_qs.filter(browser_group__in=tuple(browser_groups))
+    if traffic_channels:
+        stat_qs = stat_qs.filter(traffic_channel__in=tuple(traffic_channels))
+    return stat_qs
+
+
+@cached_analytics(timeout=LEAD_AGE_CACHE_TIMEOUT)
+@guarded_analytics
 def lead_age_totals(user: User, date_from: date, date_to: date,
                     groups: list = None, projects: list = None,
                     label_type=None, label_values=None,
@@ -172,6 +357,8 @@ def lead_age_totals(user: User, date_from: date, date_to: date,
                     traffic_channels=None, now: datetime=None):
     """
     returns data for piechart of lead_age
+    whole hours range without label filter is answered from hourly rollups,
+    only hours which have a group boundary (the current one among them) are scanned
     :param user: User
     :param date_from: Date
     :param date_to: Date
@@ -179,49 +366,92 @@ def lead_age_totals(user: User, date_from: date, date_to: date,
     :param projects: List of String - filter by project ids
     :param label_type: type of url labels (utm | openstat)
     :param label_values: dict of url labels values
-    :param now:
-    :return:
+    :param now: ages are counted from lead_age_now(now), pass lead_age_now() for cache keys
+        to change once a step
+    :return: list of {group_name, leads_count} in LEAD_AGE_GROUPS order, 'Others' last
     """
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    now = lead_age_now(now)
+    thresholds, names = _lead_age_thresholds(groups)
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
-    leads_qs = leads_qs.annotate(
-        group_name=_lead_age_groups_case(groups, now)
-    ).values('group_name').annotate(leads_count=Count('id'))
-    return leads_qs
-
-
-def _set_url_label_filter(leads_qs, label_type, label_values):
+                                          browser_groups, traffic_channels, user=user)
+    querysets = []
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        # all leads of an hour without boundary are in one group, bucket of hour start
+        boundary_hours = sorted({
+            (now - timedelta(seconds=seconds)).replace(minute=0, second=0, microsecond=0)
+            for seconds in thresholds
+        })
+        stat_qs = LeadHourStat.objects.filter(user=user).exclude(hour__in=boundary_hours)
+        stat_qs = _apply_rollup_common_filters(stat_qs, date_from, date_to, projects,
+                                               os_groups, browser_groups, traffic_channels)
+        stat_qs = stat_qs.annotate(age_bucket=_lead_age_bucket(now, thresholds, LeadHourStat, 'hour'))
+        querysets.append(stat_qs.values('age_bucket').annotate(leads_count=Sum('leads')))
+        leads_qs = leads_qs.filter(reduce(or_, (
+            Q(created__gte=hour, created__lt=hour + timedelta(hours=1)) for hour in boundary_hours
+        )))
+    leads_qs = leads_qs.annotate(age_bucket=_lead_age_bucket(now, thresholds, Lead, 'created'))
+    querysets.append(leads_qs.values('age_bucket').annotate(leads_count=Count('id')))
+
+    counts = OrderedDict((name, 0) for name in list(LEAD_AGE_GROUPS) + ['Others'])
+    for qs in querysets:
+        for row in qs:
+            counts[names[row['age_bucket']]] += row['leads_count']
+    return [{'group_name': name, 'leads_count': count} for name, count in counts.items() if count]
+
+
+def _set_url_label_filter(leads_qs, label_type, label_values, user=None,
+                          date_from=None, date_to=None):
+    """
+    filter leads by LeadUrlLabel index, values are matched case insensitive
+    :param user: owner of leads, index scan is narrowed to user labels
+    :param date_from: leads are created in range, index scan is narrowed to it
+    :param date_to:
+    """
     if label_type and label_values:
         label_filter = _get_url_label_filter(label_type, label_values)
         if label_filter:
-            leads_qs = leads_qs.filter(**label_filter)
+            for label_kind, label_value in label_filter:
+                # value ids are looked up first, so they are index condition of the scan
+                value_ids = tuple(UrlLabelValue.objects.filter(
+                    label_kind=label_kind, value__iexact=label_value
+                ).values_list('id', flat=True))
+                if not value_ids:
+                    # no leads, but a valid query for raw sql wrappers unlike empty IN
+                    leads_qs = leads_qs.filter(id__isnull=True)
+                    continue
+                index_qs = LeadUrlLabel.objects.filter(label_kind=label_kind,
+                                                       label_value__in=value_ids)
+                if user is not None:
+                    index_qs = index_qs.filter(user=user)
+                if date_from is not None:
+                    index_qs = index_qs.filter(created__range=(date_from, date_to))
+                leads_qs = leads_qs.filter(id__in=index_qs.values('lead_id'))
     return leads_qs
 
 
 def _get_url_label_filter(label_type, label_values):
-    if label_type not in ['utm', 'openstat']:
-        return None
-    label_type_fields = {
-        'utm': ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content'),
-        'openstat': ('service', 'campaign', 'ad', 'source')
-    }
-    label_names = label_type_fields[label_type]
+    """
+    :return: list of (URL_LABEL_KINDS id, value) or None if labels are unknown
+    >>> _get_url_label_filter('utm', {'utm_source': 'google'})
+    [(1, 'google')]
+    >>> _get_url_label_filter('utm', {'source': 'google'}) is None
+    True
+    """
+    label_filter = []
     for label_name, label_value in label_values.items():
-        if label_name not in label_names:
+        label_kind = url_label_kind(label_type, label_name)
+        if label_kind is None:
             return None
-
-    label_filter = {}
-    for label_name, label_value in label_values.items():
-        label_filter[label_type + '__' + label_name + '__iexact'] = label_value
+        label_filter.append((label_kind, label_value))
     return label_filter
 
 
-def _leads_period_unit_expr(period):
+def _leads_period_unit_expr(period, field='created'):
     """
     :param period: - 'hour', 'day', 'week', 'moth', 'year'
-    :param date_to:
+    :param field: datetime field to truncate
     :return:
     >>> _leads_period_unit_expr('hour')
     TruncHour(F(created))
@@ -233,17 +463,19 @@ def _leads_period_unit_expr(period):
     TruncMonth(F(created))
     >>> _leads_period_unit_expr('year')
     TruncYear(F(created))
+    >>> _leads_period_unit_expr('day', 'hour')
+    TruncDay(F(hour))
     """
     if period == 'hour':
-        return TruncHour('created')
+        return TruncHour(field)
     elif period == 'day':
-        return TruncDay('created')
+        return TruncDay(field)
     elif period == 'week':
-        return Trunc('created', 'week')
+        return Trunc(field, 'week')
     elif period == 'month':
-        return TruncMonth('created')
+        return TruncMonth(field)
     else:
-        return TruncYear('created')
+        return TruncYear(field)
 
 
 def format_leads_period(lead_date: datetime, period):
@@ -323,61 +555,218 @@ def get_scale_period(date_from: date, date_to: date):
         return 'year'
 
 
+# local days and longer periods start at local midnight, which is never skipped or repeated by dst
+PERIOD_AXIS_SQL = """
+    SELECT period AT TIME ZONE %(tz)s FROM generate_series(
+        date_trunc(%(unit)s, %(date_from)s::timestamptz AT TIME ZONE %(tz)s),
+        date_trunc(%(unit)s, %(date_to)s::timestamptz AT TIME ZONE %(tz)s),
+        %(step)s::interval
+    ) period
+"""
+
+# local hours are skipped or repeated by dst, they are counted in absolute time
+# from the start of local hour of date_from
+HOUR_AXIS_SQL = """
+    SELECT generate_series(
+        %(date_from)s::timestamptz - (%(date_from)s::timestamptz AT TIME ZONE %(tz)s
+            - date_trunc('hour', %(date_from)s::timestamptz AT TIME ZONE %(tz)s)),
+        %(date_to)s::timestamptz,
+        '1 hour'::interval
+    )
+"""
+
+
+def period_axis(date_from: date, date_to: date, scale_period=None):
+    """
+    all periods of range truncated as _leads_period_unit_expr does, in current timezone,
+    series is generated by database so month lengths and dst shifts match Trunc*
+    :param scale_period: get_scale_period of range by default
+    :return: list of aware datetimes
+    """
+    scale_period = scale_period or get_scale_period(date_from, date_to)
+    with connections[router.db_for_read(Lead)].cursor() as cursor:
+        cursor.execute(HOUR_AXIS_SQL if scale_period == 'hour' else PERIOD_AXIS_SQL, {
+            'unit': scale_period, 'date_from': date_from, 'date_to': date_to,
+            'tz': timezone.get_current_timezone_name(), 'step': '1 ' + scale_period,
+        })
+        return [timezone.localtime(row[0]) for row in cursor.fetchall()]
+
+
+def period_series(axis: list, rows, value='leads_count', group_field=None, default=0):
+    """
+    spread rows of periods with data over dense axis
+    :param axis: period_axis
+    :param rows: dicts with created_period
+    :param value: row field or function of row
+    :param group_field: row field of series name, one None series by default
+    :param default: value of periods without row
+    :return: OrderedDict {series name: list of values in axis order}, in order of rows
+    >>> period_series([datetime(2017, 1, 1)], [])
+    OrderedDict([(None, [0])])
+    >>> axis = [datetime(2017, 1, 1), datetime(2017, 1, 2), datetime(2017, 1, 3)]
+    >>> period_series(axis, [{'created_period': datetime(2017, 1, 2), 'leads_count': 5}])
+    OrderedDict([(None, [0, 5, 0])])
+    >>> period_series(axis, [
+    ...     {'created_period': datetime(2017, 1, 1), 'group_name': 'b', 'leads_count': 1},
+    ...     {'created_period': datetime(2017, 1, 3), 'group_name': 'a', 'leads_count': 2},
+    ... ], group_field='group_name', default=None)
+    OrderedDict([('b', [1, None, None]), ('a', [None, None, 2])])
+    """
+    index = {created_period: i for i, created_period in enumerate(axis)}
+    series = OrderedDict()
+    if group_field is None:
+        series[None] = [default] * len(axis)
+    for row in rows:
+        name = row[group_field] if group_field else None
+        if name not in series:
+            series[name] = [default] * len(axis)
+        i = index.get(row['created_period'])
+        if i is not None:
+            series[name][i] = value(row) if callable(value) else row[value]
+    return series
+
+
 def get_leads(user: User, date_from: date, date_to: date, projects: list = None,
               label_type=None, label_values=None, os_groups=None, browser_groups=None,
-              traffic_channels=None):
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+              traffic_channels=None, after=None):
+    """
+    converted leads newest first, device, city, country and os group labels
+    are not selected, fill them for a page with fill_lead_labels
+    :param after: cursor of the last lead of previous page (leads_cursor),
+        keyset page costs the same at any depth unlike offset
+    :return: Lead QuerySet ordered by (created, id) desc
+    """
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
-    leads_qs = leads_qs.order_by('-created')
-    leads_qs = leads_qs.annotate(os_group=F('os_version__family__group__name'))
-    device_types = dict(DeviceType.TYPES)
-    leads_qs = leads_qs.annotate(
-        device=Concat(
-            Case(
-                When(
-                    device_model__device_type__category=DeviceType.PHONE,
-                    then=Value(str(device_types[DeviceType.PHONE]))
-                ),
-                When(
-                    device_model__device_type__category=DeviceType.TABLET,
-                    then=Value(str(device_types[DeviceType.TABLET]))
-                ),
-                When(
-                    device_model__device_type__category=DeviceType.DESKTOP,
-                    then=Value(str(device_types[DeviceType.DESKTOP]))
-                ),
-                default=Value('Unknown')
-            ),
-            Value(' '),
-            F('device_model__brand__name'), Value(' '),
-            F('device_model__model')
-        )
-    )
-    cur_language = get_language()
-    if cur_language == 'ru-ru':
-        leads_qs = leads_qs.annotate(city=Coalesce(
-            Case(
-                When(geo__name_ru__exact='', then=None),
-                When(geo__name_ru__isnull=False, then='geo__name_ru'),
-                default=None
-            ), F('geo__name')
-        ))
-    else:
-        leads_qs = leads_qs.annotate(city=F('geo__name'))
-    leads_qs = leads_qs.select_related('geo')
-    return leads_qs
+                                          browser_groups, traffic_channels, user=user)
+    if after:
+        created, lead_id = parse_leads_cursor(after)
+        leads_qs = leads_qs.filter(Q(created__lt=created) | Q(created=created, id__lt=lead_id))
+    return leads_qs.order_by('-created', '-id')
+
+
+def leads_cursor(lead):
+    """
+    :param lead: Lead
+    :return: opaque cursor of lead position in get_leads order
+    >>> lead = Lead(id=uuid.UUID('9c1e8a4e-1c52-4e6f-9a3e-0c4d0f6f4b1a'),
+    ...             created=datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc))
+    >>> parse_leads_cursor(leads_cursor(lead)) == (lead.created, lead.id)
+    True
+    """
+    value = '{}|{}'.format(lead.created.isoformat(), lead.id)
+    return urlsafe_base64_encode(value.encode()).decode()
 
 
+def parse_leads_cursor(cursor):
+    """
+    :param cursor: string from leads_cursor
+    :return: (created, lead id)
+    >>> parse_leads_cursor('bad')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid leads cursor
+    >>> parse_leads_cursor(urlsafe_base64_encode(b'2018-03-01T10:05:00+00:00|1 OR 1=1').decode())
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid leads cursor
+    """
+    try:
+        created, lead_id = urlsafe_base64_decode(cursor).decode().split('|')
+        created = parse_datetime(created)
+        lead_id = uuid.UUID(lead_id)
+    except (ValueError, UnicodeDecodeError):
+        created = None
+    if created is None:
+        raise ValueError('Invalid leads cursor')
+    return created, lead_id
+
+
+# dictionary id: label, dictionaries only grow so labels are kept per process
+_DEVICE_LABELS = {}
+_CITY_LABELS = {}
+_OS_GROUP_LABELS = {}
+LABELS_CACHE_SIZE = 100000
+# label dicts are shared by threads of worker
+_labels_lock = threading.Lock()
+
+
+def _dictionary_labels(labels, queryset, ids, label):
+    """
+    :param labels: dict of cached labels
+    :param queryset: dictionary QuerySet to load missing ones
+    :param ids: ids of dictionary objects
+    :param label: function of dictionary object to label
+    :return: {id: label} of all ids, other threads may clear cached labels meanwhile
+    """
+    ids = set(ids) - {None}
+    with _labels_lock:
+        found = {obj_id: labels[obj_id] for obj_id in ids if obj_id in labels}
+    missing = ids - set(found)
+    if missing:
+        loaded = {obj.id: label(obj) for obj in queryset.filter(id__in=tuple(missing))}
+        found.update(loaded)
+        with _labels_lock:
+            if len(labels) + len(loaded) > LABELS_CACHE_SIZE:
+                labels.clear()
+            labels.update(loaded)
+    return found
+
+
+def fill_lead_labels(leads):
+    """
+    set device, city, country and os_group_name of leads from in-memory dictionaries
+    :param leads: list of Lead
+    :return: leads
+    """
+    devices = _dictionary_labels(_DEVICE_LABELS, Device.objects.select_related('brand'),
+                                 (lead.device_model_id for lead in leads),
+                                 lambda device: '{} {}'.format(device.brand.name, device.model))
+    # country is a code column (CountryField), its name needs no query
+    cities = _dictionary_labels(_CITY_LABELS, City.objects.only('name', 'name_ru', 'country'),
+                                (lead.geo_id for lead in leads),
+                                lambda city: (city.name, city.name_ru, city.country))
+    os_groups = _dictionary_labels(_OS_GROUP_LABELS, OSGroup.objects.all(),
+                                   (lead.os_group_id for lead in leads), lambda group: group.name)
+    device_types = dict(DeviceType.TYPES)
+    is_ru = get_language() == 'ru-ru'
+    for lead in leads:
+        device_type = device_types.get(lead.device_category, 'Unknown')
+        lead.device = '{} {}'.format(device_type, devices.get(lead.device_model_id, ' '))
+        lead.os_group_name = os_groups.get(lead.os_group_id)
+        lead.city = lead.country = None
+        if lead.geo_id in cities:
+            name, name_ru, country = cities[lead.geo_id]
+            lead.city = name_ru if is_ru and name_ru else name
+            lead.country = country.name
+    return leads
+
+
+@cached_analytics
+@guarded_analytics
 def leads_by_period(user: User, date_from: date, date_to: date, projects: list = None,
                     label_type=None, label_values=None, os_groups=None, browser_groups=None,
                     traffic_channels=None):
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    scale_period = get_scale_period(date_from, date_to)
+    # columns truncate periods in utc
+    columns = None
+    if timezone.get_current_timezone_name() == 'UTC':
+        columns = _lead_columns(user, date_from, date_to, label_type, label_values)
+    if columns is not None:
+        mask = columns.mask(date_from, date_to, projects, os_groups, browser_groups, traffic_channels)
+        return columns.period_counts(mask, scale_period)
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        stat_qs = LeadHourStat.objects.filter(user=user)
+        stat_qs = _apply_rollup_common_filters(stat_qs, date_from, date_to, projects,
+                                               os_groups, browser_groups, traffic_channels)
+        return stat_qs.annotate(
+            created_period=_leads_period_unit_expr(scale_period, 'hour')
+        ).values('created_period').annotate(leads_count=Sum('leads')).order_by('created_period')
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
-    scale_period = get_scale_period(date_from, date_to)
+                                          browser_groups, traffic_channels, user=user)
     leads_qs = leads_qs.annotate(
         created_period= _leads_period_unit_expr(scale_period)
     ).values('created_period').annotate(leads_count=Count('id')).order_by('created_period')
@@ -417,14 +806,46 @@ def _lead_duration_groups_case(groups=None):
     return Case(*group_whens, default=Value('Others'), output_field=CharField())
 
 
+def _rollup_duration_groups_case(groups=None):
+    """
+    LeadHourStat keeps group of all LEAD_DURATION_GROUPS,
+    groups which are not asked are 'Others' like in _lead_duration_groups_case
+    :param groups:
+    :return:
+    """
+    if not groups:
+        return F('duration_group')
+    for group_id in groups:
+        if group_id not in LEAD_DURATION_GROUPS:
+            raise AnalyticsError(_('Invalid group parameter'))
+    return Case(
+        When(duration_group__in=tuple(groups), then=F('duration_group')),
+        default=Value('Others'), output_field=CharField()
+    )
+
+
+@cached_analytics
+@guarded_analytics
 def lead_duration_by_period(user: User, date_from: date, date_to: date,
                             groups: list = None, projects: list = None,
                             label_type=None, label_values=None, os_groups=None, browser_groups=None,
                             traffic_channels=None):
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        stat_qs = LeadHourStat.objects.filter(user=user)
+        stat_qs = _apply_rollup_common_filters(stat_qs, date_from, date_to, projects,
+                                               os_groups, browser_groups, traffic_channels)
+        if groups:
+            stat_qs = stat_qs.filter(duration_group__in=groups)
+        scale_period = get_scale_period(date_from, date_to)
+        stat_qs = stat_qs.annotate(group_name=F('duration_group'),
+                                   created_period=_leads_period_unit_expr(scale_period, 'hour'))
+        stat_qs = stat_qs.values('group_name', 'created_period')
+        stat_qs = stat_qs.annotate(leads_count=Sum('leads'))
+        return stat_qs.order_by('created_period', 'group_name')
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
+                                          browser_groups, traffic_channels, user=user)
     leads_qs = leads_qs.annotate(lead_duration=ExpressionWrapper(
         F('created') - F('session_started'), output_field=DurationField()
     ))
@@ -439,15 +860,32 @@ def lead_duration_by_period(user: User, date_from: date, date_to: date,
     return leads_qs
 
 
+@cached_analytics
+@guarded_analytics
 def lead_duration_totals(user: User, date_from: date, date_to: date,
                          groups: list = None, projects: list = None,
                          label_type=None, label_values=None, os_groups=None, browser_groups=None,
                          traffic_channels=None):
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    columns = _lead_columns(user, date_from, date_to, label_type, label_values)
+    if columns is not None:
+        for group_id in groups or ():
+            if group_id not in LEAD_DURATION_GROUPS:
+                raise AnalyticsError(_('Invalid group parameter'))
+        mask = columns.mask(date_from, date_to, projects, os_groups, browser_groups, traffic_channels)
+        return columns.duration_totals(mask, groups)
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        stat_qs = LeadHourStat.objects.filter(user=user)
+        stat_qs = _apply_rollup_common_filters(stat_qs, date_from, date_to, projects,
+                                               os_groups, browser_groups, traffic_channels)
+        stat_qs = stat_qs.annotate(group_name=_rollup_duration_groups_case(groups))
+        stat_qs = stat_qs.values('group_name')
+        stat_qs = stat_qs.annotate(leads_count=Sum('leads'))
+        return stat_qs.order_by('group_name')
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = leads_qs.filter(created__range=(date_from, date_to))
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
+                                          browser_groups, traffic_channels, user=user)
     leads_qs = leads_qs.annotate(lead_duration=ExpressionWrapper(
         F('created') - F('session_started'), output_field=DurationField()
     ))
@@ -458,113 +896,211 @@ def lead_duration_totals(user: User, date_from: date, date_to: date,
     return leads_qs
 
 
+@cached_analytics
+@guarded_analytics
 def consumer_origin_by_period(user: User, date_from: date, date_to: date,
                               groups: list = None, projects: list = None,
                               device_field='device_id',
                               label_type=None, label_values=None, os_groups=None,
                               browser_groups=None, traffic_channels=None):
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
-    leads_qs = leads_qs.annotate(created_date=TruncDay('created'))
-    leads_qs = leads_qs.order_by('created')
-
-    groups_by_dates = _collect_device_frequency_groups_by_dates(leads_qs, groups, device_field)
+                                          browser_groups, traffic_channels, user=user)
+    groups_by_dates = _device_frequency_groups_by_dates(leads_qs, groups, device_field)
     scale_period = get_scale_period(date_from, date_to)
     return _collect_device_frequerncy_groups_by_period(groups_by_dates, scale_period)
 
 
-def _collect_device_frequency_groups_by_dates(leads, groups=None, device_field='device_id'):
+DEVICE_FREQUENCY_SQL = """
+SELECT s.created_date, {group_counts}
+FROM ({leads}) s
+GROUP BY s.created_date
+ORDER BY s.created_date
+"""
+
+
+def _device_frequency_groups_by_dates(leads_qs, groups=None, device_field='device_id'):
     """
-    group leads to sections (5min,1hour...) per date
-    and count sum of device_frequency for each section
-    :param leads: leads from db
-    :type leads: collections.Iterable
+    count leads which came from the same device (or subnet) during group delta
+    after previous lead of the device, previous lead is found by LAG window
+    in the same day, only counts per day and group come from db
+    :param leads_qs: filtered leads
+    :param groups: CONSUMER_ORIGIN_GROUPS keys
+    :param device_field: 'device_id' | 'subnet'
     :rtype: collections.OrderedDict
-    :return: {created_date: { section_name: {'device_last' : {}, 'device_frequency': 0}}}
+    :return: {created_date: {group_name: device_frequency}}
     """
     if not groups:
         groups = CONSUMER_ORIGIN_GROUPS.keys()
+    groups = list(groups)
+    for group_name in groups:
+        if group_name not in CONSUMER_ORIGIN_GROUPS:
+            raise AnalyticsError(_('Invalid group parameter'))
+    if device_field not in ('device_id', 'subnet'):
+        raise AnalyticsError(_('Invalid device field'))
+
+    leads_qs = leads_qs.annotate(
+        created_date=TruncDay('created'),
+        prev_created=Window(
+            expression=Lag('created'),
+            partition_by=[F(device_field), TruncDay('created')],
+            order_by=F('created').asc()
+        )
+    ).values('created_date', 'created', 'prev_created')
+    sql, params = leads_qs.query.sql_with_params()
+    group_counts = ', '.join(
+        'COUNT(*) FILTER (WHERE s.created - s.prev_created < %s)' for _ in groups
+    )
+    params = tuple(CONSUMER_ORIGIN_GROUPS[group_name].delta for group_name in groups) + params
+    sql = DEVICE_FREQUENCY_SQL.format(group_counts=group_counts, leads=sql)
+    check_query_cost(sql, params)
+    with connections[router.db_for_read(Lead)].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
 
     res = OrderedDict()
-    for lead in leads:
-        device = getattr(lead, device_field)
-        if lead.created_date not in res:
-            res[lead.created_date] = {}
-        res_date = res[lead.created_date]
-        for group_name in groups:
-            try:
-                group = CONSUMER_ORIGIN_GROUPS[group_name]
-            except KeyError:
-                raise AnalyticsError(_('Invalid group parameter'))
-            if group_name not in res_date:
-                res_date[group_name] = {'device_last': {}, 'device_frequency': 0}
-            section = res_date[group_name]
-            if device in section['device_last'] \
-                    and lead.created - section['device_last'][device] < group.delta:
-                section['device_frequency'] += 1 if section['device_frequency'] else 2
-            section['device_last'][device] = lead.created
+    for row in rows:
+        # days of current timezone like TruncDay of queryset
+        res[timezone.make_aware(row[0])] = OrderedDict(
+            (group_name, _device_frequency(repeats)) for group_name, repeats in zip(groups, row[1:])
+        )
     return res
 
 
+def _device_frequency(repeats):
+    """
+    first repeat counts both leads of the device, next ones only the new lead
+    >>> _device_frequency(0), _device_frequency(1), _device_frequency(3)
+    (0, 2, 4)
+    """
+    return repeats + 1 if repeats else 0
+
+
 def _collect_device_frequerncy_groups_by_period(groups_by_dates, scale_period):
     groups_by_period = OrderedDict()
     for created_date, sections in groups_by_dates.items():
         created_period = format_leads_period(created_date, scale_period)
         if created_period not in groups_by_period:
             groups_by_period[created_period] = {}
-        for group_name, section in sections.items():
+        for group_name, device_frequency in sections.items():
             if group_name not in groups_by_period[created_period]:
                 groups_by_period[created_period][group_name] = 0
-            groups_by_period[created_period][group_name] += section['device_frequency']
+            groups_by_period[created_period][group_name] += device_frequency
     return groups_by_period
 
 
-def load_url_label_list(user, label_type, label_name, search):
-    model_class = None
-    field_name = None
-    if label_type == 'utm':
-        model_class = LeadUtm
-        if label_name in ['utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content']:
-            field_name = label_name
-    elif label_type == 'openstat':
-        model_class = LeadOpenstat
-        if label_name in ['service', 'campaign', 'ad', 'source']:
-            field_name = label_name
-    if model_class is None or field_name is None:
+@cached_analytics(timeout=URL_LABEL_LIST_CACHE_TIMEOUT)
+def load_url_label_list(user, label_type, label_name, search=None, limit=URL_LABEL_LIST_LIMIT):
+    """
+    most frequent label values of user leads from user labels dictionary,
+    search is a prefix of value
+    """
+    label_kind = url_label_kind(label_type, label_name)
+    if label_kind is None:
         return []
-    qs = model_class.objects.filter(lead__pixel__project__user=user)
-    qs = qs.exclude(**{field_name + '__isnull': True})
-    qs = qs.exclude(**{field_name + '': ''})
+    qs = UserUrlLabel.objects.filter(user=user, label_kind=label_kind)
     if search and len(search) >= 2:
-        qs = qs.filter(**{field_name + '__istartswith': search})
-    qs = qs.values_list(field_name, flat=True).distinct()
-    qs = qs.order_by(field_name)
-    return qs
+        qs = qs.filter(value__istartswith=search)
+    qs = qs.order_by('-leads', 'value')
+    qs = qs.values_list('value', flat=True)
+    return qs[:limit]
 
 
+@cached_analytics
+@guarded_analytics
 def your_lead_lineage_by_period(user: User, date_from: date, date_to: date, projects: list = None,
                            label_type=None, label_values=None, os_groups=None,
                            browser_groups=None, traffic_channels=None):
-    your_leads_qs = Lead.objects.filter(pixel__project__user=user)
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        your_stat_qs = LeadHourStat.objects.filter(user=user)
+        your_stat_qs = _apply_rollup_common_filters(your_stat_qs, date_from, date_to, projects,
+                                                    os_groups, browser_groups, traffic_channels)
+        your_stat_qs = _apply_rollup_lineage_qs(your_stat_qs, date_from, date_to)
+        return your_stat_qs.annotate(lead_type=Value('your', output_field=CharField()))
+    your_leads_qs = Lead.objects.filter(user=user)
     your_leads_qs = _apply_lead_common_filters(your_leads_qs, date_from, date_to, projects,
                                                label_type, label_values, os_groups,
-                                               browser_groups, traffic_channels)
+                                               browser_groups, traffic_channels, user=user)
     your_leads_qs = _apply_lineage_qs(your_leads_qs, date_from, date_to)
     your_leads_qs = your_leads_qs.annotate(lead_type=Value('your', output_field=CharField()))
+    check_query_cost(your_leads_qs)
     return your_leads_qs
 
 
+def _period_totals_unit(date_from: datetime, date_to: datetime):
+    """
+    LeadPeriodTotal unit for lineage of range, days are utc ones
+    and are used for whole days range of not hourly scale only
+    >>> utc = timezone.utc
+    >>> _period_totals_unit(datetime(2017, 1, 1, tzinfo=utc), datetime(2017, 1, 31, 23, 59, 59, tzinfo=utc))
+    'day'
+    >>> _period_totals_unit(datetime(2017, 1, 1, tzinfo=utc), datetime(2017, 1, 1, 23, 59, 59, tzinfo=utc))
+    'hour'
+    >>> _period_totals_unit(datetime(2017, 1, 1, 5, tzinfo=utc), datetime(2017, 1, 31, 23, 59, 59, tzinfo=utc))
+    'hour'
+    """
+    if get_scale_period(date_from, date_to) == 'hour':
+        return 'hour'
+    if timezone.get_current_timezone().utcoffset(_to_utc(date_from).replace(tzinfo=None)):
+        return 'hour'
+    date_from = _to_utc(date_from)
+    date_to = _to_utc(date_to)
+    if date_from.time() != time.min or date_to.time().replace(microsecond=0) != time(23, 59, 59):
+        return 'hour'
+    return 'day'
+
+
+def _other_lead_lineage_from_totals(user: User, date_from: datetime, date_to: datetime):
+    """
+    lineage of other users leads as LeadPeriodTotal minus LeadUserPeriodTotal of user,
+    reads count of periods rows, not leads of all users
+    """
+    unit = _period_totals_unit(date_from, date_to)
+    scale_period = get_scale_period(date_from, date_to)
+
+    def _totals(totals_qs):
+        totals_qs = totals_qs.filter(unit=unit, started__range=(date_from, date_to))
+        totals_qs = totals_qs.annotate(created_period=_leads_period_unit_expr(scale_period, 'started'))
+        totals_qs = totals_qs.values('created_period')
+        totals_qs = totals_qs.annotate(leads_count=Sum('leads'), sales_count=Sum('salecount'))
+        return {row['created_period']: row for row in totals_qs.order_by()}
+
+    own = _totals(LeadUserPeriodTotal.objects.filter(user=user))
+    rows = []
+    for created_period, row in sorted(_totals(LeadPeriodTotal.objects.all()).items()):
+        own_row = own.get(created_period, {'leads_count': 0, 'sales_count': 0})
+        leads_count = row['leads_count'] - own_row['leads_count']
+        if leads_count > 0:
+            rows.append({
+                'created_period': created_period,
+                'leads_count': leads_count,
+                'sales_count': row['sales_count'] - own_row['sales_count'],
+                'lead_type': 'other',
+            })
+    return rows
+
+
+@cached_analytics(scope=GLOBAL_SCOPE)
+@guarded_analytics
 def other_lead_lineage_by_period(user: User, date_from: date, date_to: date,
                            label_type=None, label_values=None, os_groups=None,
                            browser_groups=None, traffic_channels=None):
-    other_leads_qs = Lead.objects.exclude(pixel__project__user=user)
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        if not os_groups and not browser_groups and not traffic_channels:
+            return _other_lead_lineage_from_totals(user, date_from, date_to)
+        other_stat_qs = LeadHourStat.objects.exclude(user=user)
+        other_stat_qs = _apply_rollup_common_filters(other_stat_qs, date_from, date_to, None,
+                                                     os_groups, browser_groups, traffic_channels)
+        other_stat_qs = _apply_rollup_lineage_qs(other_stat_qs, date_from, date_to)
+        return other_stat_qs.annotate(lead_type=Value('other', output_field=CharField()))
+    other_leads_qs = Lead.objects.exclude(user=user)
     other_leads_qs = _apply_lead_common_filters(other_leads_qs, date_from, date_to, None,
                                                 label_type, label_values, os_groups,
                                                 browser_groups, traffic_channels)
     other_leads_qs = _apply_lineage_qs(other_leads_qs, date_from, date_to)
     other_leads_qs = other_leads_qs.annotate(lead_type=Value('other', output_field=CharField()))
+    check_query_cost(other_leads_qs)
     return other_leads_qs
 
 
@@ -582,15 +1118,42 @@ def _apply_lineage_qs(leads_qs, date_from, date_to):
     return leads_qs
 
 
+def _apply_rollup_lineage_qs(stat_qs, date_from, date_to):
+    scale_period = get_scale_period(date_from, date_to)
+    stat_qs = stat_qs.annotate(created_period=_leads_period_unit_expr(scale_period, 'hour'))
+    stat_qs = stat_qs.values('created_period')
+    stat_qs = stat_qs.annotate(leads_count=Sum('leads'))
+    stat_qs = stat_qs.annotate(sales_count=Sum('salecount'))
+    stat_qs = stat_qs.order_by('created_period')
+    return stat_qs
+
+
+@cached_analytics
+@guarded_analytics
 def lead_browser_totals(user: User, date_from: date, date_to: date,
                          projects: list = None, label_type=None, label_values=None,
                          os_groups=None, browser_groups=None, traffic_channels=None):
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    columns = _lead_columns(user, date_from, date_to, label_type, label_values)
+    if columns is not None:
+        mask = columns.mask(date_from, date_to, projects, os_groups, browser_groups, traffic_channels)
+        return columns.group_totals('browser_group', mask,
+                                    dict(BrowserGroup.objects.values_list('id', 'name')))
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        stat_qs = LeadHourStat.objects.filter(user=user)
+        stat_qs = _apply_rollup_common_filters(stat_qs, date_from, date_to, projects,
+                                               os_groups, browser_groups, traffic_channels)
+        stat_qs = stat_qs.annotate(
+            group_name=Coalesce(F('browser_group__name'), Value(_('Unknown')))
+        )
+        stat_qs = stat_qs.values('group_name')
+        stat_qs = stat_qs.annotate(leads_count=Sum('leads'))
+        return stat_qs.order_by('group_name')
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
+                                          browser_groups, traffic_channels, user=user)
     leads_qs = leads_qs.annotate(
-        group_name=Coalesce(F('browser__family__group__name'), Value(_('Unknown')))
+        group_name=Coalesce(F('browser_group__name'), Value(_('Unknown')))
     )
     leads_qs = leads_qs.values('group_name')
     leads_qs = leads_qs.annotate(leads_count=Count('id'))
@@ -598,20 +1161,41 @@ def lead_browser_totals(user: User, date_from: date, date_to: date,
     return leads_qs
 
 
+@cached_analytics
+@guarded_analytics
 def lead_device_type_totals(user: User, date_from: date, date_to: date,
                          projects: list = None, label_type=None, label_values=None,
                          os_groups=None, browser_groups=None, traffic_channels=None):
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    columns = _lead_columns(user, date_from, date_to, label_type, label_values)
+    if columns is not None:
+        mask = columns.mask(date_from, date_to, projects, os_groups, browser_groups, traffic_channels)
+        return columns.group_totals('device_category', mask, {
+            DeviceType.PHONE: 'Mobile', DeviceType.TABLET: 'Mobile', DeviceType.DESKTOP: 'Desktop'
+        })
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        stat_qs = LeadHourStat.objects.filter(user=user)
+        stat_qs = _apply_rollup_common_filters(stat_qs, date_from, date_to, projects,
+                                               os_groups, browser_groups, traffic_channels)
+        stat_qs = stat_qs.annotate(group_name=Case(
+            When(device_category__in=(DeviceType.PHONE, DeviceType.TABLET), then=Value('Mobile')),
+            When(device_category=DeviceType.DESKTOP, then=Value('Desktop')),
+            default=Value(_('Unknown')),
+            output_field=CharField()
+        ))
+        stat_qs = stat_qs.values('group_name')
+        stat_qs = stat_qs.annotate(leads_count=Sum('leads'))
+        return stat_qs.order_by('group_name')
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
+                                          browser_groups, traffic_channels, user=user)
     leads_qs = leads_qs.annotate(lead_duration=ExpressionWrapper(
         F('created') - F('session_started'), output_field=DurationField()
     ))
     leads_qs = leads_qs.annotate(group_name=Case(
-        When(device_model__device_type__category__in=(DeviceType.PHONE,DeviceType.TABLET),
+        When(device_category__in=(DeviceType.PHONE,DeviceType.TABLET),
              then=Value('Mobile')),
-        When(device_model__device_type__category=(DeviceType.DESKTOP),
+        When(device_category=(DeviceType.DESKTOP),
              then=Value('Desktop')),
         default=Value(_('Unknown')),
         output_field=CharField()
@@ -622,21 +1206,158 @@ def lead_device_type_totals(user: User, date_from: date, date_to: date,
     return leads_qs
 
 
+@cached_analytics
+@guarded_analytics
 def lead_os_totals(user: User, date_from: date, date_to: date, is_mobile,
                          projects: list = None, label_type=None, label_values=None,
                          os_groups=None, browser_groups=None, traffic_channels=None):
-    leads_qs = Lead.objects.filter(pixel__project__user=user)
+    columns = _lead_columns(user, date_from, date_to, label_type, label_values)
+    if columns is not None:
+        names = dict(OSGroup.objects.filter(is_mobile=is_mobile).values_list('id', 'name'))
+        mask = columns.mask(date_from, date_to, projects, os_groups, browser_groups, traffic_channels)
+        mask &= columns.in_groups('os_group', names)
+        return columns.group_totals('os_group', mask, names)
+    if _use_lead_rollups(date_from, date_to, label_type, label_values):
+        stat_qs = LeadHourStat.objects.filter(user=user)
+        stat_qs = _apply_rollup_common_filters(stat_qs, date_from, date_to, projects,
+                                               os_groups, browser_groups, traffic_channels)
+        stat_qs = stat_qs.filter(os_group__is_mobile=is_mobile)
+        stat_qs = stat_qs.annotate(
+            group_name=Coalesce(F('os_group__name'), Value(_('Unknown')))
+        )
+        stat_qs = stat_qs.values('group_name')
+        stat_qs = stat_qs.annotate(leads_count=Sum('leads'))
+        return stat_qs.order_by('group_name')
+    leads_qs = Lead.objects.filter(user=user)
     leads_qs = _apply_lead_common_filters(leads_qs, date_from, date_to, projects,
                                           label_type, label_values, os_groups,
-                                          browser_groups, traffic_channels)
-    leads_qs = leads_qs.filter(os_version__family__group__is_mobile=is_mobile)
+                                          browser_groups, traffic_channels, user=user)
+    leads_qs = leads_qs.filter(os_group__is_mobile=is_mobile)
     leads_qs = leads_qs.annotate(lead_duration=ExpressionWrapper(
         F('created') - F('session_started'), output_field=DurationField()
     ))
     leads_qs = leads_qs.annotate(
-        group_name=Coalesce(F('os_version__family__group__name'), Value(_('Unknown')))
+        group_name=Coalesce(F('os_group__name'), Value(_('Unknown')))
     )
     leads_qs = leads_qs.values('group_name')
     leads_qs = leads_qs.annotate(leads_count=Count('id'))
     leads_qs = leads_qs.order_by('group_name')
     return leads_qs
+
+
+DASHBOARD_SUMMARY_SQL = """
+SELECT
+    GROUPING(s.browser_group_name) AS by_browser,
+    GROUPING(s.device_group) AS by_device,
+    GROUPING(s.os_group_name, s.os_is_mobile) AS by_os,
+    s.browser_group_name AS browser_group, s.device_group, s.os_group_name AS os_group, s.os_is_mobile,
+    COUNT(*) AS visits,
+    COUNT(*) FILTER (WHERE s.converted) AS conversions,
+    COUNT(DISTINCT s.device_id) FILTER (WHERE s.converted) AS devices
+FROM ({leads}) s
+GROUP BY GROUPING SETS ((), (s.browser_group_name), (s.device_group), (s.os_group_name, s.os_is_mobile))
+"""
+
+
+@cached_analytics
+@guarded_analytics
+def dashboard_summary(user: User, date_from: date, date_to: date,
+                      projects: list = None, label_type=None, label_values=None,
+                      os_groups=None, browser_groups=None, traffic_channels=None):
+    """
+    total_visits, total_conversions, total_devices, lead_browser_totals,
+    lead_device_type_totals and lead_os_totals for mobile and desktop in one scan of leads:
+    visits are leads started or created in range, others are counted
+    with FILTER over converted (created in range) ones, breakdowns are GROUPING SETS
+    :return: {'total_visits': int, 'total_conversions': int, 'total_devices': int,
+              'browser_totals': [], 'device_type_totals': [], 'mobile_os_totals': [],
+              'desktop_os_totals': []}, totals are lists of {'group_name', 'leads_count'}
+    """
+    leads_qs = Lead.objects.filter(user=user)
+    leads_qs = leads_qs.filter(
+        Q(session_started__range=(date_from, date_to)) | Q(created__range=(date_from, date_to))
+    )
+    if projects:
+        leads_qs = leads_qs.filter(project__in=tuple(projects))
+    if os_groups:
+        leads_qs = leads_qs.filter(os_group__in=tuple(os_groups))
+    if browser_groups:
+        leads_qs = leads_qs.filter(browser_group__in=tuple(browser_groups))
+    if traffic_channels:
+        leads_qs = leads_qs.filter(traffic_channel__in=tuple(traffic_channels))
+    leads_qs = _set_url_label_filter(leads_qs, label_type, label_values, user)
+    leads_qs = leads_qs.annotate(
+        converted=Case(
+            When(created__range=(date_from, date_to), then=Value(True)),
+            default=Value(False), output_field=BooleanField()
+        ),
+        browser_group_name=Coalesce(F('browser_group__name'), Value(_('Unknown'))),
+        device_group=Case(
+            When(device_category__in=(DeviceType.PHONE, DeviceType.TABLET),
+                 then=Value('Mobile')),
+            When(device_category=DeviceType.DESKTOP, then=Value('Desktop')),
+            default=Value(_('Unknown')),
+            output_field=CharField()
+        ),
+        os_group_name=Coalesce(F('os_group__name'), Value(_('Unknown'))),
+        os_is_mobile=F('os_group__is_mobile'),
+    )
+    leads_qs = leads_qs.values('converted', 'browser_group_name', 'device_group', 'os_group_name',
+                               'os_is_mobile', 'device_id')
+    sql, params = leads_qs.query.sql_with_params()
+    sql = DASHBOARD_SUMMARY_SQL.format(leads=sql)
+    check_query_cost(sql, params)
+    with connections[router.db_for_read(Lead)].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = dictfetchall(cursor)
+    return _collect_dashboard_summary(rows)
+
+
+def _collect_dashboard_summary(rows):
+    """
+    split GROUPING SETS rows of DASHBOARD_SUMMARY_SQL
+    >>> summary = _collect_dashboard_summary([
+    ...     {'by_browser': 1, 'by_device': 1, 'by_os': 3, 'visits': 5, 'conversions': 3, 'devices': 2},
+    ...     {'by_browser': 0, 'by_device': 1, 'by_os': 3, 'browser_group': 'Chrome', 'conversions': 3},
+    ...     {'by_browser': 1, 'by_device': 0, 'by_os': 3, 'device_group': 'Mobile', 'conversions': 0},
+    ...     {'by_browser': 1, 'by_device': 1, 'by_os': 0, 'os_group': 'iOS', 'os_is_mobile': True,
+    ...      'conversions': 3},
+    ...     {'by_browser': 1, 'by_device': 1, 'by_os': 0, 'os_group': 'Unknown', 'os_is_mobile': None,
+    ...      'conversions': 1},
+    ... ])
+    >>> summary['total_visits'], summary['total_conversions'], summary['total_devices']
+    (5, 3, 2)
+    >>> summary['browser_totals'], summary['device_type_totals'], summary['desktop_os_totals']
+    ([{'group_name': 'Chrome', 'leads_count': 3}], [], [])
+    >>> summary['mobile_os_totals']
+    [{'group_name': 'iOS', 'leads_count': 3}]
+    """
+    summary = {
+        'total_visits': 0, 'total_conversions': 0, 'total_devices': 0,
+        'browser_totals': [], 'device_type_totals': [],
+        'mobile_os_totals': [], 'desktop_os_totals': [],
+    }
+    for row in rows:
+        if row['by_browser'] and row['by_device'] and row['by_os']:
+            summary['total_visits'] = row['visits']
+            summary['total_conversions'] = row['conversions']
+            summary['total_devices'] = row['devices']
+            continue
+        # breakdowns count converted leads only, like *_totals functions
+        if not row['conversions']:
+            continue
+        if not row['by_browser']:
+            totals, group_name = summary['browser_totals'], row['browser_group']
+        elif not row['by_device']:
+            totals, group_name = summary['device_type_totals'], row['device_group']
+        elif row['os_is_mobile'] is None:
+            # lead_os_totals skips leads without os
+            continue
+        elif row['os_is_mobile']:
+            totals, group_name = summary['mobile_os_totals'], row['os_group']
+        else:
+            totals, group_name = summary['desktop_os_totals'], row['os_group']
+        totals.append({'group_name': group_name, 'leads_count': row['conversions']})
+    for key in ('browser_totals', 'device_type_totals', 'mobile_os_totals', 'desktop_os_totals'):
+        summary[key].sort(key=lambda total: total['group_name'])
+    return summary
@@ -0,0 +1,226 @@
+"""
+Result cache of collector.analytics functions
+
+Entry key is (function, user, normalised arguments, language), entry keeps
+the watermark of the user's leads it was computed at. fill_leads moves the
+watermark of users whose leads were filled (invalidate_users), so entries of
+those users miss and are recomputed on the next call.
+
+Functions read from a read replica (utils.db_router.replica_reads), a replica
+may not have the leads of a just moved watermark yet, so such entries
+expire after settings.REPLICA_MAX_LAG.
+
+Hit and miss counters are kept in the worker process, hits do not write to the cache.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import date, datetime
+from functools import wraps
+from inspect import signature
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Model
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from django.utils.translation import get_language
+
+from utils.db_router import DEFAULT_DB_ALIAS, replica_reads
+
+# all decorated functions by name
+CACHED_FUNCTIONS = {}
+
+# watermark of all users leads, used by functions which read leads of other users
+GLOBAL_SCOPE = 'global'
+USER_SCOPE = 'user'
+
+
+def _cache():
+    """
+    :return: cache backend or None if cache disabled
+    """
+    if not settings.ANALYTICS_CACHE:
+        return None
+    return caches[settings.ANALYTICS_CACHE]
+
+
+def _watermark_key(user_id):
+    return 'analytics:watermark:{}'.format(user_id)
+
+
+# (function, stat): value of this process since start
+_stats = defaultdict(int)
+_stats_lock = threading.Lock()
+
+
+def normalize(value):
+    """
+    make filter value hashable and independent of order and timezone
+    >>> normalize(datetime(2018, 3, 1, 3, tzinfo=timezone.get_fixed_timezone(180)))
+    '2018-03-01T00:00:00+00:00'
+    >>> normalize([3, 1, 2]) == normalize((2, 3, 1))
+    True
+    >>> normalize({'utm_source': 'google', 'utm_medium': 'cpc'})
+    (('utm_medium', 'cpc'), ('utm_source', 'google'))
+    >>> normalize([]) is normalize({}) is normalize(None)
+    True
+    """
+    if isinstance(value, datetime):
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value.astimezone(timezone.utc).isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Model):
+        return value.pk
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v)) for k, v in value.items())) or None
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted((normalize(v) for v in value), key=str)) or None
+    return value
+
+
+def make_key(func_name, arguments):
+    """
+    :param func_name: analytics function name
+    :param arguments: {argument: value}, must have user
+    :return: cache key
+    """
+    params = sorted((name, normalize(value)) for name, value in arguments.items() if name != 'user')
+    digest = hashlib.md5(repr((params, get_language())).encode()).hexdigest()
+    return 'analytics:{}:{}:{}'.format(func_name, normalize(arguments['user']), digest)
+
+
+def get_watermarks(cache, user_ids):
+    """
+    current watermarks, missing ones (never invalidated or evicted) are started now
+    :param user_ids: list of user ids or GLOBAL_SCOPE
+    :return: tuple of watermarks in user_ids order
+    """
+    keys = [_watermark_key(user_id) for user_id in user_ids]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, time.time(), None)
+            found[key] = cache.get(key)
+    return tuple(found[key] for key in keys)
+
+
+def invalidate_users(user_ids):
+    """
+    move watermark of users and global one, call it when leads of users changed,
+    inside transaction it is done on commit, so nobody caches not committed state
+    :param user_ids: iterable of user ids
+    """
+    cache = _cache()
+    if cache is None:
+        return
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def _invalidate():
+        watermark = time.time()
+        cache.set_many({
+            _watermark_key(user_id): watermark for user_id in user_ids | {GLOBAL_SCOPE}
+        }, None)
+
+    transaction.on_commit(_invalidate)
+
+
+def _count(func_name, **deltas):
+    with _stats_lock:
+        for stat, delta in deltas.items():
+            _stats[(func_name, stat)] += delta
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _call(func, args, kwargs):
+    """
+    :return: (result of func read from replica, querysets are evaluated to lists; alias read from)
+    """
+    with replica_reads() as alias:
+        result = func(*args, **kwargs)
+        if isinstance(result, QuerySet):
+            result = list(result)
+    return result, alias
+
+
+def cached_analytics(func=None, scope=USER_SCOPE, timeout=None):
+    """
+    cache result of analytics function, querysets are evaluated to lists
+    :param scope: USER_SCOPE - result depends on user leads only,
+        GLOBAL_SCOPE - on leads of all users
+    :param timeout: seconds, settings.ANALYTICS_CACHE_TIMEOUT by default,
+        functions which depend on current time need short one
+    """
+    if func is None:
+        return lambda f: cached_analytics(f, scope, timeout)
+
+    func_signature = signature(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = _cache()
+        if cache is None:
+            return _call(func, args, kwargs)[0]
+        bound = func_signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = bound.arguments
+        key = make_key(func.__name__, arguments)
+        watermark_ids = [normalize(arguments['user'])]
+        if scope == GLOBAL_SCOPE:
+            watermark_ids.append(GLOBAL_SCOPE)
+        # watermark is taken before calculation, new leads committed during it
+        # move watermark and the entry misses next time
+        watermark = get_watermarks(cache, watermark_ids)
+
+        entry = cache.get(key)
+        if entry is not None and entry['watermark'] == watermark:
+            _count(func.__name__, hits=1, saved_ms=entry['elapsed_ms'])
+            return entry['result']
+
+        started = time.perf_counter()
+        result, alias = _call(func, args, kwargs)
+        elapsed_ms = int((time.perf_counter() - started) * 1000)
+        entry_timeout = timeout if timeout is not None else settings.ANALYTICS_CACHE_TIMEOUT
+        if alias != DEFAULT_DB_ALIAS and time.time() - max(watermark) < settings.REPLICA_MAX_LAG:
+            entry_timeout = min(entry_timeout, settings.REPLICA_MAX_LAG)
+        cache.set(key, {
+            'watermark': watermark,
+            'computed': time.time(),
+            'elapsed_ms': elapsed_ms,
+            'result': result,
+        }, entry_timeout)
+        _count(func.__name__, misses=1, spent_ms=elapsed_ms)
+        return result
+
+    CACHED_FUNCTIONS[func.__name__] = wrapper
+    return wrapper
+
+
+def cache_stats():
+    """
+    :return: list of {function, hits, misses, hit_ratio, saved_ms, spent_ms} of this process
+    """
+    if _cache() is None:
+        return []
+    stats = []
+    for func_name in sorted(CACHED_FUNCTIONS):
+        with _stats_lock:
+            stat = {name: _stats[(func_name, name)] for name in ('hits', 'misses', 'saved_ms', 'spent_ms')}
+        calls = stat['hits'] + stat['misses']
+        stat['hit_ratio'] = stat['hits'] / calls if calls else 0.0
+        stat['function'] = func_name
+        stats.append(stat)
+    return stats
@@ -0,0 +1,144 @@
+"""
+Guardrails of expensive analytics queries
+
+guarded_analytics functions are rejected before any query when their range is
+longer than settings.ANALYTICS_MAX_RANGE_DAYS of the function, and run with
+settings.ANALYTICS_STATEMENT_TIMEOUT on the database they read from.
+check_query_cost rejects aggregates over raw leads whose EXPLAIN estimate is
+above settings.ANALYTICS_MAX_QUERY_COST before running them.
+
+Rejections are AnalyticsQueryRejected, GraphQL clients get them with
+extensions {code: 'NARROW_RANGE', reason, maxDays} and should ask for a
+shorter range instead of retrying.
+"""
+import json
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import wraps
+from inspect import signature
+
+from django.conf import settings
+from django.db import connections, router, transaction, OperationalError
+from django.db.models.query import QuerySet
+from django.utils.translation import ugettext as _
+
+from collector.models import Lead
+
+# postgres error code of statement_timeout
+QUERY_CANCELED = '57014'
+
+RANGE = 'range'
+COST = 'cost'
+TIMEOUT = 'timeout'
+
+
+class AnalyticsQueryRejected(Exception):
+    """
+    analytics query is too expensive for requested range
+    """
+    def __init__(self, reason, max_days=None):
+        self.reason = reason
+        self.max_days = max_days
+        if reason == RANGE:
+            message = _('Range is too long, narrow your range to {} days').format(max_days)
+        else:
+            message = _('Query is too expensive, narrow your range or filters')
+        super().__init__(message)
+
+    @property
+    def extensions(self):
+        """
+        :return: dict of GraphQL error extensions
+        """
+        return {'code': 'NARROW_RANGE', 'reason': self.reason, 'maxDays': self.max_days}
+
+
+def max_range_days(func_name):
+    """
+    :return: longest range in days of analytics function, None is unlimited
+    """
+    limits = settings.ANALYTICS_MAX_RANGE_DAYS
+    return limits.get(func_name, limits.get('default'))
+
+
+def check_range(func_name, date_from, date_to):
+    """
+    :raise AnalyticsQueryRejected: range is longer than limit of function
+    """
+    max_days = max_range_days(func_name)
+    if max_days is not None and date_to - date_from > timedelta(days=max_days):
+        raise AnalyticsQueryRejected(RANGE, max_days)
+
+
+def _read_alias():
+    return router.db_for_read(Lead)
+
+
+@contextmanager
+def statement_timeout(milliseconds, using=None):
+    """
+    run block in transaction with statement_timeout, previous value is restored
+    in enclosing transaction, canceled queries raise AnalyticsQueryRejected
+    :param using: db alias, alias of Lead reads by default
+    """
+    using = using or _read_alias()
+    try:
+        with transaction.atomic(using=using):
+            with connections[using].cursor() as cursor:
+                cursor.execute("SELECT current_setting('statement_timeout')")
+                previous = cursor.fetchone()[0]
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(milliseconds)])
+            yield
+            with connections[using].cursor() as cursor:
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", [previous])
+    except OperationalError as e:
+        if getattr(e.__cause__, 'pgcode', None) == QUERY_CANCELED:
+            raise AnalyticsQueryRejected(TIMEOUT) from e
+        raise
+
+
+def query_cost(sql, params, using=None):
+    """
+    :return: EXPLAIN total cost estimate of query
+    """
+    using = using or _read_alias()
+    with connections[using].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Total Cost']
+
+
+def check_query_cost(query, params=None):
+    """
+    :param query: QuerySet or sql with params
+    :raise AnalyticsQueryRejected: estimate is above settings.ANALYTICS_MAX_QUERY_COST
+    """
+    max_cost = settings.ANALYTICS_MAX_QUERY_COST
+    if max_cost is None:
+        return
+    if isinstance(query, QuerySet):
+        query, params = query.query.sql_with_params()
+    if query_cost(query, params) > max_cost:
+        raise AnalyticsQueryRejected(COST)
+
+
+def guarded_analytics(func):
+    """
+    check range of analytics function and run it with statement timeout,
+    querysets are evaluated inside, use it under cached_analytics
+    """
+    func_signature = signature(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = func_signature.bind(*args, **kwargs).arguments
+        check_range(func.__name__, arguments['date_from'], arguments['date_to'])
+        with statement_timeout(settings.ANALYTICS_STATEMENT_TIMEOUT):
+            result = func(*args, **kwargs)
+            if isinstance(result, QuerySet):
+                result = list(result)
+        return result
+
+    return wrapper
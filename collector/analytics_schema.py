@@ -1,5 +1,5 @@
 import graphene
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, get_language
 from graphene_django.types import DjangoObjectType
 
 from collector.models import LEAD_AGE_GROUPS, LEAD_DURATION_GROUPS, CONSUMER_ORIGIN_GROUPS
@@ -7,9 +7,15 @@ from collector.analytics import lead_age_totals, leads_by_period, format_leads_p
     lead_duration_by_period, lead_duration_totals, consumer_origin_by_period, load_url_label_list, \
     get_leads, lead_browser_totals, lead_device_type_totals, lead_os_totals, \
     your_lead_lineage_by_period, other_lead_lineage_by_period, \
-    total_visits, total_conversions, total_devices, get_scale_period
-from collector.models.dictionaries import OSGroup, BrowserGroup, TrafficChannel
+    total_visits, total_conversions, total_devices, get_scale_period, dashboard_summary, \
+    fill_lead_labels, leads_cursor, URL_LABEL_LIST_LIMIT, URL_LABEL_LIST_MAX_LIMIT, \
+    period_axis, period_series, lead_age_now
+from collector.analytics_cache import cache_stats
+from collector.models.dictionaries import OSGroup, BrowserGroup, TrafficChannel, City
 from collector.models.analytics import Lead
+from collector.projects_schema import pixel_loader
+from utils.dataloader import ModelLoader, get_loader
+from utils.db_router import replica_reads
 from utils.graphene import JSONDict
 
 
@@ -32,6 +38,33 @@ class SalesPeriodGroup(LeadsPeriod, LeadsGroup):
     leads_count = graphene.Float()
 
 
+class PeriodSeries(graphene.ObjectType):
+    group_name = graphene.String()
+    group_title = graphene.String()
+    # value per period of PeriodSeriesSet.periods, null is no data
+    counts = graphene.List(graphene.Float)
+
+
+class PeriodSeriesSet(graphene.ObjectType):
+    periods = graphene.List(graphene.types.datetime.DateTime)
+    labels = graphene.List(graphene.String)
+    series = graphene.List(PeriodSeries)
+
+
+def _series_set(date_from, date_to, axis, series):
+    """
+    :param axis: period_axis
+    :param series: list of PeriodSeries
+    :return: PeriodSeriesSet with one label per period
+    """
+    scale_period = get_scale_period(date_from, date_to)
+    return PeriodSeriesSet(
+        periods=axis,
+        labels=[format_leads_period(created_period, scale_period) for created_period in axis],
+        series=series
+    )
+
+
 def _resolve_groups(info, groups_const):
     groups = []
     for group_id, group in groups_const.items():
@@ -69,6 +102,41 @@ class LeadType(DjangoObjectType):
             'id', 'created', 'session_started',
             'pixel', 'os_group', 'device', 'city', 'country')
 
+    def resolve_os_group(self, info):
+        # set by fill_lead_labels
+        return getattr(self, 'os_group_name', None)
+
+    def resolve_pixel(self, info):
+        return pixel_loader(info).load(self.pixel_id)
+
+    def resolve_city(self, info):
+        return _lead_geo(info, self, 'city')
+
+    def resolve_country(self, info):
+        return _lead_geo(info, self, 'country')
+
+
+def _lead_geo(info, lead, label):
+    """
+    city or country label of lead set by fill_lead_labels,
+    cities of leads not filled by it are batch loaded
+    :param label: 'city' | 'country'
+    """
+    if hasattr(lead, label):
+        return getattr(lead, label)
+    if lead.geo_id is None:
+        return None
+    city_loader = get_loader(info, 'city', lambda: ModelLoader(City.objects.all()))
+
+    def _label(city):
+        if city is None:
+            return None
+        if label == 'country':
+            return city.country.name
+        return city.name_ru if get_language() == 'ru-ru' and city.name_ru else city.name
+
+    return city_loader.load(lead.geo_id).then(_label)
+
 
 
 class TrafficChannelType(DjangoObjectType):
@@ -79,6 +147,36 @@ class TrafficChannelType(DjangoObjectType):
 class LeadsPaginated(graphene.ObjectType):
     data = graphene.List(LeadType)
     total = graphene.Int()
+    next_cursor = graphene.String(description='after argument of the next page, null on the last one')
+
+
+class DashboardSummary(graphene.ObjectType):
+    total_visits = graphene.Int()
+    total_conversions = graphene.Int()
+    total_devices = graphene.Int()
+    lead_browser_totals = graphene.List(LeadsGroup)
+    lead_device_type_totals = graphene.List(LeadsGroup)
+    lead_mobile_os_totals = graphene.List(LeadsGroup)
+    lead_desktop_os_totals = graphene.List(LeadsGroup)
+
+
+def _totals_groups(totals):
+    return [
+        LeadsGroup(
+            group_name=total['group_name'],
+            group_title=total['group_name'],
+            leads_count=total['leads_count']
+        ) for total in totals
+    ]
+
+
+class AnalyticsCacheStat(graphene.ObjectType):
+    function = graphene.String()
+    hits = graphene.Int()
+    misses = graphene.Int()
+    hit_ratio = graphene.Float()
+    saved_ms = graphene.Int(description='time of hits if they were computed')
+    spent_ms = graphene.Int(description='time of misses computation')
 
 class Query(graphene.ObjectType):
     lead_age_groups = graphene.List(LeadsGroup)
@@ -98,7 +196,8 @@ class Query(graphene.ObjectType):
         browser_groups=graphene.List(graphene.Int, required=False),
         traffic_channels=graphene.List(graphene.Int, required=False),
         limit=graphene.Int(),
-        offset=graphene.Int()
+        offset=graphene.Int(),
+        after=graphene.String(description='nextCursor of previous page, use it instead of offset')
     )
     total_visits = graphene.Field(
         graphene.Int,
@@ -131,7 +230,12 @@ class Query(graphene.ObjectType):
         label_values=JSONDict(required=False),
         os_groups=graphene.List(graphene.Int, required=False),
         browser_groups=graphene.List(graphene.Int, required=False),
-        traffic_channels=graphene.List(graphene.Int, required=False)
+        traffic_channels=graphene.List(graphene.Int, required=False),
+        approximate=graphene.Boolean(
+            required=False, default_value=False,
+            description='estimate from sketches, standard error 1.6%, used without os, '
+                        'browser, channel and label filters for whole hours range'
+        )
     )
     leads_by_period = graphene.List(
         LeadsPeriod,
@@ -144,6 +248,18 @@ class Query(graphene.ObjectType):
         browser_groups=graphene.List(graphene.Int, required=False),
         traffic_channels = graphene.List(graphene.Int, required=False)
     )
+    leads_series_by_period = graphene.Field(
+        PeriodSeriesSet,
+        description='leads_by_period as dense arrays, periods without leads are 0',
+        date_from=graphene.types.datetime.DateTime(required=True),
+        date_to=graphene.types.datetime.DateTime(required=True),
+        projects=graphene.List(graphene.UUID, required=False),
+        label_type=graphene.String(required=False),
+        label_values=JSONDict(required=False),
+        os_groups=graphene.List(graphene.Int, required=False),
+        browser_groups=graphene.List(graphene.Int, required=False),
+        traffic_channels=graphene.List(graphene.Int, required=False)
+    )
     lead_age_totals = graphene.List(
         LeadsGroup,
         date_from=graphene.types.datetime.DateTime(required=True),
@@ -168,6 +284,19 @@ class Query(graphene.ObjectType):
         browser_groups=graphene.List(graphene.Int, required=False),
         traffic_channels=graphene.List(graphene.Int, required=False)
     )
+    lead_duration_series_by_period = graphene.Field(
+        PeriodSeriesSet,
+        description='lead_duration_by_period as dense arrays per group, periods without leads are 0',
+        date_from=graphene.types.datetime.DateTime(required=True),
+        date_to=graphene.types.datetime.DateTime(required=True),
+        groups=graphene.List(graphene.String, required=False),
+        projects=graphene.List(graphene.UUID, required=False),
+        label_type=graphene.String(required=False),
+        label_values=JSONDict(required=False),
+        os_groups=graphene.List(graphene.Int, required=False),
+        browser_groups=graphene.List(graphene.Int, required=False),
+        traffic_channels=graphene.List(graphene.Int, required=False)
+    )
     lead_duration_totals = graphene.List(
         LeadsGroup,
         date_from=graphene.types.datetime.DateTime(required=True),
@@ -205,11 +334,25 @@ class Query(graphene.ObjectType):
         traffic_channels=graphene.List(graphene.Int, required=False),
         lead_owner=graphene.String(required=False) #'you','other','all'
     )
+    lead_lineage_series_by_period = graphene.Field(
+        PeriodSeriesSet,
+        description='lead_lineage_by_period as dense arrays, periods without leads are null',
+        date_from=graphene.types.datetime.DateTime(required=True),
+        date_to=graphene.types.datetime.DateTime(required=True),
+        projects=graphene.List(graphene.UUID, required=False),
+        label_type=graphene.String(required=False),
+        label_values=JSONDict(required=False),
+        os_groups=graphene.List(graphene.Int, required=False),
+        browser_groups=graphene.List(graphene.Int, required=False),
+        traffic_channels=graphene.List(graphene.Int, required=False),
+        lead_owner=graphene.String(required=False) #'you','other','all'
+    )
     url_label_list = graphene.List(
         graphene.String,
         label_type=graphene.String(required=True),
         label_name=graphene.String(required=True),
-        search=graphene.String(required=False)
+        search=graphene.String(required=False),
+        limit=graphene.Int(required=False)
     )
 
     lead_browser_totals = graphene.List(
@@ -249,6 +392,42 @@ class Query(graphene.ObjectType):
         traffic_channels=graphene.List(graphene.Int, required=False)
     )
 
+    dashboard_summary = graphene.Field(
+        DashboardSummary,
+        date_from=graphene.types.datetime.DateTime(required=True),
+        date_to=graphene.types.datetime.DateTime(required=True),
+        projects=graphene.List(graphene.UUID, required=False),
+        label_type=graphene.String(required=False),
+        label_values=JSONDict(required=False),
+        os_groups=graphene.List(graphene.Int, required=False),
+        browser_groups=graphene.List(graphene.Int, required=False),
+        traffic_channels=graphene.List(graphene.Int, required=False)
+    )
+    analytics_cache_stats = graphene.List(AnalyticsCacheStat, description='counters of the answering worker process')
+
+    def resolve_dashboard_summary(self, info, date_from, date_to, projects=None,
+                                  label_type=None, label_values=None,
+                                  os_groups=None, browser_groups=None, traffic_channels=None):
+        if not info.context.user.is_authenticated:
+            return None
+        user = info.context.user
+        summary = dashboard_summary(user, date_from, date_to, projects, label_type,
+                                    label_values, os_groups, browser_groups, traffic_channels)
+        return DashboardSummary(
+            total_visits=summary['total_visits'],
+            total_conversions=summary['total_conversions'],
+            total_devices=summary['total_devices'],
+            lead_browser_totals=_totals_groups(summary['browser_totals']),
+            lead_device_type_totals=_totals_groups(summary['device_type_totals']),
+            lead_mobile_os_totals=_totals_groups(summary['mobile_os_totals']),
+            lead_desktop_os_totals=_totals_groups(summary['desktop_os_totals']),
+        )
+
+    def resolve_analytics_cache_stats(self, info):
+        if not info.context.user.is_staff:
+            return None
+        return [AnalyticsCacheStat(**stat) for stat in cache_stats()]
+
     def resolve_lead_age_groups(self, info):
         return _resolve_groups(info, LEAD_AGE_GROUPS)
 
@@ -258,11 +437,14 @@ class Query(graphene.ObjectType):
     def resolve_consumer_origin_groups(self, info):
         return _resolve_groups(info, CONSUMER_ORIGIN_GROUPS)
 
-    def resolve_url_label_list(self, info, label_type, label_name, search):
+    def resolve_url_label_list(self, info, label_type, label_name, search=None, limit=URL_LABEL_LIST_LIMIT):
         if not info.context.user.is_authenticated:
             return None
         user = info.context.user
-        return load_url_label_list(user, label_type, label_name, search)
+        if limit is None:
+            limit = URL_LABEL_LIST_LIMIT
+        return load_url_label_list(user, label_type, label_name, search,
+                                   max(1, min(limit, URL_LABEL_LIST_MAX_LIMIT)))
 
     def resolve_traffic_channels(self, info):
         if not info.context.user.is_authenticated:
@@ -289,30 +471,38 @@ class Query(graphene.ObjectType):
 
     def resolve_total_devices(self, info, date_from, date_to, projects=None,
                                 label_type=None, label_values=None,
-                                os_groups=None, browser_groups=None, traffic_channels=None):
+                                os_groups=None, browser_groups=None, traffic_channels=None,
+                                approximate=False):
         if not info.context.user.is_authenticated:
             return None
         user = info.context.user
         return total_devices(user, date_from, date_to, projects, label_type,
-                                 label_values, os_groups, browser_groups, traffic_channels)
+                                 label_values, os_groups, browser_groups, traffic_channels,
+                                 approximate=approximate)
 
     def resolve_leads(self, info, date_from, date_to, projects=None,
                       label_type=None, label_values=None,
                       os_groups=None, browser_groups=None, traffic_channels=None,
-                      limit=10, offset=0):
+                      limit=10, offset=0, after=None):
         if not info.context.user.is_authenticated:
             return None
         user = info.context.user
-        leads_qs = get_leads(user, date_from, date_to, projects,
-                        label_type, label_values, os_groups, browser_groups, traffic_channels)
-        total = leads_qs.count()
-        leads = leads_qs[offset:offset+limit]
-        for lead in leads:
-            if lead.geo:
-                lead.country = lead.geo.country.name
+        with replica_reads():
+            leads_qs = get_leads(user, date_from, date_to, projects,
+                            label_type, label_values, os_groups, browser_groups, traffic_channels,
+                            after=after)
+            # same leads as get_leads, cached and served from rollups
+            total = total_conversions(user, date_from, date_to, projects,
+                                      label_type, label_values, os_groups, browser_groups,
+                                      traffic_channels)
+            # one more lead tells if there is next page
+            leads = list(leads_qs[offset:offset+limit+1])
+            has_next = len(leads) > limit
+            leads = fill_lead_labels(leads[:limit])
         return LeadsPaginated(
             total=total,
-            data=leads
+            data=leads,
+            next_cursor=leads_cursor(leads[-1]) if has_next and leads else None
         )
 
     def resolve_lead_age_totals(self, info, date_from, date_to, groups=None, projects=None,
@@ -322,7 +512,8 @@ class Query(graphene.ObjectType):
             return None
         user = info.context.user
         totals = lead_age_totals(user, date_from, date_to, groups, projects, label_type,
-                                 label_values, os_groups, browser_groups, traffic_channels)
+                                 label_values, os_groups, browser_groups, traffic_channels,
+                                 now=lead_age_now())
         groups = []
         for total in totals:
             try:
@@ -355,6 +546,21 @@ class Query(graphene.ObjectType):
             ))
         return res
 
+    def resolve_leads_series_by_period(self, info, date_from, date_to, projects=None,
+                                       label_type=None, label_values=None,
+                                       os_groups=None, browser_groups=None, traffic_channels=None):
+        if not info.context.user.is_authenticated:
+            return None
+        user = info.context.user
+        periods = leads_by_period(user, date_from, date_to, projects,
+                                  label_type, label_values, os_groups,
+                                  browser_groups, traffic_channels)
+        axis = period_axis(date_from, date_to)
+        counts = period_series(axis, periods)[None]
+        return _series_set(date_from, date_to, axis, [
+            PeriodSeries(group_name='leads', group_title=_('Leads'), counts=counts)
+        ])
+
     def resolve_lead_duration_by_period(self, info, date_from, date_to, groups=None, projects=None,
                                         label_type=None, label_values=None,
                                         os_groups=None, browser_groups=None, traffic_channels=None):
@@ -376,6 +582,33 @@ class Query(graphene.ObjectType):
             ))
         return res
 
+    def resolve_lead_duration_series_by_period(self, info, date_from, date_to, groups=None,
+                                               projects=None, label_type=None, label_values=None,
+                                               os_groups=None, browser_groups=None,
+                                               traffic_channels=None):
+        if not info.context.user.is_authenticated:
+            return None
+        user = info.context.user
+        data = lead_duration_by_period(user, date_from, date_to, groups, projects,
+                                       label_type, label_values, os_groups,
+                                       browser_groups, traffic_channels)
+        axis = period_axis(date_from, date_to)
+        series = period_series(axis, data, group_field='group_name')
+        # requested groups without leads are zero series
+        for group_name in groups or ():
+            series.setdefault(group_name, [0] * len(axis))
+        group_names = [name for name in LEAD_DURATION_GROUPS if name in series]
+        group_names += sorted(name for name in series if name not in LEAD_DURATION_GROUPS)
+        res = []
+        for group_name in group_names:
+            try:
+                group_title = LEAD_DURATION_GROUPS[group_name].title
+            except KeyError:
+                group_title = _('Others')
+            res.append(PeriodSeries(group_name=group_name, group_title=group_title,
+                                    counts=series[group_name]))
+        return _series_set(date_from, date_to, axis, res)
+
     def resolve_lead_duration_totals(self, info, date_from, date_to, groups=None, projects=None,
                                      label_type=None, label_values=None,
                                      os_groups=None, browser_groups=None, traffic_channels=None):
@@ -461,6 +694,38 @@ class Query(graphene.ObjectType):
         ]
         return res
 
+    def resolve_lead_lineage_series_by_period(self, info, date_from, date_to, projects=None,
+                                              label_type=None, label_values=None,
+                                              os_groups=None, browser_groups=None,
+                                              traffic_channels=None, lead_owner='all'):
+        if not info.context.user.is_authenticated:
+            return None
+        user = info.context.user
+
+        axis = period_axis(date_from, date_to)
+        data = []
+        if lead_owner in ('you', 'all'):
+            data.append(('your', your_lead_lineage_by_period(user, date_from, date_to, projects,
+                                                             label_type, label_values,
+                                                             os_groups, browser_groups,
+                                                             traffic_channels)))
+        if lead_owner in ('other', 'all'):
+            data.append(('other', other_lead_lineage_by_period(user, date_from, date_to,
+                                                               label_type, label_values,
+                                                               os_groups, browser_groups,
+                                                               traffic_channels)))
+        res = []
+        for lead_type, rows in data:
+            counts = period_series(
+                axis, rows, lambda l: round(l['sales_count'] / l['leads_count'], 2), default=None
+            )[None]
+            res.append(PeriodSeries(
+                group_name='{}_leads'.format(lead_type),
+                group_title=_('{} leads'.format(lead_type.capitalize())),
+                counts=counts
+            ))
+        return _series_set(date_from, date_to, axis, res)
+
     def resolve_lead_browser_totals(self, info, date_from, date_to, projects=None,
                                      label_type=None, label_values=None,
                                      os_groups=None, browser_groups=None, traffic_channels=None):
@@ -0,0 +1,324 @@
+"""
+In-memory columnar engine of user leads for interactive dashboard slicing
+
+Converted leads of a user are loaded into NumPy column arrays, one value per
+lead, and analytics functions answer from boolean masks and bincounts instead
+of SQL aggregates over Lead. Columns are kept per process, least recently
+used users are dropped when all columns exceed ANALYTICS_COLUMNAR_MEMORY_BUDGET.
+When fill_leads moves the analytics watermark of the user (invalidate_users),
+leads updated since the last load are upserted by id.
+
+The engine is optional: it needs numpy and ANALYTICS_COLUMNAR, users whose
+columns alone do not fit the budget are answered by SQL.
+"""
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import mmh3
+from django.conf import settings
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from collector.analytics_cache import _cache, get_watermarks
+from collector.models import Lead, LEAD_DURATION_GROUPS
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+ONE_SECOND = 10 ** 6
+
+# Lead updated is set before commit, leads committed later with earlier
+# updated are caught by reloading this period again
+REFRESH_OVERLAP = timedelta(minutes=10)
+
+NULL_ID = -1
+
+# column: numpy dtype
+COLUMNS = OrderedDict((
+    ('id', 'S16'),
+    # microseconds since epoch
+    ('created', 'int64'),
+    ('session_started', 'int64'),
+    ('os_group', 'int32'),
+    ('browser_group', 'int32'),
+    ('device_category', 'int8'),
+    ('traffic_channel', 'int32'),
+    # index in LeadColumns.projects
+    ('project', 'int32'),
+    # 64 bit hash of device_id, 0 is null
+    ('device', 'uint64'),
+))
+
+# bytes of columns and id sort index per lead
+ROW_BYTES = 16 + 8 + 8 + 4 + 4 + 1 + 4 + 4 + 8 + 8
+
+_LEAD_VALUES = ('id', 'created', 'session_started', 'os_group_id', 'browser_group_id',
+                'device_category', 'traffic_channel_id', 'project_id', 'device_id')
+
+_stores = OrderedDict()
+# users too big for budget: watermark of the check
+_too_big = {}
+_lock = threading.RLock()
+
+
+def _reset_key(user_id):
+    return 'analytics:columnar:reset:{}'.format(user_id)
+
+
+def to_microseconds(value: datetime):
+    """
+    >>> to_microseconds(datetime(1970, 1, 1, 0, 0, 1, 5, tzinfo=timezone.utc))
+    1000005
+    """
+    return (value - EPOCH) // ONE_MICROSECOND
+
+
+def device_hash(device_id):
+    """
+    >>> device_hash(None)
+    0
+    >>> device_hash('device') == device_hash('device') != device_hash('other')
+    True
+    """
+    if device_id is None:
+        return 0
+    return mmh3.hash64(device_id, signed=False)[0] or 1
+
+
+class LeadColumns(object):
+    """
+    columns of converted leads of one user
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.columns = {name: numpy.empty(0, dtype) for name, dtype in COLUMNS.items()}
+        # sort index of id column for upserts
+        self.id_order = numpy.empty(0, 'int64')
+        self.projects = []
+        self.project_codes = {}
+        self.watermark = None
+        self.reset = None
+        # leads updated after it are reloaded on refresh
+        self.loaded = None
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values()) + self.id_order.nbytes
+
+    def _project_code(self, project_id):
+        if project_id is None:
+            return NULL_ID
+        if project_id not in self.project_codes:
+            self.project_codes[project_id] = len(self.projects)
+            self.projects.append(project_id)
+        return self.project_codes[project_id]
+
+    def _to_columns(self, rows):
+        values = {name: [] for name in COLUMNS}
+        for lead_id, created, session_started, os_group, browser_group, device_category, \
+                traffic_channel, project, device_id in rows:
+            values['id'].append(lead_id.bytes)
+            values['created'].append(to_microseconds(created))
+            values['session_started'].append(to_microseconds(session_started))
+            values['os_group'].append(NULL_ID if os_group is None else os_group)
+            values['browser_group'].append(NULL_ID if browser_group is None else browser_group)
+            values['device_category'].append(NULL_ID if device_category is None else device_category)
+            values['traffic_channel'].append(NULL_ID if traffic_channel is None else traffic_channel)
+            values['project'].append(self._project_code(project))
+            values['device'].append(device_hash(device_id))
+        return {name: numpy.array(values[name], dtype) for name, dtype in COLUMNS.items()}
+
+    def upsert(self, rows):
+        """
+        :param rows: Lead values_list of _LEAD_VALUES, changed leads replace loaded ones
+        :return: count of rows
+        """
+        new = self._to_columns(rows)
+        new_ids = new['id']
+        if not len(new_ids):
+            return 0
+        ids = self.columns['id']
+        if len(ids):
+            positions = numpy.searchsorted(ids, new_ids, sorter=self.id_order)
+            positions = self.id_order[numpy.minimum(positions, len(ids) - 1)]
+            found = ids[positions] == new_ids
+            for name, column in self.columns.items():
+                column[positions[found]] = new[name][found]
+            new = {name: column[~found] for name, column in new.items()}
+        if len(new['id']):
+            for name in COLUMNS:
+                self.columns[name] = numpy.concatenate((self.columns[name], new[name]))
+            self.id_order = numpy.argsort(self.columns['id'], kind='mergesort')
+        return len(new_ids)
+
+    def load(self, since=None):
+        """
+        :param since: load leads updated after it, all by default
+        """
+        leads_qs = Lead.objects.filter(user=self.user_id, created__isnull=False)
+        if since is not None:
+            leads_qs = leads_qs.filter(updated__gt=since)
+        started = timezone.now()
+        self.upsert(leads_qs.values_list(*_LEAD_VALUES).order_by().iterator(chunk_size=10000))
+        self.loaded = started - REFRESH_OVERLAP
+
+    def mask(self, date_from: datetime, date_to: datetime, projects: list = None,
+             os_groups: list = None, browser_groups: list = None, traffic_channels: list = None):
+        """
+        :return: boolean array of leads matching analytics common filters
+        """
+        created = self.columns['created']
+        mask = (created >= to_microseconds(date_from)) & (created <= to_microseconds(date_to))
+        if projects:
+            codes = [self.project_codes[project_id] for project_id in
+                     (uuid.UUID(str(project)) for project in projects) if project_id in self.project_codes]
+            mask &= numpy.isin(self.columns['project'], codes)
+        for name, ids in (('os_group', os_groups), ('browser_group', browser_groups),
+                          ('traffic_channel', traffic_channels)):
+            if ids:
+                mask &= self.in_groups(name, ids)
+        return mask
+
+    def in_groups(self, column, ids):
+        """
+        :param column: column name of group id
+        :param ids: iterable of group ids
+        :return: boolean array of leads of groups
+        """
+        return numpy.isin(self.columns[column], [int(group_id) for group_id in ids])
+
+    @staticmethod
+    def count(mask):
+        return int(numpy.count_nonzero(mask))
+
+    def distinct_devices(self, mask):
+        devices = self.columns['device'][mask]
+        return int(numpy.unique(devices[devices != 0]).size)
+
+    def group_totals(self, column, mask, names):
+        """
+        :param column: column name of group id
+        :param names: {group id: group name}, other ids are 'Unknown'
+        :return: list of {group_name, leads_count} ordered by group_name
+        """
+        group_ids, counts = numpy.unique(self.columns[column][mask], return_counts=True)
+        totals = {}
+        unknown = _('Unknown')
+        for group_id, count in zip(group_ids.tolist(), counts.tolist()):
+            group_name = names.get(group_id, unknown)
+            totals[group_name] = totals.get(group_name, 0) + count
+        return [{'group_name': name, 'leads_count': totals[name]} for name in sorted(totals)]
+
+    def duration_totals(self, mask, groups=None):
+        """
+        same groups as _lead_duration_groups_case, first matching group wins
+        :param groups: LEAD_DURATION_GROUPS keys, all by default
+        :return: list of {group_name, leads_count} ordered by group_name
+        """
+        durations = (self.columns['created'] - self.columns['session_started'])[mask]
+        # 0 is 'Others'
+        group_names = ['Others']
+        codes = numpy.zeros(len(durations), 'int8')
+        for group_id in groups or LEAD_DURATION_GROUPS.keys():
+            group = LEAD_DURATION_GROUPS[group_id]
+            val1 = group.val1 * ONE_SECOND
+            if group.operator == 'range':
+                matches = (durations >= val1) & (durations <= group.val2 * ONE_SECOND)
+            else:
+                matches = getattr(numpy, {'lt': 'less', 'lte': 'less_equal', 'gt': 'greater',
+                                          'gte': 'greater_equal'}[group.operator])(durations, val1)
+            codes[matches & (codes == 0)] = len(group_names)
+            group_names.append(group_id)
+        counts = numpy.bincount(codes, minlength=len(group_names)).tolist()
+        return [
+            {'group_name': name, 'leads_count': count}
+            for name, count in sorted(zip(group_names, counts)) if count
+        ]
+
+    def period_counts(self, mask, scale_period):
+        """
+        leads per utc period as Trunc* of _leads_period_unit_expr
+        :param scale_period: 'hour', 'day', 'week', 'month', 'year'
+        :return: list of {created_period, leads_count} ordered by created_period
+        """
+        created = self.columns['created'][mask].astype('datetime64[us]')
+        if scale_period == 'week':
+            days = created.astype('datetime64[D]').astype('int64')
+            # 1970-01-01 is thursday, weeks start on monday
+            periods = ((days + 3) // 7 * 7 - 3).astype('datetime64[D]')
+        else:
+            unit = {'hour': 'h', 'day': 'D', 'month': 'M', 'year': 'Y'}[scale_period]
+            periods = created.astype('datetime64[{}]'.format(unit))
+        periods, counts = numpy.unique(periods.astype('datetime64[us]'), return_counts=True)
+        return [
+            {'created_period': EPOCH + int(period) * ONE_MICROSECOND, 'leads_count': count}
+            for period, count in zip(periods.astype('int64').tolist(), counts.tolist())
+        ]
+
+
+def _evict(budget):
+    used = sum(store.nbytes for store in _stores.values())
+    while _stores and used > budget:
+        _, store = _stores.popitem(last=False)
+        used -= store.nbytes
+
+
+def get_lead_columns(user_id):
+    """
+    columns of user leads, loaded or refreshed when fill_leads moved watermark of user
+    :return: LeadColumns or None when engine is off or user leads do not fit the budget
+    """
+    if numpy is None or not settings.ANALYTICS_COLUMNAR:
+        return None
+    budget = settings.ANALYTICS_COLUMNAR_MEMORY_BUDGET
+    cache = _cache()
+    # without shared cache leads are refreshed on every call
+    watermark = get_watermarks(cache, [user_id])[0] if cache is not None else None
+    reset = cache.get(_reset_key(user_id)) if cache is not None else None
+    with _lock:
+        if user_id in _too_big:
+            if watermark is not None and _too_big[user_id] == watermark:
+                return None
+            del _too_big[user_id]
+        store = _stores.pop(user_id, None)
+        if store is not None and store.reset != reset:
+            store = None
+        if store is None:
+            count = Lead.objects.filter(user=user_id, created__isnull=False).count()
+            if count * ROW_BYTES > budget:
+                _too_big[user_id] = watermark
+                return None
+            store = LeadColumns(user_id)
+            store.load()
+        elif watermark is None or store.watermark != watermark:
+            store.load(store.loaded)
+        store.watermark = watermark
+        store.reset = reset
+        if store.nbytes > budget:
+            _too_big[user_id] = watermark
+            return None
+        _stores[user_id] = store
+        _evict(budget)
+        return store
+
+
+def reset_lead_columns(user_ids):
+    """
+    reload columns of users fully, call it when leads are moved to other users
+    :param user_ids: iterable of user ids
+    """
+    cache = _cache()
+    with _lock:
+        for user_id in user_ids:
+            _stores.pop(user_id, None)
+            if cache is not None:
+                cache.set(_reset_key(user_id), uuid.uuid4().hex, None)
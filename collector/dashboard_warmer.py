@@ -0,0 +1,237 @@
+"""
+Precomputed dashboards of saved page filters
+
+Users land on their pages with the filters saved by SavePageFilters
+(profiles.PageFilters) again and again. After fill_leads the warmer computes
+dashboard widgets of the saved filters of active users and keeps them as JSON
+on PageFilters, so the first paint reads a ready result (pageDashboard query)
+instead of running the aggregates. Widgets are computed through the analytics
+cache, so following requests with the same filters hit it too.
+
+A page is active if it was viewed in settings.DASHBOARD_WARM_ACTIVE_DAYS days,
+a result is stale if leads of the user changed after it was warmed, leads of
+other users changed (other_lead_lineage_by_period) or its default range moved
+to the next hour.
+"""
+import json
+import uuid
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+from inspect import signature
+from logging import getLogger
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+
+from collector.analytics import AnalyticsError, lead_age_now
+from collector.analytics_cache import CACHED_FUNCTIONS, GLOBAL_SCOPE, _cache, _watermark_key
+from collector.analytics_guard import AnalyticsQueryRejected
+from collector.models import Lead
+from profiles.models import PageFilters
+from utils.db_router import primary_reads
+
+logger = getLogger(__name__)
+
+# widget: (analytics function, arguments besides filters)
+DASHBOARD_WIDGETS = OrderedDict((
+    ('dashboard_summary', ('dashboard_summary', {})),
+    ('leads_by_period', ('leads_by_period', {})),
+    ('lead_age_totals', ('lead_age_totals', {})),
+    ('lead_duration_totals', ('lead_duration_totals', {})),
+    ('lead_duration_by_period', ('lead_duration_by_period', {})),
+    ('consumer_origin_by_period', ('consumer_origin_by_period', {})),
+    ('your_lead_lineage_by_period', ('your_lead_lineage_by_period', {})),
+    ('other_lead_lineage_by_period', ('other_lead_lineage_by_period', {})),
+    ('lead_device_type_totals', ('lead_device_type_totals', {})),
+    ('mobile_os_totals', ('lead_os_totals', {'is_mobile': True})),
+    ('desktop_os_totals', ('lead_os_totals', {'is_mobile': False})),
+))
+
+# saved filter name (GraphQL variable) -> (analytics argument, value parser)
+FILTER_ARGUMENTS = OrderedDict((
+    ('dateFrom', ('date_from', None)),
+    ('dateTo', ('date_to', None)),
+    ('projects', ('projects', uuid.UUID)),
+    ('labelType', ('label_type', str)),
+    ('labelValues', ('label_values', None)),
+    ('osGroups', ('os_groups', int)),
+    ('browserGroups', ('browser_groups', int)),
+    ('trafficChannels', ('traffic_channels', int)),
+))
+
+
+def _parse_datetime(value, end=False):
+    """
+    >>> _parse_datetime('2018-03-01', end=True).isoformat()
+    '2018-03-01T23:59:59+00:00'
+    >>> _parse_datetime('2018-03-01T10:00:00+03:00').isoformat()
+    '2018-03-01T10:00:00+03:00'
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError('Bad date {}'.format(value))
+        parsed = datetime.combine(day, time(23, 59, 59) if end else time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _list(value, parse):
+    if isinstance(value, str):
+        value = [item for item in value.split(',') if item]
+    return [parse(item) for item in value]
+
+
+def page_filter_arguments(filters):
+    """
+    analytics arguments of saved page filters, JSON object or query string
+    of the page's GraphQL variables, range is the last
+    settings.DASHBOARD_WARM_DAYS days if not saved
+    :raise ValueError: filters are not parsed
+    :return: {argument: value}
+    >>> arguments = page_filter_arguments('dateFrom=2018-03-01&dateTo=2018-03-31&osGroups=1,2')
+    >>> arguments['date_to'].isoformat(), arguments['os_groups']
+    ('2018-03-31T23:59:59+00:00', [1, 2])
+    >>> page_filter_arguments('{"labelType": "utm", "labelValues": {"utm_source": "google"}}')['label_values']
+    {'utm_source': 'google'}
+    """
+    filters = filters.strip()
+    if filters.startswith('{'):
+        values = json.loads(filters)
+    else:
+        values = {name: value if len(value) > 1 else value[0]
+                  for name, value in parse_qs(filters.lstrip('?')).items()}
+
+    arguments = {}
+    for name, (argument, parse) in FILTER_ARGUMENTS.items():
+        value = values.get(name, values.get(argument))
+        if value in (None, '', []):
+            continue
+        if argument in ('date_from', 'date_to'):
+            value = _parse_datetime(value, end=argument == 'date_to')
+        elif argument == 'label_values':
+            value = json.loads(value) if isinstance(value, str) else value
+        elif argument == 'label_type':
+            value = parse(value)
+        else:
+            value = _list(value, parse)
+        arguments[argument] = value
+    if 'date_to' not in arguments:
+        # whole hours, as rollups answer
+        arguments['date_to'] = timezone.now().replace(minute=0, second=0, microsecond=0) \
+            - timedelta(seconds=1)
+    if 'date_from' not in arguments:
+        arguments['date_from'] = arguments['date_to'] + timedelta(seconds=1) \
+            - timedelta(days=settings.DASHBOARD_WARM_DAYS)
+    return arguments
+
+
+def compute_dashboard(user, arguments):
+    """
+    :param arguments: page_filter_arguments
+    :return: {widget: result}
+    """
+    widgets = OrderedDict()
+    for widget, (func_name, extra) in DASHBOARD_WIDGETS.items():
+        func = CACHED_FUNCTIONS[func_name]
+        kwargs = dict(extra)
+        parameters = signature(func).parameters
+        kwargs.update((name, value) for name, value in arguments.items() if name in parameters)
+        if func_name == 'lead_age_totals':
+            # the same cache key as resolve_lead_age_totals
+            kwargs['now'] = lead_age_now()
+        widgets[widget] = func(user, **kwargs)
+    return widgets
+
+
+def _global_changed(since):
+    """
+    :return: True if leads of any user changed after since, by global watermark of analytics cache
+    """
+    cache = _cache()
+    if cache is None:
+        return Lead.objects.filter(updated__gt=since).exists()
+    # missing one was not moved since cache start
+    watermark = cache.get(_watermark_key(GLOBAL_SCOPE))
+    return watermark is not None and watermark > since.timestamp()
+
+
+def is_stale(page_filters):
+    """
+    :param page_filters: profiles.PageFilters
+    :return: True if result is missing, its range moved (filters without saved dates)
+        or leads changed after warm
+    """
+    if page_filters.result is None or page_filters.warmed is None:
+        return True
+    try:
+        arguments = page_filter_arguments(page_filters.filters)
+        warmed_to = json.loads(page_filters.result)['arguments']['date_to']
+    except (ValueError, KeyError):
+        return True
+    if DjangoJSONEncoder().default(arguments['date_to']) != warmed_to:
+        return True
+    if Lead.objects.filter(user=page_filters.user_id, updated__gt=page_filters.warmed).exists():
+        return True
+    return 'other_lead_lineage_by_period' in DASHBOARD_WIDGETS and _global_changed(page_filters.warmed)
+
+
+def warm_page(page_filters):
+    """
+    compute and save dashboard of page filters
+    :raise ValueError: saved filters are not parsed
+    :raise AnalyticsError, AnalyticsQueryRejected: filters are rejected by analytics
+    :return: True if saved, False if filters were changed meanwhile
+    """
+    # leads changed during computation make result stale
+    warmed = timezone.now()
+    arguments = page_filter_arguments(page_filters.filters)
+    # replicas may not have leads filled just before
+    with primary_reads():
+        widgets = compute_dashboard(page_filters.user, arguments)
+    result = json.dumps({'arguments': arguments, 'widgets': widgets}, cls=DjangoJSONEncoder)
+    return bool(PageFilters.objects
+                .filter(pk=page_filters.pk, filters=page_filters.filters)
+                .update(result=result, warmed=warmed))
+
+
+def active_page_filters(user_ids=None, now=None):
+    """
+    :param user_ids: only pages of these users
+    :return: QuerySet of PageFilters viewed lately by active users
+    """
+    now = now or timezone.now()
+    qs = PageFilters.objects.filter(
+        user__is_active=True,
+        viewed__gte=now - timedelta(days=settings.DASHBOARD_WARM_ACTIVE_DAYS),
+    )
+    if settings.DASHBOARD_WARM_PAGES:
+        qs = qs.filter(page__in=settings.DASHBOARD_WARM_PAGES)
+    if user_ids is not None:
+        qs = qs.filter(user__in=user_ids)
+    return qs.select_related('user').order_by('user_id', 'page')
+
+
+def warm_dashboards(user_ids=None, stale_only=True):
+    """
+    warm dashboards of active page filters, bad or rejected filters are logged and skipped
+    :param user_ids: only pages of these users
+    :param stale_only: skip pages with fresh results
+    :return: (warmed, failed) pages
+    """
+    warmed = failed = 0
+    for page_filters in active_page_filters(user_ids):
+        if stale_only and not is_stale(page_filters):
+            continue
+        try:
+            warmed += warm_page(page_filters)
+        except (ValueError, AnalyticsError, AnalyticsQueryRejected) as e:
+            logger.warning('Dashboard of user {} page {} is not warmed: {}'.format(
+                page_filters.user_id, page_filters.page, e))
+            failed += 1
+    return warmed, failed
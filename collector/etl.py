@@ -0,0 +1,142 @@
+import cProfile
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import connection
+from django.utils import timezone
+
+from collector.models.etl import EtlRun
+
+
+class QueryCounter(object):
+    """
+    connection.execute_wrapper callable counting executed queries
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class EtlStats(object):
+    """
+    Per stage wall time, rows and queries of one ETL command run
+    >>> stats = EtlStats('fill_leads')
+    >>> stats.add_rows('leads', 2)
+    >>> stats.merge({'leads': {'time': 1.5, 'rows': 3, 'queries': 4}})
+    >>> stats.stages['leads']
+    {'time': 1.5, 'rows': 5, 'queries': 4}
+    """
+    def __init__(self, command):
+        self.command = command
+        self.started = timezone.now()
+        self.finished = None
+        self.rows = 0
+        self.failed = 0
+        self.stages = OrderedDict()
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'time': 0.0, 'rows': 0, 'queries': 0}
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        """
+        measure wall time and queries of code block, repeated stages are summed
+        :param name: stage name
+        :param rows: rows processed by block
+        """
+        stage = self._stage(name)
+        counter = QueryCounter()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(counter):
+                yield stage
+        finally:
+            stage['time'] += time.perf_counter() - started
+            stage['queries'] += counter.count
+            stage['rows'] += rows
+
+    def add_rows(self, name, rows):
+        self._stage(name)['rows'] += rows
+
+    def merge(self, stages):
+        """
+        add stages of other run (e.g. worker process)
+        :param stages: {name: {time, rows, queries}}
+        """
+        for name, other in stages.items():
+            stage = self._stage(name)
+            for key in ('time', 'rows', 'queries'):
+                stage[key] += other[key]
+
+    def finish(self, rows, failed=0):
+        self.finished = timezone.now()
+        self.rows = rows
+        self.failed = failed
+
+    @property
+    def duration(self):
+        return ((self.finished or timezone.now()) - self.started).total_seconds()
+
+    def as_dict(self):
+        return {
+            'command': self.command,
+            'started': self.started.isoformat(),
+            'finished': self.finished.isoformat() if self.finished else None,
+            'duration': self.duration,
+            'rows': self.rows,
+            'failed': self.failed,
+            'stages': self.stages,
+        }
+
+    def save(self):
+        """
+        :rtype: EtlRun
+        """
+        return EtlRun.objects.create(
+            command=self.command,
+            started=self.started,
+            finished=self.finished or timezone.now(),
+            duration=self.duration,
+            rows=self.rows,
+            failed=self.failed,
+            stages=self.stages
+        )
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def log_line(self):
+        """
+        :return: one line summary for logger
+        """
+        stages = ', '.join(
+            '{}: {:.3f}s {} rows {} queries'.format(name, s['time'], s['rows'], s['queries'])
+            for name, s in self.stages.items()
+        )
+        return '{} {} rows in {:.3f}s ({})'.format(self.command, self.rows, self.duration, stages)
+
+
+@contextmanager
+def profiled(path=None):
+    """
+    run code block under cProfile and save pstats file if path set
+    :param path: pstats file path or None to disable profiling
+    """
+    if not path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
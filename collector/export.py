@@ -0,0 +1,146 @@
+"""
+Streaming export of leads list
+
+Leads of get_leads are read with a server-side cursor in chunks, labels are
+filled per chunk (fill_lead_labels) and rows are encoded per chunk, so export
+memory does not depend on count of leads.
+"""
+import csv
+import io
+import json
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_datetime
+from django.utils.text import compress_sequence
+
+from collector.analytics import fill_lead_labels
+
+EXPORT_FIELDS = ('id', 'created', 'session_started', 'pixel', 'project',
+                 'os_group', 'device', 'city', 'country')
+
+EXPORT_CHUNK_SIZE = 2000
+
+# format: (content type, file extension)
+EXPORT_FORMATS = OrderedDict((
+    ('csv', ('text/csv', 'csv')),
+    ('ndjson', ('application/x-ndjson', 'ndjson')),
+))
+
+# Lead columns of export rows and labels
+_LEAD_COLUMNS = ('id', 'created', 'session_started', 'pixel_id', 'project_id',
+                 'os_group_id', 'device_model_id', 'device_category', 'geo_id')
+
+
+def _int_list(values):
+    return [int(value) for value in values]
+
+
+def parse_leads_filters(params):
+    """
+    get_leads filters from query string, lists are repeated params
+    :param params: QueryDict
+    :return: dict of get_leads keyword arguments
+    >>> from django.http import QueryDict
+    >>> filters = parse_leads_filters(QueryDict(
+    ...     'date_from=2018-03-01T00:00:00Z&date_to=2018-03-31T23:59:59Z'
+    ...     '&os_groups=1&os_groups=2&label_type=utm&label_values={"utm_source":"google"}'))
+    >>> filters['date_from'], filters['os_groups'], filters['label_values']
+    (datetime.datetime(2018, 3, 1, 0, 0, tzinfo=<UTC>), [1, 2], {'utm_source': 'google'})
+    >>> parse_leads_filters(QueryDict('date_from=2018-03-01'))
+    Traceback (most recent call last):
+    ...
+    ValueError: date_from and date_to are required datetimes
+    """
+    try:
+        date_from = parse_datetime(params.get('date_from', ''))
+        date_to = parse_datetime(params.get('date_to', ''))
+    except ValueError:
+        date_from = date_to = None
+    if date_from is None or date_to is None:
+        raise ValueError('date_from and date_to are required datetimes')
+    filters = {'date_from': date_from, 'date_to': date_to}
+    try:
+        if 'projects' in params:
+            filters['projects'] = [uuid.UUID(value) for value in params.getlist('projects')]
+        for name in ('os_groups', 'browser_groups', 'traffic_channels'):
+            if name in params:
+                filters[name] = _int_list(params.getlist(name))
+        if 'label_type' in params:
+            filters['label_type'] = params['label_type']
+            filters['label_values'] = json.loads(params.get('label_values') or '{}')
+    except ValueError as e:
+        raise ValueError('Bad filter: {}'.format(e))
+    return filters
+
+
+def _lead_rows(leads):
+    for lead in fill_lead_labels(leads):
+        yield OrderedDict((
+            ('id', lead.id),
+            ('created', lead.created),
+            ('session_started', lead.session_started),
+            ('pixel', lead.pixel_id),
+            ('project', lead.project_id),
+            ('os_group', lead.os_group_name),
+            ('device', lead.device),
+            ('city', lead.city),
+            ('country', lead.country),
+        ))
+
+
+def iter_lead_row_chunks(leads_qs, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    :param leads_qs: get_leads QuerySet
+    :return: iterator of lists of export rows (OrderedDict of EXPORT_FIELDS)
+    """
+    chunk = []
+    # iterator() reads with server-side cursor
+    for lead in leads_qs.only(*_LEAD_COLUMNS).iterator(chunk_size=chunk_size):
+        chunk.append(lead)
+        if len(chunk) == chunk_size:
+            yield list(_lead_rows(chunk))
+            chunk = []
+    if chunk:
+        yield list(_lead_rows(chunk))
+
+
+def _csv_chunks(row_chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for rows in row_chunks:
+        writer.writerows(
+            [value.isoformat() if isinstance(value, datetime) else value for value in row.values()]
+            for row in rows
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # header of empty export
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson_chunks(row_chunks):
+    for rows in row_chunks:
+        yield ''.join(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows).encode()
+
+
+def stream_leads(leads_qs, export_format='csv', gzip=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    :param leads_qs: get_leads QuerySet
+    :param export_format: EXPORT_FORMATS key
+    :param gzip: compress stream
+    :return: iterator of bytes
+    """
+    row_chunks = iter_lead_row_chunks(leads_qs, chunk_size)
+    if export_format == 'ndjson':
+        chunks = _ndjson_chunks(row_chunks)
+    else:
+        chunks = _csv_chunks(row_chunks)
+    if gzip:
+        chunks = compress_sequence(chunks)
+    return chunks
@@ -0,0 +1,196 @@
+import json
+import statistics
+import subprocess
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from inspect import signature, Parameter
+
+from django.core.management.base import BaseCommand
+from django.db.models import QuerySet
+from django.db.transaction import atomic, set_rollback
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from audit.error import AuditError
+from audit.lead_authenticity import check_lead_authenticity
+from audit.lead_duplication import check_lead_duplication
+from collector import analytics, synthetic
+from collector.analytics_cache import CACHED_FUNCTIONS
+from collector.analytics_guard import AnalyticsQueryRejected
+from collector.etl import EtlStats
+from collector.models import Lead, LeadField, Pixel
+
+# arguments of analytics functions besides user and range
+FUNCTION_ARGUMENTS = {
+    'is_mobile': True,
+    'label_type': 'utm',
+    'label_name': 'utm_source',
+}
+
+DEFAULT_SIZES = '100000,1000000,10000000'
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL)\
+            .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _evaluate(result):
+    if isinstance(result, QuerySet):
+        return list(result)
+    return result
+
+
+def _function_arguments(func, **values):
+    """
+    required arguments of analytics function
+    >>> sorted(_function_arguments(analytics.lead_os_totals, user=1, date_from=2, date_to=3))
+    ['date_from', 'date_to', 'is_mobile', 'user']
+    """
+    values = dict(FUNCTION_ARGUMENTS, **values)
+    return {name: values[name] for name, param in signature(func).parameters.items()
+            if param.default is Parameter.empty and name in values}
+
+
+def _person_fields(user):
+    """
+    form fields of newest converted lead of user, a typical person,
+    the most frequent ones have thousands of leads in big datasets
+    """
+    lead = Lead.objects.filter(user=user, created__isnull=False).order_by('-created').first()
+    if lead is None:
+        return None, None
+    return lead, dict(LeadField.objects.filter(lead=lead).values_list('field_name', 'field_data'))
+
+
+def _audit(check, *args):
+    # audits log their calls, benchmark leaves no audits
+    with atomic():
+        try:
+            return check(*args)
+        except AuditError:
+            return None
+        finally:
+            set_rollback(True)
+
+
+def compare_results(results, baseline):
+    """
+    :return: list of (size, function, baseline median ms, median ms, ratio)
+    """
+    rows = []
+    for size, result in results['sizes'].items():
+        base_functions = baseline['sizes'].get(size, {}).get('functions', {})
+        for name, timing in result['functions'].items():
+            base = base_functions.get(name)
+            if not base or base.get('median_ms') is None or timing.get('median_ms') is None:
+                continue
+            ratio = timing['median_ms'] / base['median_ms'] if base['median_ms'] else None
+            rows.append((size, name, base['median_ms'], timing['median_ms'], ratio))
+    return rows
+
+
+class Command(BaseCommand):
+    help = 'time analytics functions and audit checks on synthetic datasets of several sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', dest='sizes', type=str, default=DEFAULT_SIZES,
+                            help='comma separated lead counts of datasets')
+        parser.add_argument('--days', dest='days', type=int, default=90,
+                            help='range of leads and of analytics calls')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                            help='calls of every function, median is reported')
+        parser.add_argument('--output', dest='output', type=str, default=None,
+                            help='save timings to json file')
+        parser.add_argument('--compare', dest='compare', type=str, default=None,
+                            help='json file of previous run to compare medians with')
+
+    def handle(self, sizes=DEFAULT_SIZES, days=90, repeat=5, output=None, compare=None, *args, **options):
+        sizes = sorted(int(size) for size in sizes.split(','))
+        # whole hours range, as widgets of dashboard ask
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        date_from = hour - timedelta(days=days)
+        date_to = hour - timedelta(seconds=1)
+        results = OrderedDict([
+            ('commit', _git_revision()),
+            ('created', timezone.now().isoformat()),
+            ('days', days),
+            ('sizes', OrderedDict()),
+        ])
+        # results of uncached sql are measured, guardrails must not reject big datasets
+        with override_settings(ANALYTICS_CACHE=None, ANALYTICS_COLUMNAR=False,
+                               ANALYTICS_MAX_QUERY_COST=None, ANALYTICS_STATEMENT_TIMEOUT=60 * 60 * 1000):
+            for size in sizes:
+                dataset = self._dataset(size, date_from, date_to)
+                results['sizes'][str(size)] = OrderedDict([
+                    ('leads', dataset.lead_count()),
+                    ('functions', self._bench(dataset, date_from, date_to, repeat)),
+                ])
+
+        if output:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
+        if compare:
+            with open(compare) as f:
+                baseline = json.load(f)
+            self.stdout.write('compared with {}'.format(baseline.get('commit')))
+            for size, name, base_ms, median_ms, ratio in compare_results(results, baseline):
+                self.stdout.write('{:>10} {:<40} {:>10.1f} {:>10.1f} {}'.format(
+                    size, name, base_ms, median_ms, '{:.2f}x'.format(ratio) if ratio else '-'))
+
+    def _dataset(self, size, date_from, date_to):
+        """
+        synthetic dataset of size leads, generated by first run only
+        """
+        dataset = synthetic.SyntheticDataset('bench{}'.format(size))
+        count = dataset.lead_count()
+        if count < size:
+            stats = EtlStats('bench_analytics')
+            # leads of interrupted run are kept, new ones get other random ids
+            dataset.seed(count)
+            synthetic.generate_leads(dataset, size - count, date_from, date_to, stats=stats)
+            self.stdout.write('generated {} leads: {}'.format(size - count, json.dumps(stats.stages)))
+        return dataset
+
+    def _time(self, func, repeat):
+        runs_ms = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            try:
+                _evaluate(func())
+            except AnalyticsQueryRejected as e:
+                return {'rejected': e.reason}
+            runs_ms.append((time.perf_counter() - started) * 1000)
+        return OrderedDict([
+            ('runs_ms', [round(ms, 2) for ms in runs_ms]),
+            ('median_ms', round(statistics.median(runs_ms), 2)),
+            ('min_ms', round(min(runs_ms), 2)),
+        ])
+
+    def _bench(self, dataset, date_from, date_to, repeat):
+        # biggest user, volume of users follows Zipf law
+        user = dataset.users[0]
+        calls = OrderedDict()
+        for name in sorted(CACHED_FUNCTIONS):
+            func = CACHED_FUNCTIONS[name]
+            kwargs = _function_arguments(func, user=user, date_from=date_from, date_to=date_to)
+            calls[name] = lambda func=func, kwargs=kwargs: func(**kwargs)
+        calls['get_leads'] = lambda: analytics.get_leads(user, date_from, date_to)[:100]
+        calls['period_axis'] = lambda: analytics.period_axis(date_from, date_to)
+
+        lead, fields = _person_fields(user)
+        if lead is not None:
+            pixel = Pixel.objects.select_related('project__user').get(id=lead.pixel_id)
+            calls['check_lead_authenticity'] = lambda: _audit(check_lead_authenticity, pixel, fields)
+            calls['check_lead_duplication'] = lambda: _audit(check_lead_duplication, user, fields)
+
+        functions = OrderedDict()
+        for name, call in calls.items():
+            functions[name] = self._time(call, repeat)
+            self.stdout.write('{:>10} {:<40} {}'.format(
+                dataset.prefix, name, functions[name].get('median_ms', functions[name].get('rejected'))))
+        return functions
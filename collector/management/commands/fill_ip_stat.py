@@ -11,6 +11,7 @@ from django.core.management.base import BaseCommand
 from django.db.transaction import atomic
 from logging import getLogger
 
+from collector.etl import EtlStats, profiled
 from collector.models.analytics import IpStat, Lead
 from django.conf import settings
 from profiles.models import Profile
@@ -28,35 +29,55 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--date', type=str, dest='fill_date')
+        parser.add_argument('--stats-json', dest='stats_json', type=str, default=None,
+                            help='dump per stage timings to json file')
+        parser.add_argument('--profile', dest='profile', type=str, default=None,
+                            help='run under cProfile and save pstats to file')
+
+    def handle(self, fill_date=None, stats_json=None, profile=None, *args, **options):
+        stats = EtlStats('fill_ip_stat')
+        with profiled(profile):
+            res = self.fill(stats, fill_date)
+        stats.finish(len(res))
+        stats.save()
+        if stats_json:
+            stats.dump_json(stats_json)
+        logger.info(stats.log_line())
 
     @atomic()
-    def handle(self, fill_date=None, *args, **options):
+    def fill(self, stats, fill_date=None):
+        """
+        :param stats: per stage timings collector
+        :type stats: collector.etl.EtlStats
+        :param fill_date: 'YYYY-MM-DD', yesterday by default
+        :return: {ip: IpStat}
+        """
         now = timezone.now()
-        started = now
         if fill_date is None:
             fill_date = (now - timedelta(days=1)).date()
         else:
             fill_date = strptime(fill_date).date()
 
-        IpStat.objects.filter(date=fill_date).delete()
-
-        ip_stat_total = self._load_period_ipstat(fill_date, IP_STAT_MAX_PERIOD)
-        ip_stat_30days = self._load_period_ipstat(fill_date, timedelta(days=30))
-        ip_stat_10days = self._load_period_ipstat(fill_date, timedelta(days=10))
-        ip_stat_3days = self._load_period_ipstat(fill_date, timedelta(days=3))
+        with stats.stage('delete'):
+            IpStat.objects.filter(date=fill_date).delete()
 
+        periods = (('', IP_STAT_MAX_PERIOD), ('30', timedelta(days=30)),
+                   ('10', timedelta(days=10)), ('3', timedelta(days=3)))
         res = {}
-        res = self._collect_period_ipstat(res, fill_date, ip_stat_total, '')
-        res = self._collect_period_ipstat(res, fill_date, ip_stat_30days, '30')
-        res = self._collect_period_ipstat(res, fill_date, ip_stat_10days, '10')
-        res = self._collect_period_ipstat(res, fill_date, ip_stat_3days, '3')
-        if res:
-            IpStat.objects.bulk_create(res.values())
-
-        self._save_csv(res.values(), fill_date)
-
-        logger.info('Fill {} ip_stats in {}s'.format(
-            len(res), (timezone.now() - started).total_seconds()))
+        for suffix, period in periods:
+            with stats.stage('load') as stage:
+                period_ip_stat = list(self._load_period_ipstat(fill_date, period))
+                stage['rows'] += len(period_ip_stat)
+            with stats.stage('collect', rows=len(period_ip_stat)):
+                res = self._collect_period_ipstat(res, fill_date, period_ip_stat, suffix)
+
+        with stats.stage('write', rows=len(res)):
+            if res:
+                IpStat.objects.bulk_create(res.values())
+
+        with stats.stage('csv', rows=len(res)):
+            self._save_csv(res.values(), fill_date)
+        return res
 
     @staticmethod
     def _load_period_ipstat(fill_date: date, period: timedelta):
@@ -77,7 +98,7 @@ class Command(BaseCommand):
             .annotate(s_beg=Cast(Avg(
                 Cast(F('session_started'), output_field=TimeField())
             ), output_field=TimeField())) \
-            .annotate(user_ids=ArrayAgg('pixel__project__user__id', distinct=True))\
+            .annotate(user_ids=ArrayAgg('user_id', distinct=True))\
             .annotate(cnt_dev=Count('device_id'))
 
     def _collect_period_ipstat(self, res, fill_date, period_ip_stat, suffix=''):
@@ -0,0 +1,48 @@
+from datetime import timedelta
+from logging import getLogger
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from collector.etl import EtlStats
+from collector.models import Lead
+from collector.rollups import rebuild_lead_hour_stat, truncate_hour
+from utils.datetime import strptime
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'rebuild hourly lead rollups (LeadHourStat), fill_leads keeps them up to date after'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date-from', dest='date_from', type=str,
+                            help='first lead by default')
+        parser.add_argument('--date-to', dest='date_to', type=str,
+                            help='now by default')
+        parser.add_argument('--days', dest='days', type=int, default=7,
+                            help='days per transaction')
+
+    def handle(self, date_from=None, date_to=None, days=7, *args, **options):
+        stats = EtlStats('fill_lead_hour_stat')
+        date_from = strptime(date_from) if date_from else self._first_lead_created()
+        if date_to:
+            date_to = strptime(date_to).replace(hour=23, minute=59, second=59, microsecond=999999)
+        else:
+            date_to = timezone.now()
+
+        step = timedelta(days=days)
+        while date_from and date_from <= date_to:
+            step_to = min(truncate_hour(date_from + step) - timedelta(microseconds=1), date_to)
+            with stats.stage('rebuild') as stage:
+                stage['rows'] += rebuild_lead_hour_stat(date_from, step_to)
+            date_from = step_to + timedelta(microseconds=1)
+
+        stats.finish(stats.stages.get('rebuild', {}).get('rows', 0))
+        stats.save()
+        logger.info(stats.log_line())
+
+    @staticmethod
+    def _first_lead_created():
+        lead = Lead.objects.filter(created__isnull=False).order_by('created').first()
+        return lead.created if lead else None
@@ -1,13 +1,21 @@
 from datetime import timedelta
 from logging import getLogger
+from multiprocessing import Pool
 
-from django.core.management.base import BaseCommand
-from django.db.transaction import atomic
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.transaction import atomic, on_commit
 from django.utils import timezone
 
-from collector.models import Lead, SessionStorage, LeadField, Event, Pixel, LeadUtm, LeadOpenstat
+from collector.analytics_cache import invalidate_users
+from collector.dashboard_warmer import warm_dashboards
+from collector.etl import EtlStats, profiled
+from collector.models import Lead, SessionStorage, LeadField, Event, Pixel, LeadUtm, LeadOpenstat, \
+    LeadUrlLabel, UserUrlLabel
 from collector.models.dictionaries import TrafficChannel
-from utils.ad import parse_traffic_channel
+from collector.rollups import refresh_lead_hour_stat, lead_pixel_hours
+from utils.ad import parse_traffic_channel, AdUrl
 from utils.datetime import strptime
 from utils.network import ip2subnet
 
@@ -16,30 +24,198 @@ logger = getLogger(__name__)
 # we load sessions which last event younger than DEFAULT_PERIOD
 DEFAULT_PERIOD = timedelta(minutes=5)
 
+# sessions per transaction for parallel back-fill
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _fill_shard(shard):
+    """
+    process pool entry point: fill leads for one shard of sessions
+    every worker opens its own db connection on first query
+    :param shard: (session_ids, chunk_size)
+    :return: (filled, failed, stages, invalidated user ids)
+    """
+    session_ids, chunk_size = shard
+    command = Command()
+    try:
+        filled, failed = command.fill_chunks(session_ids, chunk_size)
+        return filled, failed, command.stats.stages, command.invalidated_users
+    finally:
+        connections.close_all()
+
 
 class Command(BaseCommand):
     help = 'fill leads table from raw session and events data'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = EtlStats('fill_leads')
+        # users whose leads were filled by committed chunks
+        self.invalidated_users = set()
+
     def add_arguments(self, parser):
         # # Positional arguments
         # parser.add_argument('pixel_id', type=str)
         parser.add_argument('--date-from', dest='date_from', type=str)
         parser.add_argument('--date-to', dest='date_to', type=str)
-
-    @atomic()
-    def handle(self, date_from=None, date_to=None, *args, **options):
+        parser.add_argument('--workers', dest='workers', type=int, default=1,
+                            help='process pool size for back-fill')
+        parser.add_argument('--shard-by', dest='shard_by', choices=('pixel', 'session'),
+                            default='pixel', help='split sessions between workers by pixel or session')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                            help='sessions per transaction, whole run in one transaction by default')
+        parser.add_argument('--stats-json', dest='stats_json', type=str, default=None,
+                            help='dump per stage timings to json file')
+        parser.add_argument('--profile', dest='profile', type=str, default=None,
+                            help='run under cProfile and save pstats to file')
+        parser.add_argument('--no-warm', dest='warm', action='store_false', default=True,
+                            help='do not warm dashboards of saved page filters after fill')
+
+    def handle(self, date_from=None, date_to=None, workers=1, chunk_size=None, shard_by='pixel',
+               stats_json=None, profile=None, warm=True, *args, **options):
         now = timezone.now()
-        started = now
+        self.stats = EtlStats('fill_leads')
+        self.invalidated_users = set()
+
+        with profiled(profile):
+            with self.stats.stage('session_ids') as stage:
+                session_ids = self._load_session_ids(now, date_from, date_to)
+                if workers > 1:
+                    # ids are fetched once, already split between workers
+                    if shard_by == 'pixel':
+                        shards = self._shard_session_ids_by_pixel(session_ids, workers)
+                    else:
+                        shards = self._shard_session_ids(session_ids.iterator(), workers)
+                    stage['rows'] += sum(len(shard) for shard in shards)
+                else:
+                    session_ids = list(session_ids)
+                    stage['rows'] += len(session_ids)
+
+            if workers > 1:
+                filled, failed = self._fill_parallel(shards, chunk_size or DEFAULT_CHUNK_SIZE)
+            else:
+                filled, failed = self.fill_chunks(session_ids, chunk_size)
+
+            if warm and settings.DASHBOARD_WARM_AFTER_FILL:
+                self._warm_dashboards()
+
+        self.stats.finish(filled, failed)
+        self.stats.save()
+        if stats_json:
+            self.stats.dump_json(stats_json)
+        logger.info(self.stats.log_line())
+        if failed:
+            raise CommandError('Fill leads failed for {} sessions'.format(failed))
+
+    def _warm_dashboards(self):
+        """
+        warm stale dashboards of saved page filters of users whose leads were filled,
+        leads are already committed, so failed warm does not fail the fill
+        """
+        if not self.invalidated_users:
+            return
+        with self.stats.stage('warm') as stage:
+            try:
+                warmed, failed = warm_dashboards(self.invalidated_users)
+            except Exception:
+                logger.exception('Warm dashboards failed')
+                return
+            stage['rows'] += warmed
+        if failed:
+            logger.warning('Dashboards of {} pages are not warmed'.format(failed))
+
+    def _fill_parallel(self, shards, chunk_size):
+        """
+        fill every shard of sessions in separate process
+        :param shards: lists of session ids, see _shard_session_ids
+        :param chunk_size: sessions per transaction
+        :return: (filled, failed)
+        """
+        # forked workers must not share parent connection
+        connections.close_all()
+        with Pool(processes=len(shards) or 1) as pool:
+            results = pool.map(_fill_shard, [(shard, chunk_size) for shard in shards])
+        filled = sum(res[0] for res in results)
+        failed = sum(res[1] for res in results)
+        for res in results:
+            # stage times of workers are summed, so they show cpu time not wall time
+            self.stats.merge(res[2])
+            self.invalidated_users.update(res[3])
+        return filled, failed
+
+    @staticmethod
+    def _shard_session_ids(session_ids, workers):
+        """
+        split sessions to shards by session id
+        :param session_ids: iterable of session ids
+        :param workers: shards count
+        :return: list of not empty lists of session ids
+        """
+        shards = [[] for _ in range(workers)]
+        for session_id in session_ids:
+            shards[session_id.int % workers].append(session_id)
+        return [shard for shard in shards if shard]
 
-        session_ids = self._load_session_ids(now, date_from, date_to)
-        sessions = self._load_sessions(session_ids)
+    @staticmethod
+    def _shard_session_ids_by_pixel(session_ids, workers):
+        """
+        split sessions to shards by pixel, all sessions of one pixel go to the same shard
+        :param session_ids: QuerySet of session ids, it is a subquery, so ids are not sent back to db
+        :param workers: shards count
+        :return: list of not empty lists of session ids
+        """
+        shards = [[] for _ in range(workers)]
+        pixel_sessions = SessionStorage.objects \
+            .filter(id__in=session_ids) \
+            .values_list('pixel_id', 'id')
+        for pixel_id, session_id in pixel_sessions.iterator():
+            shards[pixel_id.int % workers].append(session_id)
+        return [shard for shard in shards if shard]
 
-        exist_leads = {lead.pk: lead for lead in Lead.objects.filter(id__in=session_ids)}
+    def fill_chunks(self, session_ids, chunk_size=None):
+        """
+        fill leads chunk by chunk, every chunk in own transaction
+        failed chunk is logged and skipped
+        :param session_ids: list of session ids
+        :param chunk_size: sessions per transaction, None - all in one
+        :return: (filled, failed)
+        """
+        if not chunk_size:
+            chunk_size = len(session_ids) or 1
+        filled = failed = 0
+        for i in range(0, len(session_ids), chunk_size):
+            chunk = session_ids[i:i + chunk_size]
+            try:
+                filled += self.fill_sessions(chunk)
+            except Exception:
+                logger.exception('Fill leads chunk of {} sessions failed'.format(len(chunk)))
+                failed += len(chunk)
+        return filled, failed
 
-        traffic_channel_map = { channel.name: channel for channel in TrafficChannel.objects.all() }
+    @atomic()
+    def fill_sessions(self, session_ids):
+        """
+        fill leads for sessions
+        per stage timings are collected to self.stats
+        :param session_ids: list of session ids
+        :return: count of filled leads
+        """
+        stats = self.stats
+        with stats.stage('sessions') as stage:
+            sessions = list(self._load_sessions(session_ids))
+            exist_leads = {lead.pk: lead for lead in Lead.objects.filter(id__in=session_ids)}
+            traffic_channel_map = {channel.name: channel for channel in TrafficChannel.objects.all()}
+            stage['rows'] += len(sessions)
+        # rollup slices of leads before update
+        pixel_hours = lead_pixel_hours(exist_leads.values())
+        # url labels of new leads for user label counts
+        url_labels = []
 
         for session in sessions:
-            channel = parse_traffic_channel(session.referrer, session.location)
+            # urls are parsed once for channel and url labels
+            location = AdUrl(session.location)
+            referrer = AdUrl(session.referrer)
+            channel = parse_traffic_channel(referrer, location)
             lead = exist_leads.get(session.id, Lead(
                 id=session.id,
                 pixel=session.pixel,
@@ -54,20 +230,38 @@ class Command(BaseCommand):
                 traffic_channel=traffic_channel_map[channel],
                 session_started=session.created,
             ))
+            created = lead.created
             lead.created = session.submitted
-            last_event = session.events.order_by('-finished').first()
+            with stats.stage('events', rows=1):
+                last_event = session.events.order_by('-finished').first()
+                form_data = self._get_session_form_data(session)
             lead.last_event_time = last_event.finished if last_event else None
             lead.set_metrik_lead_duration()
-            lead.save()
+            with stats.stage('leads', rows=1):
+                lead.save()
 
             if session.id not in exist_leads:
-                self._save_lead_url_labels(session, lead)
-
-            lead.fields.all().delete()
-            self._save_lead_fields(session, lead)
-
-        logger.info('Fill {} leads complete in {}s'.format(
-            len(sessions), (timezone.now() - started).total_seconds()))
+                with stats.stage('labels', rows=1):
+                    self._save_lead_url_labels(session, lead, location, referrer, url_labels)
+            elif created != lead.created:
+                with stats.stage('labels', rows=1):
+                    LeadUrlLabel.objects.filter(lead=lead).update(created=lead.created)
+
+            self._save_lead_fields(session, lead, form_data)
+            pixel_hours.update(lead_pixel_hours([lead]))
+
+        with stats.stage('labels', rows=len(url_labels)):
+            UserUrlLabel.add_lead_labels(url_labels)
+        with stats.stage('rollups', rows=len(pixel_hours)):
+            refresh_lead_hour_stat(pixel_hours)
+        with stats.stage('cache'):
+            user_ids = set(Pixel.objects.filter(
+                id__in={session.pixel_id for session in sessions}, project__isnull=False
+            ).values_list('project__user_id', flat=True))
+            invalidate_users(user_ids)
+            on_commit(lambda: self.invalidated_users.update(user_ids))
+
+        return len(sessions)
 
     @staticmethod
     def fill_session_field(src: str, session: SessionStorage, lead: Lead, target: str = None):
@@ -226,8 +420,11 @@ class Command(BaseCommand):
         return session_ids
 
     def _load_sessions(self, session_ids):
+        # related models of Lead filter columns, see Lead.set_filter_columns
         return SessionStorage.objects \
             .filter(id__in=session_ids) \
+            .select_related('pixel__project', 'os_version__family', 'browser__family',
+                            'device__device_type') \
             .prefetch_related('events') \
             .order_by('pixel_id', 'created')
 
@@ -243,36 +440,60 @@ class Command(BaseCommand):
                 )
         return lead_fields
 
-    def _fill_lead_fields(self, session, lead):
+    def _fill_lead_fields(self, session, lead, form_data=None):
         lead_fields = {}
         lead_fields = self._fill_lead_type_field(lead.pixel, lead, lead_fields)
-        form_data = self._get_session_form_data(session)
+        if form_data is None:
+            form_data = self._get_session_form_data(session)
         lead_fields = self._fill_form_fields(form_data, lead, lead_fields)
         lead_fields = self._fill_session_fields(session, lead, lead_fields)
         return lead_fields
 
-    def _save_lead_fields(self, session, lead):
+    def _save_lead_fields(self, session, lead, form_data=None):
         # order sensitive, because form-data more important when tech data
-        lead_fields = self._fill_lead_fields(session, lead)
-        LeadField.objects.bulk_create(lead_fields.values())
+        with self.stats.stage('fields') as stage:
+            lead_fields = self._fill_lead_fields(session, lead, form_data)
+            stage['rows'] += len(lead_fields)
+        with self.stats.stage('fields_write', rows=len(lead_fields)):
+            lead.fields.all().delete()
+            LeadField.objects.bulk_create(lead_fields.values())
 
-    def _save_lead_url_labels(self, session, lead):
+    def _save_lead_url_labels(self, session, lead, location=None, referrer=None, url_labels=None):
         """
 
         :param session: source session
         :type session: collector.models.SessionStorage
         :param lead:  target lead
         :type lead: collector.models.Lead
+        :param location: parsed session.location
+        :type location: utils.ad.AdUrl
+        :param referrer: parsed session.referrer
+        :type referrer: utils.ad.AdUrl
+        :param url_labels: list to collect saved LeadUrlLabel
+        :type url_labels: list
         :return: (collector.models.LeadUtm, collector.models.LeadOpenstat)
         :rtype: (collector.models.LeadUtm, collector.models.LeadOpenstat)
         """
-        lead_utms = self._save_lead_url_label(LeadUtm, session.location, lead)
+        if location is None:
+            location = AdUrl(session.location)
+        if referrer is None:
+            referrer = AdUrl(session.referrer)
+
+        lead_utms = self._save_lead_url_label(LeadUtm, location, lead)
         if lead_utms is None:
-            lead_utms = self._save_lead_url_label(LeadUtm, session.referrer, lead)
+            lead_utms = self._save_lead_url_label(LeadUtm, referrer, lead)
 
-        lead_openstat = self._save_lead_url_label(LeadOpenstat, session.location, lead)
+        lead_openstat = self._save_lead_url_label(LeadOpenstat, location, lead)
         if lead_openstat is None:
-            lead_openstat = self._save_lead_url_label(LeadOpenstat, session.referrer, lead)
+            lead_openstat = self._save_lead_url_label(LeadOpenstat, referrer, lead)
+
+        lead_url_labels = []
+        for lead_label in (lead_utms, lead_openstat):
+            if lead_label is not None:
+                lead_url_labels.extend(LeadUrlLabel.from_lead_label(lead_label))
+        LeadUrlLabel.objects.bulk_create(lead_url_labels)
+        if url_labels is not None:
+            url_labels.extend(lead_url_labels)
 
         return lead_utms, lead_openstat
 
@@ -0,0 +1,39 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from collector import synthetic
+from collector.etl import EtlStats
+from utils.datetime import strptime
+
+
+class Command(BaseCommand):
+    help = 'generate synthetic users with millions of leads for load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('leads', type=int)
+        parser.add_argument('--prefix', dest='prefix', type=str, default='synthetic',
+                            help='username prefix of synthetic users')
+        parser.add_argument('--users', dest='users', type=int, default=10)
+        parser.add_argument('--sales-users', dest='sales_users', type=int, default=3)
+        parser.add_argument('--date-from', dest='date_from', type=str, default=None,
+                            help='%%Y-%%m-%%d, 90 days ago by default')
+        parser.add_argument('--date-to', dest='date_to', type=str, default=None,
+                            help='%%Y-%%m-%%d, now by default')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=synthetic.CHUNK_SIZE,
+                            help='leads per transaction')
+        parser.add_argument('--seed', dest='seed', type=int, default=0)
+
+    def handle(self, leads, prefix='synthetic', users=10, sales_users=3, date_from=None, date_to=None,
+               chunk_size=synthetic.CHUNK_SIZE, seed=0, *args, **options):
+        date_to = strptime(date_to, '%Y-%m-%d') if date_to else timezone.now()
+        date_from = strptime(date_from, '%Y-%m-%d') if date_from else date_to - timedelta(days=90)
+
+        dataset = synthetic.SyntheticDataset(prefix, users=users, sales_users=sales_users, seed=seed)
+        if dataset.lead_count():
+            raise CommandError('users of prefix "{}" already have leads'.format(prefix))
+        stats = EtlStats('fill_synthetic_leads')
+        rows = synthetic.generate_leads(dataset, leads, date_from, date_to, chunk_size, stats)
+        self.stdout.write(json.dumps({'rows': rows, 'stages': stats.stages}, indent=2))
@@ -6,10 +6,12 @@ from django.db.transaction import atomic
 from django.utils import timezone
 
 from audit.models import Audit
-from collector.models import Lead
+from collector.analytics_cache import invalidate_users
+from collector.models import Lead, Pixel
 from collector.models.analytics import LeadUtm, LeadOpenstat
 from collector.models.dictionaries import City, Provider, OSFamily, OS, BrowserVersion, \
     TrafficChannel, Device
+from collector.rollups import rebuild_lead_hour_stat
 from utils.network import int2ip, ip_int2subnet, ip_int2subnet_int
 
 DAY_MAX_LEADS = 150 # max leads generated per day
@@ -174,4 +176,6 @@ class Command(BaseCommand):
 
     @atomic()
     def handle(self, pixel_id, *args, **options):
-        fill_test_leads(pixel_id, Lead.objects, Lead)
\ No newline at end of file
+        fill_test_leads(pixel_id, Lead.objects, Lead)
+        rebuild_lead_hour_stat(pixel_ids=[pixel_id])
+        invalidate_users(Pixel.objects.filter(id=pixel_id).values_list('project__user_id', flat=True))
\ No newline at end of file
@@ -0,0 +1,97 @@
+import select
+import time
+import uuid
+from logging import getLogger
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, close_old_connections
+
+from collector.management.commands.fill_leads import Command as FillLeadsCommand
+
+logger = getLogger(__name__)
+
+# wait for more submits after first notification before materialize
+DEFAULT_DEBOUNCE = 0.2
+# but materialize not later than DEFAULT_MAX_DELAY after first notification
+DEFAULT_MAX_DELAY = 0.5
+# how long to sleep in select when nothing happens
+IDLE_TIMEOUT = 5
+
+
+class Command(BaseCommand):
+    help = 'materialize leads right after form submit, listens notifications from collect_event'
+    # waiting and clock, tests replace them to debounce without real time
+    _select = staticmethod(select.select)
+    _clock = staticmethod(time.monotonic)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--debounce', dest='debounce', type=float, default=DEFAULT_DEBOUNCE)
+        parser.add_argument('--max-delay', dest='max_delay', type=float, default=DEFAULT_MAX_DELAY)
+
+    def handle(self, debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY, *args, **options):
+        conn = self._listen(settings.LEADS_NOTIFY_CHANNEL)
+        logger.info('Listen {} notifications'.format(settings.LEADS_NOTIFY_CHANNEL))
+        try:
+            while True:
+                session_ids = self._wait_session_ids(conn, debounce, max_delay)
+                if session_ids:
+                    self._materialize(session_ids)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _listen(channel):
+        """
+        LISTEN needs own autocommit connection, not the django one used for filling
+        NOTE: does not work through pgbouncer in transaction pool mode
+        :param channel: channel name
+        :return: psycopg2 connection
+        """
+        wrapper = connections['default']
+        conn = wrapper.get_new_connection(wrapper.get_connection_params())
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('LISTEN {}'.format(channel))
+        return conn
+
+    def _wait_session_ids(self, conn, debounce, max_delay):
+        """
+        wait first notification, then collect others until debounce pause or max_delay
+        :return: set of session ids
+        """
+        session_ids = set()
+        first_notify = None
+        timeout = IDLE_TIMEOUT
+        while True:
+            ready, _, _ = self._select([conn], [], [], timeout)
+            if ready:
+                conn.poll()
+                while conn.notifies:
+                    session_ids.update(self._parse_payload(conn.notifies.pop(0).payload))
+            if not session_ids:
+                # idle, keep waiting first notification
+                continue
+            now = self._clock()
+            if first_notify is None:
+                first_notify = now
+            elif not ready or now - first_notify >= max_delay:
+                # nothing new for debounce seconds or waited long enough
+                return session_ids
+            timeout = min(debounce, max(max_delay - (now - first_notify), 0))
+
+    @staticmethod
+    def _parse_payload(payload):
+        try:
+            return [uuid.UUID(payload)]
+        except ValueError:
+            logger.warning('Bad {} payload: {}'.format(settings.LEADS_NOTIFY_CHANNEL, payload))
+            return []
+
+    @staticmethod
+    def _materialize(session_ids):
+        close_old_connections()
+        started = time.monotonic()
+        filled, failed = FillLeadsCommand().fill_chunks(list(session_ids))
+        logger.info('Materialize {} leads ({} failed) in {}s'.format(
+            filled, failed, time.monotonic() - started))
@@ -1,5 +1,5 @@
 import uuid
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, call
 
 from django.test import TestCase
 
@@ -127,3 +127,37 @@ class FileLeadsTestCase(TestCase):
         lead_utms, lead_openstat = cmd._save_lead_url_labels(session, lead)
         self.assertEquals('utm-source-from-location', lead_utms.utm_source)
         self.assertEquals('openstat-service-from-referrer', lead_openstat.service)
+
+
+class FillLeadsParallelTestCase(TestCase):
+
+    def test__shard_session_ids_must_split_all_sessions_between_workers(self):
+        session_ids = [uuid.UUID(int=i) for i in range(10)]
+        shards = fill_leads.Command._shard_session_ids(session_ids, 3)
+        self.assertEquals(3, len(shards))
+        self.assertEquals(sorted(session_ids), sorted(sum(shards, [])))
+        self.assertEquals([uuid.UUID(int=0), uuid.UUID(int=3), uuid.UUID(int=6), uuid.UUID(int=9)],
+                          shards[0])
+
+    def test__shard_session_ids_by_pixel_must_shard_session_ids_query(self):
+        pixels = [Pixel.objects.create(title='pixel {}'.format(i)) for i in range(3)]
+        sessions = [SessionStorage.objects.create(pixel=pixels[i % 3]) for i in range(9)]
+        session_ids = SessionStorage.objects.values_list('id', flat=True)
+        # session ids are a subquery of the sharding one
+        with self.assertNumQueries(1):
+            shards = fill_leads.Command._shard_session_ids_by_pixel(session_ids, 2)
+        self.assertEquals(sorted(session.id for session in sessions), sorted(sum(shards, [])))
+        for pixel in pixels:
+            pixel_shards = {i for i, shard in enumerate(shards)
+                            for session in sessions if session.pixel_id == pixel.id and session.id in shard}
+            self.assertEquals(1, len(pixel_shards))
+
+    def test_fill_chunks_must_count_failed_chunks_and_continue(self):
+        session_ids = [uuid.UUID(int=i) for i in range(5)]
+        cmd = fill_leads.Command()
+        cmd.fill_sessions = MagicMock(side_effect=[2, Exception('db error'), 1])
+        res = cmd.fill_chunks(session_ids, 2)
+        self.assertEquals((3, 2), res)
+        cmd.fill_sessions.assert_has_calls([
+            call(session_ids[0:2]), call(session_ids[2:4]), call(session_ids[4:5])
+        ])
@@ -0,0 +1,113 @@
+import uuid
+from unittest import mock
+
+from django.conf import settings
+from django.db import connections
+from django.test import TransactionTestCase
+
+from collector.management.commands import listen_leads
+
+
+class StopListening(Exception):
+    pass
+
+
+class Notify(object):
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class VirtualTime(object):
+    """
+    connection, select and clock of listen_leads in virtual time, select returns
+    when the next notification comes or after timeout, so tests do not sleep
+    """
+
+    def __init__(self, notifications):
+        # (time, payload) in order of time
+        self.notifications = list(notifications)
+        self.notifies = []
+        self.now = 0
+
+    def clock(self):
+        return self.now
+
+    def poll(self):
+        pass
+
+    def select(self, rlist, wlist, xlist, timeout):
+        if self.notifications and self.notifications[0][0] <= self.now + timeout:
+            self.now = max(self.now, self.notifications[0][0])
+            while self.notifications and self.notifications[0][0] <= self.now:
+                self.notifies.append(Notify(str(self.notifications.pop(0)[1])))
+            return rlist, [], []
+        self.now += timeout
+        return [], [], []
+
+
+class ListenLeadsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.cmd = listen_leads.Command()
+
+    def _notify(self, payloads):
+        """
+        send payloads from other connection like collect_event does
+        """
+        wrapper = connections['default']
+        conn = wrapper.get_new_connection(wrapper.get_connection_params())
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for payload in payloads:
+                    cursor.execute('SELECT pg_notify(%s, %s)', [settings.LEADS_NOTIFY_CHANNEL, str(payload)])
+        finally:
+            conn.close()
+
+    def test__parse_payload_must_skip_bad_session_ids(self):
+        session_id = uuid.uuid4()
+        self.assertEqual([session_id], self.cmd._parse_payload(str(session_id)))
+        self.assertEqual([], self.cmd._parse_payload('not a session'))
+        self.assertEqual([], self.cmd._parse_payload(''))
+
+    def _virtual_time(self, notifications):
+        virtual = VirtualTime(notifications)
+        self.cmd._select = virtual.select
+        self.cmd._clock = virtual.clock
+        return virtual
+
+    def test__wait_session_ids_must_return_after_debounce_pause(self):
+        session_ids = [uuid.uuid4(), uuid.uuid4()]
+        # comes after debounce pause, waits for the next call
+        late = uuid.uuid4()
+        virtual = self._virtual_time([(0, session_ids[0]), (1 / 32, 'bad'), (2 / 32, session_ids[1]),
+                                      (3 / 32, session_ids[0]), (1, late)])
+        self.assertEqual(set(session_ids), self.cmd._wait_session_ids(virtual, debounce=1 / 8, max_delay=1 / 2))
+        self.assertEqual(virtual.now, 3 / 32 + 1 / 8)
+        self.assertEqual({late}, self.cmd._wait_session_ids(virtual, debounce=1 / 8, max_delay=1 / 2))
+        self.assertEqual(virtual.now, 1 + 1 / 8)
+
+    def test__wait_session_ids_must_not_wait_longer_than_max_delay(self):
+        session_ids = [uuid.uuid4() for _ in range(100)]
+        # submits never pause for debounce
+        virtual = self._virtual_time([(i / 32, session_id) for i, session_id in enumerate(session_ids)])
+        first = self.cmd._wait_session_ids(virtual, debounce=1 / 8, max_delay=1 / 4)
+        self.assertEqual(virtual.now, 1 / 4)
+        self.assertEqual(set(session_ids[:9]), first)
+
+    def test_notified_session_must_be_materialized(self):
+        session_id = uuid.uuid4()
+        listen = self.cmd._listen
+
+        def listen_and_notify(channel):
+            # notified after LISTEN, so it is not missed however slow the start is
+            conn = listen(channel)
+            self._notify([session_id])
+            return conn
+
+        self.cmd._listen = listen_and_notify
+        with mock.patch.object(listen_leads.FillLeadsCommand, 'fill_chunks',
+                               side_effect=StopListening) as fill_chunks:
+            with self.assertRaises(StopListening):
+                self.cmd.handle(debounce=0.1, max_delay=0.5)
+        fill_chunks.assert_called_once_with([session_id])
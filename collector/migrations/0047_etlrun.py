@@ -0,0 +1,27 @@
+# Generated by Django 2.0.1 on 2026-10-19 14:17
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collector', '0046_auto_20180328_1127'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EtlRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.CharField(db_index=True, max_length=100)),
+                ('started', models.DateTimeField(db_index=True)),
+                ('finished', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='in seconds')),
+                ('rows', models.IntegerField(default=0, help_text='count of processed rows')),
+                ('failed', models.IntegerField(default=0, help_text='count of failed rows')),
+                ('stages', django.contrib.postgres.fields.jsonb.JSONField(default=dict, help_text='{stage: {time, rows, queries}}')),
+            ],
+        ),
+    ]
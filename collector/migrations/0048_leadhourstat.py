@@ -0,0 +1,37 @@
+# Generated by Django 2.0.1 on 2026-10-19 14:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0047_etlrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeadHourStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('device_category', models.PositiveSmallIntegerField(choices=[(1, 'Phone'), (2, 'Tablet'), (3, 'Desktop')], null=True)),
+                ('duration_group', models.CharField(max_length=50)),
+                ('leads', models.IntegerField(default=0)),
+                ('salecount', models.IntegerField(default=0)),
+                ('browser_group', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.BrowserGroup')),
+                ('os_group', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.OSGroup')),
+                ('pixel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.Pixel')),
+                ('project', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.Project')),
+                ('traffic_channel', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.TrafficChannel')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='leadhourstat',
+            index_together={('user', 'hour'), ('pixel', 'hour')},
+        ),
+    ]
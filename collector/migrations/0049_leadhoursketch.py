@@ -0,0 +1,32 @@
+# Generated by Django 2.0.1 on 2026-10-19 14:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0048_leadhourstat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeadHourSketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('devices', models.BinaryField()),
+                ('subnets', models.BinaryField()),
+                ('pixel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.Pixel')),
+                ('project', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.Project')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='leadhoursketch',
+            index_together={('pixel', 'hour'), ('user', 'hour')},
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 2.0.1 on 2026-10-19 14:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+
+
+def forwards_func(apps, schema_editor):
+    Lead = apps.get_model("collector", "Lead")
+    Pixel = apps.get_model("collector", "Pixel")
+    OS = apps.get_model("collector", "OS")
+    BrowserVersion = apps.get_model("collector", "BrowserVersion")
+    Device = apps.get_model("collector", "Device")
+    db_alias = schema_editor.connection.alias
+
+    def related(model, path, field):
+        return Subquery(model.objects.using(db_alias).filter(id=OuterRef(field)).values(path)[:1])
+
+    # one pass over leads
+    Lead.objects.using(db_alias).update(
+        project_id=related(Pixel, 'project_id', 'pixel_id'),
+        user_id=related(Pixel, 'project__user_id', 'pixel_id'),
+        os_group_id=related(OS, 'family__group_id', 'os_version_id'),
+        browser_group_id=related(BrowserVersion, 'family__group_id', 'browser_id'),
+        device_category=related(Device, 'device_type__category', 'device_model_id'),
+    )
+
+
+def reverse_func(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0049_leadhoursketch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lead',
+            name='browser_group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='collector.BrowserGroup'),
+        ),
+        migrations.AddField(
+            model_name='lead',
+            name='device_category',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(1, 'Phone'), (2, 'Tablet'), (3, 'Desktop')], null=True),
+        ),
+        migrations.AddField(
+            model_name='lead',
+            name='os_group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='collector.OSGroup'),
+        ),
+        migrations.AddField(
+            model_name='lead',
+            name='project',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='collector.Project'),
+        ),
+        migrations.AddField(
+            model_name='lead',
+            name='user',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(forwards_func, reverse_func),
+        migrations.AlterIndexTogether(
+            name='lead',
+            index_together={('user', 'created'), ('project', 'created')},
+        ),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 2.0.1 on 2026-10-19 14:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# labels of existing leads, kinds are collector.models.analytics.URL_LABEL_KINDS
+LEAD_LABELS_SQL = """
+    SELECT lead_id, 1 AS label_kind, utm_source AS value FROM collector_leadutm
+    UNION ALL SELECT lead_id, 2 AS label_kind, utm_medium AS value FROM collector_leadutm
+    UNION ALL SELECT lead_id, 3 AS label_kind, utm_campaign AS value FROM collector_leadutm
+    UNION ALL SELECT lead_id, 4 AS label_kind, utm_term AS value FROM collector_leadutm
+    UNION ALL SELECT lead_id, 5 AS label_kind, utm_content AS value FROM collector_leadutm
+    UNION ALL SELECT lead_id, 6 AS label_kind, service AS value FROM collector_leadopenstat
+    UNION ALL SELECT lead_id, 7 AS label_kind, campaign AS value FROM collector_leadopenstat
+    UNION ALL SELECT lead_id, 8 AS label_kind, ad AS value FROM collector_leadopenstat
+    UNION ALL SELECT lead_id, 9 AS label_kind, source AS value FROM collector_leadopenstat
+"""
+
+FILL_LEAD_URL_LABELS_SQL = """
+WITH labels AS (
+    -- one label of a kind per lead like fill_leads saves them
+    SELECT DISTINCT ON (lead_id, label_kind) * FROM (
+    {labels}
+    ) l WHERE value <> ''
+    ORDER BY lead_id, label_kind
+), new_values AS (
+    INSERT INTO collector_urllabelvalue (label_kind, value)
+    SELECT DISTINCT label_kind, value FROM labels
+    RETURNING id, label_kind, value
+)
+INSERT INTO collector_leadurllabel (user_id, label_kind, label_value_id, created, lead_id)
+SELECT lead.user_id, labels.label_kind, new_values.id, lead.created, lead.id
+FROM labels
+JOIN new_values ON new_values.label_kind = labels.label_kind AND new_values.value = labels.value
+JOIN collector_lead lead ON lead.id = labels.lead_id
+""".format(labels=LEAD_LABELS_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0050_lead_filter_columns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeadUrlLabel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label_kind', models.PositiveSmallIntegerField(choices=[(1, 'utm utm_source'), (2, 'utm utm_medium'), (3, 'utm utm_campaign'), (4, 'utm utm_term'), (5, 'utm utm_content'), (6, 'openstat service'), (7, 'openstat campaign'), (8, 'openstat ad'), (9, 'openstat source')])),
+                ('created', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UrlLabelValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label_kind', models.PositiveSmallIntegerField(choices=[(1, 'utm utm_source'), (2, 'utm utm_medium'), (3, 'utm utm_campaign'), (4, 'utm utm_term'), (5, 'utm utm_content'), (6, 'openstat service'), (7, 'openstat campaign'), (8, 'openstat ad'), (9, 'openstat source')])),
+                ('value', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='urllabelvalue',
+            unique_together={('label_kind', 'value')},
+        ),
+        migrations.AddField(
+            model_name='leadurllabel',
+            name='label_value',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='collector.UrlLabelValue'),
+        ),
+        migrations.AddField(
+            model_name='leadurllabel',
+            name='lead',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='url_labels', to='collector.Lead'),
+        ),
+        migrations.AddField(
+            model_name='leadurllabel',
+            name='user',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='leadurllabel',
+            unique_together={('lead', 'label_kind')},
+        ),
+        migrations.AlterIndexTogether(
+            name='leadurllabel',
+            index_together={('user', 'label_kind', 'label_value', 'created', 'lead')},
+        ),
+        # case insensitive lookup of value__iexact is upper(value) = upper(%s)
+        migrations.RunSQL(
+            'CREATE INDEX collector_urllabelvalue_upper_idx ON collector_urllabelvalue '
+            '(label_kind, upper(value::text))',
+            'DROP INDEX collector_urllabelvalue_upper_idx',
+        ),
+        migrations.RunSQL(FILL_LEAD_URL_LABELS_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL('ANALYZE collector_urllabelvalue, collector_leadurllabel',
+                          migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.0.1 on 2026-10-19 14:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+FILL_USER_URL_LABELS_SQL = """
+INSERT INTO collector_userurllabel (user_id, label_kind, label_value_id, value, leads)
+SELECT label.user_id, label.label_kind, label.label_value_id, label_value.value, COUNT(*)
+FROM collector_leadurllabel label
+JOIN collector_urllabelvalue label_value ON label_value.id = label.label_value_id
+WHERE label.user_id IS NOT NULL
+GROUP BY 1, 2, 3, 4
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0051_lead_url_label'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserUrlLabel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label_kind', models.PositiveSmallIntegerField(choices=[(1, 'utm utm_source'), (2, 'utm utm_medium'), (3, 'utm utm_campaign'), (4, 'utm utm_term'), (5, 'utm utm_content'), (6, 'openstat service'), (7, 'openstat campaign'), (8, 'openstat ad'), (9, 'openstat source')])),
+                ('value', models.CharField(max_length=255)),
+                ('leads', models.IntegerField(default=0)),
+                ('label_value', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='collector.UrlLabelValue')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='userurllabel',
+            unique_together={('user', 'label_kind', 'label_value')},
+        ),
+        # prefix search of value__istartswith is upper(value) LIKE 'PREFIX%'
+        migrations.RunSQL(
+            'CREATE INDEX collector_userurllabel_prefix_idx ON collector_userurllabel '
+            '(user_id, label_kind, upper(value::text) text_pattern_ops)',
+            'DROP INDEX collector_userurllabel_prefix_idx',
+        ),
+        migrations.RunSQL(FILL_USER_URL_LABELS_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL('ANALYZE collector_userurllabel', migrations.RunSQL.noop),
+    ]
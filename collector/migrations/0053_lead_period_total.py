@@ -0,0 +1,61 @@
+# Generated by Django 2.0.1 on 2026-10-19 14:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+FILL_PERIOD_TOTALS_SQL = """
+INSERT INTO collector_leadperiodtotal (unit, started, leads, salecount)
+SELECT 'hour', hour, SUM(leads), SUM(salecount) FROM collector_leadhourstat GROUP BY 1, 2
+UNION ALL
+SELECT 'day', date_trunc('day', hour AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', SUM(leads), SUM(salecount)
+FROM collector_leadhourstat GROUP BY 1, 2;
+
+INSERT INTO collector_leaduserperiodtotal (user_id, unit, started, leads, salecount)
+SELECT user_id, 'hour', hour, SUM(leads), SUM(salecount)
+FROM collector_leadhourstat WHERE user_id IS NOT NULL GROUP BY 1, 2, 3
+UNION ALL
+SELECT user_id, 'day', date_trunc('day', hour AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', SUM(leads), SUM(salecount)
+FROM collector_leadhourstat WHERE user_id IS NOT NULL GROUP BY 1, 2, 3;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0052_user_url_label'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeadPeriodTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unit', models.CharField(choices=[('hour', 'hour'), ('day', 'day')], max_length=4)),
+                ('started', models.DateTimeField()),
+                ('leads', models.IntegerField(default=0)),
+                ('salecount', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LeadUserPeriodTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unit', models.CharField(choices=[('hour', 'hour'), ('day', 'day')], max_length=4)),
+                ('started', models.DateTimeField()),
+                ('leads', models.IntegerField(default=0)),
+                ('salecount', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='leadperiodtotal',
+            unique_together={('unit', 'started')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='leaduserperiodtotal',
+            unique_together={('user', 'unit', 'started')},
+        ),
+        migrations.RunSQL(FILL_PERIOD_TOTALS_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.0.1 on 2026-10-19 14:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0053_lead_period_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lead',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='lead',
+            index_together={('project', 'created'), ('user', 'created'), ('user', 'updated')},
+        ),
+    ]
@@ -0,0 +1,124 @@
+# Generated by Django 2.0.1 on 2026-10-19 16:05
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models.aggregates import Count, Sum
+from django.db.models.expressions import Case, ExpressionWrapper, F, Value, When
+from django.db.models.fields import CharField, DurationField
+from django.db.models.functions.datetime import TruncHour
+
+from utils.hll import HyperLogLog
+
+# LEAD_DURATION_GROUPS of the migration: id, operator, seconds, range end seconds
+DURATION_GROUPS = (
+    ('less_5_seconds', 'range', 0, 5 - 1),
+    ('5_to_30_seconds', 'range', 5, 30 - 1),
+    ('30_to_60_seconds', 'range', 30, 60 - 1),
+    ('1_to_5_minutes', 'range', 60, 5 * 60 - 1),
+    ('5_to_30_minutes', 'range', 5 * 60, 30 * 60 - 1),
+    ('30_to_60_minutes', 'range', 30 * 60, 60 * 60 - 1),
+    ('more_1_hour', 'gte', 60 * 60, None),
+)
+
+STAT_KEYS = ('user_id', 'project_id', 'pixel_id', 'hour', 'os_group_id', 'browser_group_id',
+             'device_category', 'traffic_channel_id', 'duration_group')
+
+FILL_PERIOD_TOTALS_SQL = """
+DELETE FROM collector_leadperiodtotal;
+DELETE FROM collector_leaduserperiodtotal;
+
+INSERT INTO collector_leadperiodtotal (unit, started, leads, salecount)
+SELECT 'hour', hour, SUM(leads), SUM(salecount) FROM collector_leadhourstat GROUP BY 1, 2
+UNION ALL
+SELECT 'day', date_trunc('day', hour AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', SUM(leads), SUM(salecount)
+FROM collector_leadhourstat GROUP BY 1, 2;
+
+INSERT INTO collector_leaduserperiodtotal (user_id, unit, started, leads, salecount)
+SELECT user_id, 'hour', hour, SUM(leads), SUM(salecount)
+FROM collector_leadhourstat WHERE user_id IS NOT NULL GROUP BY 1, 2, 3
+UNION ALL
+SELECT user_id, 'day', date_trunc('day', hour AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', SUM(leads), SUM(salecount)
+FROM collector_leadhourstat WHERE user_id IS NOT NULL GROUP BY 1, 2, 3;
+"""
+
+
+def _duration_groups_case():
+    """
+    as collector.analytics._lead_duration_groups_case of all groups
+    """
+    whens = []
+    for group_id, operator, val1, val2 in DURATION_GROUPS:
+        if operator == 'range':
+            value = (timedelta(seconds=val1), timedelta(seconds=val2))
+        else:
+            value = timedelta(seconds=val1)
+        whens.append(When(**{'lead_duration__' + operator: value, 'then': Value(group_id)}))
+    return Case(*whens, default=Value('Others'), output_field=CharField())
+
+
+def _sketch_leads(LeadHourSketch, rows):
+    """
+    :param rows: ordered by key (user, project, pixel, hour, device_id, subnet)
+    :return: generator of LeadHourSketch per key
+    """
+    key = sketch = None
+    for user_id, project_id, pixel_id, hour, device_id, subnet in rows:
+        if key != (user_id, project_id, pixel_id, hour):
+            if sketch is not None:
+                yield LeadHourSketch(devices=sketch[0].to_bytes(), subnets=sketch[1].to_bytes(), **sketch[2])
+            key = (user_id, project_id, pixel_id, hour)
+            sketch = (HyperLogLog(), HyperLogLog(),
+                      dict(user_id=user_id, project_id=project_id, pixel_id=pixel_id, hour=hour))
+        sketch[0].add(device_id)
+        sketch[1].add(subnet)
+    if sketch is not None:
+        yield LeadHourSketch(devices=sketch[0].to_bytes(), subnets=sketch[1].to_bytes(), **sketch[2])
+
+
+def forwards_func(apps, schema_editor):
+    """
+    rollups of leads converted before deploy, as collector.rollups.rebuild_lead_hour_stat
+    """
+    Lead = apps.get_model("collector", "Lead")
+    LeadHourStat = apps.get_model("collector", "LeadHourStat")
+    LeadHourSketch = apps.get_model("collector", "LeadHourSketch")
+    db_alias = schema_editor.connection.alias
+
+    LeadHourStat.objects.using(db_alias).all().delete()
+    LeadHourSketch.objects.using(db_alias).all().delete()
+    leads_qs = Lead.objects.using(db_alias).filter(created__isnull=False).annotate(hour=TruncHour('created'))
+
+    stats_qs = leads_qs.annotate(lead_duration=ExpressionWrapper(
+        F('created') - F('session_started'), output_field=DurationField()
+    ))
+    stats_qs = stats_qs.annotate(duration_group=_duration_groups_case())
+    stats_qs = stats_qs.values(*STAT_KEYS).annotate(leads=Count('id'), salecount=Sum('metrik_lead_salecount'))
+    LeadHourStat.objects.using(db_alias).bulk_create((
+        LeadHourStat(leads=row['leads'], salecount=row['salecount'] or 0, **{key: row[key] for key in STAT_KEYS})
+        for row in stats_qs.order_by().iterator()
+    ), batch_size=1000)
+
+    rows = leads_qs.values_list('user_id', 'project_id', 'pixel_id', 'hour', 'device_id', 'subnet')
+    rows = rows.order_by('pixel_id', 'hour', 'user_id', 'project_id')
+    LeadHourSketch.objects.using(db_alias).bulk_create(
+        _sketch_leads(LeadHourSketch, rows.iterator()), batch_size=1000)
+
+
+def reverse_func(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0054_lead_updated'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards_func, reverse_func),
+        # 0053_lead_period_total filled totals from empty rollups
+        migrations.RunSQL(FILL_PERIOD_TOTALS_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 2.0.1 on 2026-10-19 15:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+from utils.hll import HyperLogLog
+
+
+def _period_start(value, unit):
+    value = value.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(day=1) if unit == 'month' else value
+
+
+def _merge_sketches(LeadPeriodSketch, unit, rows):
+    """
+    :param rows: ordered by pixel and time (user, project, pixel, time, devices, subnets)
+    :return: generator of LeadPeriodSketch merged per pixel and utc period
+    """
+    key = period = None
+    for user_id, project_id, pixel_id, started, devices, subnets in rows:
+        if key != (pixel_id, _period_start(started, unit)):
+            if period is not None:
+                yield LeadPeriodSketch(devices=period[0].to_bytes(), subnets=period[1].to_bytes(), **period[2])
+            key = (pixel_id, _period_start(started, unit))
+            period = (HyperLogLog(), HyperLogLog(),
+                      dict(user_id=user_id, project_id=project_id, pixel_id=pixel_id, unit=unit, started=key[1]))
+        period[0].merge_bytes(devices)
+        period[1].merge_bytes(subnets)
+    if period is not None:
+        yield LeadPeriodSketch(devices=period[0].to_bytes(), subnets=period[1].to_bytes(), **period[2])
+
+
+def forwards_func(apps, schema_editor):
+    """
+    day sketches of hourly ones and month sketches of day ones, as collector.rollups.rebuild_lead_hour_stat
+    """
+    LeadHourSketch = apps.get_model("collector", "LeadHourSketch")
+    LeadPeriodSketch = apps.get_model("collector", "LeadPeriodSketch")
+    db_alias = schema_editor.connection.alias
+
+    fields = ('user', 'project', 'pixel', 'hour', 'devices', 'subnets')
+    rows = LeadHourSketch.objects.using(db_alias).values_list(*fields).order_by('pixel', 'hour')
+    LeadPeriodSketch.objects.using(db_alias).bulk_create(
+        _merge_sketches(LeadPeriodSketch, 'day', rows.iterator()), batch_size=1000)
+    fields = ('user', 'project', 'pixel', 'started', 'devices', 'subnets')
+    rows = LeadPeriodSketch.objects.using(db_alias).filter(unit='day').values_list(*fields).order_by('pixel', 'started')
+    LeadPeriodSketch.objects.using(db_alias).bulk_create(
+        _merge_sketches(LeadPeriodSketch, 'month', rows.iterator()), batch_size=1000)
+
+
+def reverse_func(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collector', '0055_fill_lead_hour_stat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeadPeriodSketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unit', models.CharField(choices=[('day', 'day'), ('month', 'month')], max_length=5)),
+                ('started', models.DateTimeField()),
+                ('devices', models.BinaryField()),
+                ('subnets', models.BinaryField()),
+                ('pixel', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.Pixel')),
+                ('project', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='collector.Project')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='leadperiodsketch',
+            unique_together={('pixel', 'unit', 'started')},
+        ),
+        migrations.AlterIndexTogether(
+            name='leadperiodsketch',
+            index_together={('user', 'unit', 'started')},
+        ),
+        migrations.RunPython(forwards_func, reverse_func),
+    ]
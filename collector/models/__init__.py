@@ -1,4 +1,6 @@
 from collector.models.analytics import *
 from collector.models.dictionaries import *
+from collector.models.etl import *
 from collector.models.projects import *
 from collector.models.raw import *
+from collector.models.rollups import *
@@ -4,17 +4,24 @@ import uuid
 from datetime import timedelta, time
 
 import hashlib
-from collections import OrderedDict, namedtuple
-from django.db import models
-from django.db.models.deletion import CASCADE, PROTECT
+from collections import Counter, OrderedDict, namedtuple
+from django.contrib.auth import get_user_model
+from django.db import connection, models, transaction
+from django.db.models.deletion import CASCADE, PROTECT, SET_NULL
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_decode
 from django.utils.translation import ugettext_lazy as _
 from django_countries.fields import CountryField
 
-from collector.models.dictionaries import City, Provider, BrowserVersion, Device, OS, TrafficChannel
-from collector.models.projects import Pixel
-from utils.ad import parse_url_utms, parse_url_openstat
+from collector.models.dictionaries import City, Provider, BrowserVersion, Device, OS, TrafficChannel, \
+    OSGroup, BrowserGroup, DeviceType
+from collector.models.projects import Pixel, Project
+from utils.ad import to_ad_url
+
+User = get_user_model()
 
 
 class Lead(models.Model):
@@ -42,11 +49,58 @@ class Lead(models.Model):
     created = models.DateTimeField(null=True, blank=True, db_index=True)
     metrik_lead_duration = models.IntegerField(blank=True, null=True, default=None)
     metrik_lead_salecount = models.IntegerField(default=0)
+    # denormalised filter columns, analytics filter leads without join chains,
+    # see set_filter_columns, user and project are indexed with created in Meta
+    user = models.ForeignKey(User, null=True, blank=True, related_name='+', on_delete=SET_NULL,
+                             db_index=False)
+    project = models.ForeignKey(Project, null=True, blank=True, related_name='+', on_delete=SET_NULL,
+                                db_index=False)
+    os_group = models.ForeignKey(OSGroup, null=True, blank=True, related_name='+', on_delete=PROTECT)
+    browser_group = models.ForeignKey(BrowserGroup, null=True, blank=True, related_name='+',
+                                      on_delete=PROTECT)
+    device_category = models.PositiveSmallIntegerField(choices=DeviceType.TYPES, null=True, blank=True)
+    # last change, columnar engine reloads leads of user changed since its last load
+    updated = models.DateTimeField(auto_now=True, null=True, blank=True)
+
+    class Meta:
+        index_together = (('user', 'created'), ('project', 'created'), ('user', 'updated'))
 
     def __str__(self):
         # pixel_title = self.pixel.title if self.pixel else None
         return "Pixel {0}: Id: {1} SessionStarted {2}".format(self.pixel_id, self.id, self.session_started)
 
+    # set_filter_columns fields, names and attnames as update_fields accepts both
+    FILTER_COLUMNS = frozenset(('user', 'user_id', 'project', 'project_id', 'os_group', 'os_group_id',
+                                'browser_group', 'browser_group_id', 'device_category'))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        lead = super().from_db(db, field_names, values)
+        # filter columns are copied again only if pixel is changed, see save
+        if 'pixel_id' in lead.__dict__:
+            lead._loaded_pixel_id = lead.pixel_id
+        return lead
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or self.FILTER_COLUMNS.intersection(update_fields):
+            if self._state.adding or self.pixel_id != getattr(self, '_loaded_pixel_id', self.pixel_id):
+                self.set_filter_columns()
+        super().save(*args, **kwargs)
+        self._loaded_pixel_id = self.pixel_id
+
+    def set_filter_columns(self):
+        """
+        copy user, project, os group, browser group and device category from related models,
+        select_related them to fill without queries
+        """
+        project = self.pixel.project if self.pixel_id else None
+        self.project_id = project.id if project else None
+        self.user_id = project.user_id if project else None
+        self.os_group_id = self.os_version.family.group_id if self.os_version_id else None
+        self.browser_group_id = self.browser.family.group_id if self.browser_id else None
+        self.device_category = self.device_model.device_type.category if self.device_model_id else None
+
     def fields_hash_map(self, field_names):
         if not field_names:
             return {}
@@ -63,6 +117,37 @@ class Lead(models.Model):
             self.metrik_lead_duration = (session_end - self.session_started).total_seconds()
 
 
+@receiver(post_save, sender=Pixel)
+def update_leads_project(sender, instance, raw=False, *args, **kwargs):
+    """
+    keep Lead.project and Lead.user (and url labels, rollups and cached analytics of users)
+    of pixel leads when pixel is moved to other project
+    """
+    if raw:
+        # loaddata, related objects may be not loaded yet
+        return
+    project = instance.project
+    leads_qs = Lead.objects.filter(pixel=instance)
+    if project is None:
+        leads_qs = leads_qs.filter(project__isnull=False)
+    else:
+        leads_qs = leads_qs.exclude(project=project, user=project.user_id)
+    leads = dict(leads_qs.values_list('id', 'user_id'))
+    if leads:
+        user_id = project.user_id if project else None
+        Lead.objects.filter(id__in=leads).update(project=project, user=user_id, updated=timezone.now())
+        LeadUrlLabel.objects.filter(lead__in=leads).update(user=user_id)
+        UserUrlLabel.refresh_users(set(leads.values()) | {user_id})
+        # rollups keep user and project of pixel, period totals are moved by difference
+        from collector.rollups import rebuild_lead_hour_stat
+        rebuild_lead_hour_stat(pixel_ids=[instance.id])
+        # columns of previous users are fully reloaded without moved leads
+        from collector.columnar import reset_lead_columns
+        reset_lead_columns(set(leads.values()) - {None})
+        from collector.analytics_cache import invalidate_users
+        invalidate_users((set(leads.values()) | {user_id}) - {None})
+
+
 class LeadField(models.Model):
     """
     Form data for lead
@@ -91,6 +176,9 @@ class LeadField(models.Model):
 
 
 class LeadUtm(models.Model):
+    URL_LABEL_TYPE = 'utm'
+    URL_LABEL_FIELDS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content')
+
     lead = models.ForeignKey(Lead, related_name='utm', on_delete=CASCADE)
     utm_source = models.CharField(max_length=255, db_index=True)
     utm_medium = models.CharField(max_length=255, null=True, blank=True, db_index=True)
@@ -100,7 +188,11 @@ class LeadUtm(models.Model):
 
     @classmethod
     def parse_url(cls, url):
-        labels = parse_url_utms(url)
+        """
+        :param url: url or utils.ad.AdUrl
+        :return: LeadUtm or None
+        """
+        labels = to_ad_url(url).utm
         if labels is None:
             return None
         obj = cls()
@@ -109,6 +201,9 @@ class LeadUtm(models.Model):
 
 
 class LeadOpenstat(models.Model):
+    URL_LABEL_TYPE = 'openstat'
+    URL_LABEL_FIELDS = ('service', 'campaign', 'ad', 'source')
+
     lead = models.ForeignKey(Lead, related_name='openstat', on_delete=CASCADE)
     service = models.CharField(max_length=255, null=True, blank=True, db_index=True)
     campaign = models.CharField(max_length=255, null=True, blank=True, db_index=True)
@@ -117,7 +212,11 @@ class LeadOpenstat(models.Model):
 
     @classmethod
     def parse_url(cls, url):
-        labels = parse_url_openstat(url)
+        """
+        :param url: url or utils.ad.AdUrl
+        :return: LeadOpenstat or None
+        """
+        labels = to_ad_url(url).openstat
         if labels is None:
             return None
         obj = cls()
@@ -125,6 +224,172 @@ class LeadOpenstat(models.Model):
         return obj
 
 
+# id: (label type, label name) of url labels kept in LeadUrlLabel
+URL_LABEL_KINDS = OrderedDict(
+    (kind, (model.URL_LABEL_TYPE, field_name))
+    for kind, (model, field_name) in enumerate((
+        (model, field_name) for model in (LeadUtm, LeadOpenstat) for field_name in model.URL_LABEL_FIELDS
+    ), start=1)
+)
+
+
+def url_label_kind(label_type, label_name):
+    """
+    :return: URL_LABEL_KINDS id or None
+    >>> url_label_kind('utm', 'utm_source'), url_label_kind('openstat', 'source')
+    (1, 9)
+    >>> url_label_kind('openstat', 'utm_source') is None
+    True
+    """
+    for kind, type_name in URL_LABEL_KINDS.items():
+        if type_name == (label_type, label_name):
+            return kind
+    return None
+
+
+class UrlLabelValue(models.Model):
+    """
+    Interned url label values, LeadUrlLabel refers them by id
+    """
+    label_kind = models.PositiveSmallIntegerField(choices=[
+        (kind, '{} {}'.format(*type_name)) for kind, type_name in URL_LABEL_KINDS.items()
+    ])
+    value = models.CharField(max_length=255)
+
+    # (label_kind, value): id, values are never deleted, cleared when it holds IDS_CACHE_SIZE ones
+    _ids = {}
+    IDS_CACHE_SIZE = 100000
+
+    class Meta:
+        unique_together = ('label_kind', 'value')
+
+    def __str__(self):
+        return self.value
+
+    @classmethod
+    def intern(cls, label_kind, value):
+        """
+        :return: id of value, created if it is new
+        """
+        key = (label_kind, value)
+        if key in cls._ids:
+            return cls._ids[key]
+        value_id = cls.objects.get_or_create(label_kind=label_kind, value=value)[0].id
+        # ids of values created by rolled back transaction must not be cached
+        transaction.on_commit(lambda: cls._remember(key, value_id))
+        return value_id
+
+    @classmethod
+    def _remember(cls, key, value_id):
+        if len(cls._ids) >= cls.IDS_CACHE_SIZE:
+            cls._ids.clear()
+        cls._ids.setdefault(key, value_id)
+
+
+class LeadUrlLabel(models.Model):
+    """
+    Inverted index of lead url labels (LeadUtm, LeadOpenstat) for analytics filters,
+    label filter of user leads in date range is a range scan of (user, label_kind, label_value, created)
+    """
+    user = models.ForeignKey(User, null=True, related_name='+', on_delete=SET_NULL, db_index=False)
+    label_kind = models.PositiveSmallIntegerField(choices=UrlLabelValue._meta.get_field('label_kind').choices)
+    label_value = models.ForeignKey(UrlLabelValue, related_name='+', on_delete=PROTECT, db_index=False)
+    # Lead.created
+    created = models.DateTimeField(null=True)
+    lead = models.ForeignKey(Lead, related_name='url_labels', on_delete=CASCADE, db_index=False)
+
+    class Meta:
+        unique_together = ('lead', 'label_kind')
+        index_together = ('user', 'label_kind', 'label_value', 'created', 'lead')
+
+    @classmethod
+    def from_lead_label(cls, lead_label):
+        """
+        :param lead_label: saved LeadUtm or LeadOpenstat
+        :return: list of not saved LeadUrlLabel of not empty label fields
+        """
+        lead = lead_label.lead
+        labels = []
+        for field_name in lead_label.URL_LABEL_FIELDS:
+            value = getattr(lead_label, field_name)
+            if not value:
+                continue
+            label_kind = url_label_kind(lead_label.URL_LABEL_TYPE, field_name)
+            labels.append(cls(
+                user_id=lead.user_id, label_kind=label_kind,
+                label_value_id=UrlLabelValue.intern(label_kind, value),
+                created=lead.created, lead=lead
+            ))
+        return labels
+
+
+class UserUrlLabel(models.Model):
+    """
+    Distinct url label values of user leads with count of leads for label autocomplete,
+    value is copied from UrlLabelValue for prefix index (user, label_kind, upper(value))
+    """
+    user = models.ForeignKey(User, related_name='+', on_delete=CASCADE, db_index=False)
+    label_kind = models.PositiveSmallIntegerField(choices=UrlLabelValue._meta.get_field('label_kind').choices)
+    label_value = models.ForeignKey(UrlLabelValue, related_name='+', on_delete=PROTECT, db_index=False)
+    value = models.CharField(max_length=255)
+    leads = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'label_kind', 'label_value')
+
+    ADD_LEADS_SQL = """
+        INSERT INTO collector_userurllabel (user_id, label_kind, label_value_id, value, leads)
+        SELECT v.user_id, v.label_kind, v.label_value_id, label_value.value, v.leads
+        FROM (VALUES {rows}) v (user_id, label_kind, label_value_id, leads)
+        JOIN collector_urllabelvalue label_value ON label_value.id = v.label_value_id
+        ORDER BY 1, 2, 3
+        ON CONFLICT (user_id, label_kind, label_value_id)
+        DO UPDATE SET leads = collector_userurllabel.leads + EXCLUDED.leads
+    """
+
+    REFRESH_USERS_SQL = """
+        INSERT INTO collector_userurllabel (user_id, label_kind, label_value_id, value, leads)
+        SELECT label.user_id, label.label_kind, label.label_value_id, label_value.value, COUNT(*)
+        FROM collector_leadurllabel label
+        JOIN collector_urllabelvalue label_value ON label_value.id = label.label_value_id
+        WHERE label.user_id = ANY(%s)
+        GROUP BY 1, 2, 3, 4
+    """
+
+    @classmethod
+    def add_lead_labels(cls, url_labels):
+        """
+        count new leads labels, rows are upserted in key order,
+        so parallel fill_leads workers do not deadlock
+        :param url_labels: iterable of saved LeadUrlLabel of new leads
+        """
+        counts = Counter(
+            (label.user_id, label.label_kind, label.label_value_id)
+            for label in url_labels if label.user_id is not None
+        )
+        if not counts:
+            return
+        keys = sorted(counts)
+        rows = ', '.join(['(%s, %s, %s, %s)'] * len(keys))
+        params = [param for key in keys for param in key + (counts[key],)]
+        with connection.cursor() as cursor:
+            cursor.execute(cls.ADD_LEADS_SQL.format(rows=rows), params)
+
+    @classmethod
+    @transaction.atomic()
+    def refresh_users(cls, user_ids):
+        """
+        recount labels of users from LeadUrlLabel
+        :param user_ids: iterable of user ids
+        """
+        user_ids = sorted(set(user_ids) - {None})
+        if not user_ids:
+            return
+        cls.objects.filter(user__in=user_ids).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(cls.REFRESH_USERS_SQL, [user_ids])
+
+
 LeadGroup = namedtuple('LeadGroup', ('title', 'operator', 'val1', 'val2'))
 
 LEAD_AGE_GROUPS = OrderedDict((
@@ -0,0 +1,19 @@
+from django.contrib.postgres.fields.jsonb import JSONField
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class EtlRun(models.Model):
+    """
+    Log of ETL command runs (fill_leads, fill_ip_stat) with per stage metrics
+    """
+    command = models.CharField(max_length=100, db_index=True)
+    started = models.DateTimeField(db_index=True)
+    finished = models.DateTimeField()
+    duration = models.FloatField(help_text=_('in seconds'))
+    rows = models.IntegerField(default=0, help_text=_('count of processed rows'))
+    failed = models.IntegerField(default=0, help_text=_('count of failed rows'))
+    stages = JSONField(default=dict, help_text=_('{stage: {time, rows, queries}}'))
+
+    def __str__(self):
+        return "{} {} {} rows in {}s".format(self.command, self.started, self.rows, self.duration)
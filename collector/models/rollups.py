@@ -0,0 +1,183 @@
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connection, models
+from django.db.models.deletion import CASCADE
+from django.utils import timezone
+
+from collector.models.dictionaries import OSGroup, BrowserGroup, DeviceType, TrafficChannel
+from collector.models.projects import Project, Pixel
+
+User = get_user_model()
+
+
+class LeadHourStat(models.Model):
+    """
+    Hourly rollup of converted leads (Lead.created is set) for dashboard widgets
+    One row per (pixel, hour, os group, browser group, device category, traffic channel,
+    duration group), maintained by fill_leads, see collector.rollups
+    """
+    # pixel may have no project
+    user = models.ForeignKey(User, null=True, related_name='+', on_delete=CASCADE)
+    project = models.ForeignKey(Project, null=True, related_name='+', on_delete=CASCADE)
+    pixel = models.ForeignKey(Pixel, related_name='+', on_delete=CASCADE)
+    # Lead.created truncated to hour
+    hour = models.DateTimeField()
+    os_group = models.ForeignKey(OSGroup, null=True, related_name='+', on_delete=CASCADE)
+    browser_group = models.ForeignKey(BrowserGroup, null=True, related_name='+', on_delete=CASCADE)
+    device_category = models.PositiveSmallIntegerField(choices=DeviceType.TYPES, null=True)
+    traffic_channel = models.ForeignKey(TrafficChannel, null=True, related_name='+', on_delete=CASCADE)
+    # LEAD_DURATION_GROUPS key or 'Others'
+    duration_group = models.CharField(max_length=50)
+    leads = models.IntegerField(default=0)
+    salecount = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = (('user', 'hour'), ('pixel', 'hour'))
+
+    def __str__(self):
+        return "Pixel {} {}: {} leads".format(self.pixel_id, self.hour, self.leads)
+
+
+class LeadHourSketch(models.Model):
+    """
+    HyperLogLog sketches (utils.hll) of device_id and subnet of converted leads
+    per pixel and created hour, merged for approximate distinct counts of any range
+    """
+    user = models.ForeignKey(User, null=True, related_name='+', on_delete=CASCADE)
+    project = models.ForeignKey(Project, null=True, related_name='+', on_delete=CASCADE)
+    pixel = models.ForeignKey(Pixel, related_name='+', on_delete=CASCADE)
+    hour = models.DateTimeField()
+    devices = models.BinaryField()
+    subnets = models.BinaryField()
+
+    class Meta:
+        index_together = (('user', 'hour'), ('pixel', 'hour'))
+
+    def __str__(self):
+        return "Pixel {} {} sketch".format(self.pixel_id, self.hour)
+
+
+# LeadPeriodSketch units, days and months are utc
+SKETCH_UNITS = ('day', 'month')
+
+
+class LeadPeriodSketch(models.Model):
+    """
+    LeadHourSketch of pixel merged per utc day and month, distinct counts of long ranges
+    merge the coarsest sketches covering the range, maintained together with hourly ones
+    """
+    user = models.ForeignKey(User, null=True, related_name='+', on_delete=CASCADE)
+    project = models.ForeignKey(Project, null=True, related_name='+', on_delete=CASCADE)
+    pixel = models.ForeignKey(Pixel, related_name='+', on_delete=CASCADE, db_index=False)
+    unit = models.CharField(max_length=5, choices=[(unit, unit) for unit in SKETCH_UNITS])
+    # start of utc day or month
+    started = models.DateTimeField()
+    devices = models.BinaryField()
+    subnets = models.BinaryField()
+
+    class Meta:
+        unique_together = ('pixel', 'unit', 'started')
+        index_together = ('user', 'unit', 'started')
+
+    def __str__(self):
+        return "Pixel {} {} {} sketch".format(self.pixel_id, self.unit, self.started)
+
+    @staticmethod
+    def period_start(value, unit):
+        """
+        :param value: aware datetime
+        :return: start of utc day or month of value
+        >>> from datetime import datetime
+        >>> from django.utils import timezone
+        >>> LeadPeriodSketch.period_start(datetime(2018, 3, 5, 15, 42, tzinfo=timezone.utc), 'month')
+        datetime.datetime(2018, 3, 1, 0, 0, tzinfo=<UTC>)
+        """
+        value = value.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        return value.replace(day=1) if unit == 'month' else value
+
+    @staticmethod
+    def period_end(started, unit):
+        """
+        :param started: period_start
+        :return: start of the next period
+        >>> from datetime import datetime
+        >>> LeadPeriodSketch.period_end(datetime(2018, 12, 1), 'month')
+        datetime.datetime(2019, 1, 1, 0, 0)
+        """
+        if unit == 'day':
+            return started + timedelta(days=1)
+        return (started + timedelta(days=32)).replace(day=1)
+
+
+# LeadPeriodTotal units, days are utc
+TOTAL_UNITS = ('hour', 'day')
+
+
+class _PeriodTotal(models.Model):
+    unit = models.CharField(max_length=4, choices=[(unit, unit) for unit in TOTAL_UNITS])
+    # start of hour or utc day
+    started = models.DateTimeField()
+    leads = models.IntegerField(default=0)
+    salecount = models.IntegerField(default=0)
+
+    # unique columns, conflict target of ADD_SQL
+    KEY_COLUMNS = None
+
+    ADD_SQL = """
+        INSERT INTO {table} ({columns}, leads, salecount)
+        VALUES {rows}
+        ON CONFLICT ({columns}) DO UPDATE
+        SET leads = {table}.leads + EXCLUDED.leads, salecount = {table}.salecount + EXCLUDED.salecount
+    """
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def add(cls, deltas):
+        """
+        add deltas to totals, rows are upserted in key order,
+        so parallel fill_leads workers do not deadlock
+        :param deltas: {key columns tuple: (leads, salecount)}
+        """
+        keys = sorted(key for key, value in deltas.items() if any(value))
+        if not keys:
+            return
+        placeholders = '({})'.format(', '.join(['%s'] * (len(cls.KEY_COLUMNS) + 2)))
+        sql = cls.ADD_SQL.format(
+            table=cls._meta.db_table, columns=', '.join(cls.KEY_COLUMNS),
+            rows=', '.join([placeholders] * len(keys))
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [param for key in keys for param in key + tuple(deltas[key])])
+
+
+class LeadPeriodTotal(_PeriodTotal):
+    """
+    Converted leads of all users per hour and utc day, market-wide lineage
+    of other users is the total minus LeadUserPeriodTotal of the user,
+    maintained together with LeadHourStat, see collector.rollups
+    """
+    KEY_COLUMNS = ('unit', 'started')
+
+    class Meta:
+        unique_together = ('unit', 'started')
+
+    def __str__(self):
+        return "{} {}: {} leads".format(self.unit, self.started, self.leads)
+
+
+class LeadUserPeriodTotal(_PeriodTotal):
+    """
+    Converted leads of user per hour and utc day, see LeadPeriodTotal
+    """
+    user = models.ForeignKey(User, related_name='+', on_delete=CASCADE, db_index=False)
+
+    KEY_COLUMNS = ('user_id', 'unit', 'started')
+
+    class Meta:
+        unique_together = ('user', 'unit', 'started')
+
+    def __str__(self):
+        return "User {} {} {}: {} leads".format(self.user_id, self.unit, self.started, self.leads)
@@ -4,18 +4,32 @@ from django.db.transaction import atomic
 from django.utils.translation import ugettext as _
 from django.contrib.auth import get_user_model
 from graphene_django import DjangoObjectType
-from collector.models import Project, Pixel
+from collector.models import Project, Pixel, Lead
+from utils.dataloader import ModelLoader, RelatedLoader, get_loader
 
 User = get_user_model()
 
 
+def pixel_loader(info):
+    return get_loader(info, 'pixel', lambda: ModelLoader(Pixel.objects.all()))
+
+
+def project_loader(info):
+    return get_loader(info, 'project', lambda: ModelLoader(Project.objects.all()))
+
+
+def project_pixels_loader(info):
+    return get_loader(info, 'project_pixels',
+                      lambda: RelatedLoader(Pixel.objects.filter(removed=False), 'project'))
+
+
 class ProjectType(DjangoObjectType):
     class Meta:
         model = Project
         only_fields = ('id','title', 'pixels')
 
     def resolve_pixels(self, info):
-        return self.pixels.all().filter(removed=False)
+        return project_pixels_loader(info).load(self.id)
 
 
 class PixelType(DjangoObjectType):
@@ -24,6 +38,16 @@ class PixelType(DjangoObjectType):
     class Meta:
         model = Pixel
 
+    def resolve_project(self, info):
+        if self.project_id is None:
+            # project was deleted
+            return None
+        return project_loader(info).load(self.project_id)
+
+    def resolve_leads(self, info):
+        return get_loader(info, 'pixel_leads', lambda: RelatedLoader(Lead.objects.all(), 'pixel'))\
+            .load(self.id)
+
     def resolve_code(self, info):
         host = info.context.get_host() or 'dev-api.conduster.com'
         no_data = ', nodata: true' if not self.save_client_data else ''
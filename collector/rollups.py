@@ -0,0 +1,259 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from django.db.models.aggregates import Count, Sum
+from django.db.models.expressions import ExpressionWrapper, F
+from django.db.models.fields import DurationField
+from django.db.models.functions.datetime import TruncHour
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from collector.analytics import _lead_duration_groups_case
+from collector.models import Lead, LeadHourStat, LeadHourSketch, LeadPeriodSketch, LeadPeriodTotal, \
+    LeadUserPeriodTotal
+from utils.db import pg_advisory_xact_lock
+from utils.hll import HyperLogLog
+
+ONE_HOUR = timedelta(hours=1)
+
+# LeadHourStat field: Lead values() path
+LEAD_HOUR_STAT_KEYS = (
+    ('user_id', 'user'),
+    ('project_id', 'project'),
+    ('pixel_id', 'pixel'),
+    ('hour', 'hour'),
+    ('os_group_id', 'os_group'),
+    ('browser_group_id', 'browser_group'),
+    ('device_category', 'device_category'),
+    ('traffic_channel_id', 'traffic_channel'),
+    ('duration_group', 'duration_group'),
+)
+
+
+def truncate_hour(value):
+    """
+    :param value: aware datetime
+    :return: datetime truncated to utc hour
+    >>> truncate_hour(datetime(2018, 3, 1, 15, 42, 7, 15, tzinfo=timezone.utc))
+    datetime.datetime(2018, 3, 1, 15, 0, tzinfo=<UTC>)
+    """
+    return value.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def lead_pixel_hours(leads):
+    """
+    :param leads: iterable of Lead
+    :return: set of (pixel_id, hour) rollup slices of converted leads
+    """
+    return {(lead.pixel_id, truncate_hour(lead.created)) for lead in leads if lead.created}
+
+
+def _aggregate_leads(leads_qs):
+    """
+    group leads by LeadHourStat keys
+    :param leads_qs: Lead QuerySet
+    :return: list of not saved LeadHourStat
+    """
+    leads_qs = leads_qs.filter(created__isnull=False)
+    leads_qs = leads_qs.annotate(hour=TruncHour('created'))
+    leads_qs = leads_qs.annotate(lead_duration=ExpressionWrapper(
+        F('created') - F('session_started'), output_field=DurationField()
+    ))
+    leads_qs = leads_qs.annotate(duration_group=_lead_duration_groups_case())
+    leads_qs = leads_qs.values(*(path for _, path in LEAD_HOUR_STAT_KEYS))
+    leads_qs = leads_qs.annotate(leads=Count('id'), salecount=Sum('metrik_lead_salecount'))
+    leads_qs = leads_qs.order_by()
+    return [
+        LeadHourStat(
+            leads=row['leads'], salecount=row['salecount'] or 0,
+            **{field: row[path] for field, path in LEAD_HOUR_STAT_KEYS}
+        ) for row in leads_qs
+    ]
+
+
+def _sketch_leads(leads_qs):
+    """
+    build device and subnet sketches of leads per pixel and hour
+    :param leads_qs: Lead QuerySet
+    :return: list of not saved LeadHourSketch
+    """
+    leads_qs = leads_qs.filter(created__isnull=False)
+    leads_qs = leads_qs.annotate(hour=TruncHour('created'))
+    leads_qs = leads_qs.values_list('user', 'project', 'pixel', 'hour', 'device_id', 'subnet')
+    sketches = {}
+    for user_id, project_id, pixel_id, hour, device_id, subnet in leads_qs.order_by().iterator():
+        key = (user_id, project_id, pixel_id, hour)
+        if key not in sketches:
+            sketches[key] = (HyperLogLog(), HyperLogLog())
+        sketches[key][0].add(device_id)
+        sketches[key][1].add(subnet)
+    return [
+        LeadHourSketch(
+            user_id=user_id, project_id=project_id, pixel_id=pixel_id, hour=hour,
+            devices=devices.to_bytes(), subnets=subnets.to_bytes()
+        ) for (user_id, project_id, pixel_id, hour), (devices, subnets) in sketches.items()
+    ]
+
+
+def _periods_filter(field, unit, pixel_ids=None, date_from=None, date_to=None):
+    """
+    :param field: time field of filtered sketches
+    :param unit: LeadPeriodSketch unit
+    :return: Q of sketches of pixels in whole utc periods covering range
+    """
+    periods_filter = Q()
+    if pixel_ids:
+        periods_filter &= Q(pixel_id__in=tuple(pixel_ids))
+    if date_from:
+        periods_filter &= Q(**{field + '__gte': LeadPeriodSketch.period_start(date_from, unit)})
+    if date_to:
+        started = LeadPeriodSketch.period_start(date_to, unit)
+        periods_filter &= Q(**{field + '__lt': LeadPeriodSketch.period_end(started, unit)})
+    return periods_filter
+
+
+def _merge_sketches(unit, sketch_qs, field):
+    """
+    merge sketches per pixel and utc period, sketches are streamed
+    :param sketch_qs: LeadHourSketch or LeadPeriodSketch QuerySet
+    :param field: time field of sketch_qs
+    :return: generator of not saved LeadPeriodSketch
+    """
+    rows = sketch_qs.values_list('user', 'project', 'pixel', field, 'devices', 'subnets').order_by('pixel', field)
+    period = None
+    for user_id, project_id, pixel_id, started, devices, subnets in rows.iterator():
+        key = (pixel_id, LeadPeriodSketch.period_start(started, unit))
+        if period is None or period.pixel_id != key[0] or period.started != key[1]:
+            if period is not None:
+                yield period
+            period = LeadPeriodSketch(user_id=user_id, project_id=project_id, pixel_id=key[0],
+                                      unit=unit, started=key[1])
+            period.devices, period.subnets = HyperLogLog(), HyperLogLog()
+        period.devices.merge_bytes(devices)
+        period.subnets.merge_bytes(subnets)
+    if period is not None:
+        yield period
+
+
+def _refresh_period_sketches(ranges):
+    """
+    re-merge day sketches from hourly ones and month sketches from day ones,
+    sketches can not subtract, so whole periods are merged again
+    :param ranges: list of (pixel_ids, date_from, date_to) of refreshed hours, None is not limited
+    """
+    sources = (('day', LeadHourSketch.objects.all(), 'hour'),
+               ('month', LeadPeriodSketch.objects.filter(unit='day'), 'started'))
+    for unit, sources_qs, field in sources:
+        LeadPeriodSketch.objects.filter(
+            reduce(or_, (_periods_filter('started', unit, *period) for period in ranges)), unit=unit
+        ).delete()
+        sketches = []
+        for sketch in _merge_sketches(unit, sources_qs.filter(
+                reduce(or_, (_periods_filter(field, unit, *period) for period in ranges))), field):
+            sketch.devices, sketch.subnets = sketch.devices.to_bytes(), sketch.subnets.to_bytes()
+            sketches.append(sketch)
+        LeadPeriodSketch.objects.bulk_create(sketches, batch_size=1000)
+
+
+def _stat_totals(stats):
+    """
+    :param stats: iterable of LeadHourStat
+    :return: {(user_id, hour): [leads, salecount]}
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for stat in stats:
+        total = totals[(stat.user_id, stat.hour)]
+        total[0] += stat.leads
+        total[1] += stat.salecount
+    return totals
+
+
+def _add_period_totals(old_stats, new_stats):
+    """
+    move LeadPeriodTotal and LeadUserPeriodTotal by difference of replaced rollup rows
+    :param old_stats: deleted LeadHourStat
+    :param new_stats: created LeadHourStat
+    """
+    deltas = _stat_totals(new_stats)
+    for key, (leads, salecount) in _stat_totals(old_stats).items():
+        deltas[key][0] -= leads
+        deltas[key][1] -= salecount
+    totals = defaultdict(lambda: [0, 0])
+    user_totals = defaultdict(lambda: [0, 0])
+    for (user_id, hour), (leads, salecount) in deltas.items():
+        hour = hour.astimezone(timezone.utc)
+        for unit, started in (('hour', hour), ('day', hour.replace(hour=0))):
+            for total in (totals[(unit, started)], user_totals[(user_id, unit, started)]):
+                total[0] += leads
+                total[1] += salecount
+    LeadPeriodTotal.add(totals)
+    LeadUserPeriodTotal.add({key: value for key, value in user_totals.items() if key[0] is not None})
+
+
+@atomic()
+def refresh_lead_hour_stat(pixel_hours):
+    """
+    recalc rollup and sketch slices from leads, period totals are moved by difference, slices are locked by pixel
+    so parallel fill_leads workers do not double count
+    :param pixel_hours: iterable of (pixel_id, hour), see lead_pixel_hours
+    :return: count of rollup rows
+    """
+    pixel_hours = set(pixel_hours)
+    if not pixel_hours:
+        return 0
+    pg_advisory_xact_lock('lead_hour_stat', shared=True)
+    for pixel_id in sorted({str(pixel_id) for pixel_id, _ in pixel_hours}):
+        pg_advisory_xact_lock('lead_hour_stat:' + pixel_id)
+
+    stat_filter = Q()
+    leads_filter = Q()
+    for pixel_id, hour in pixel_hours:
+        stat_filter |= Q(pixel_id=pixel_id, hour=hour)
+        leads_filter |= Q(pixel_id=pixel_id, created__gte=hour, created__lt=hour + ONE_HOUR)
+    old_stats = list(LeadHourStat.objects.filter(stat_filter).only('user', 'hour', 'leads', 'salecount'))
+    LeadHourStat.objects.filter(stat_filter).delete()
+    LeadHourSketch.objects.filter(stat_filter).delete()
+    stats = _aggregate_leads(Lead.objects.filter(leads_filter))
+    LeadHourStat.objects.bulk_create(stats)
+    _add_period_totals(old_stats, stats)
+    LeadHourSketch.objects.bulk_create(_sketch_leads(Lead.objects.filter(leads_filter)))
+    pixel_days = {(pixel_id, LeadPeriodSketch.period_start(hour, 'day')) for pixel_id, hour in pixel_hours}
+    _refresh_period_sketches([([pixel_id], day, day) for pixel_id, day in sorted(pixel_days)])
+    return len(stats)
+
+
+@atomic()
+def rebuild_lead_hour_stat(date_from=None, date_to=None, pixel_ids=None):
+    """
+    rebuild all rollups and sketches of leads created in range
+    :param date_from: datetime, truncated to hour
+    :param date_to: datetime
+    :param pixel_ids: list of pixel ids, all pixels by default
+    :return: count of rollup rows
+    """
+    # wait for running refreshes
+    pg_advisory_xact_lock('lead_hour_stat')
+    stats_filter = Q()
+    leads_qs = Lead.objects.all()
+    if date_from:
+        stats_filter &= Q(hour__gte=truncate_hour(date_from))
+        leads_qs = leads_qs.filter(created__gte=truncate_hour(date_from))
+    if date_to:
+        stats_filter &= Q(hour__lte=date_to)
+        leads_qs = leads_qs.filter(created__lt=truncate_hour(date_to) + ONE_HOUR)
+    if pixel_ids:
+        stats_filter &= Q(pixel_id__in=tuple(pixel_ids))
+        leads_qs = leads_qs.filter(pixel_id__in=tuple(pixel_ids))
+    old_stats = LeadHourStat.objects.filter(stats_filter).only('user', 'hour', 'leads', 'salecount')
+    old_stats = list(old_stats.iterator())
+    LeadHourStat.objects.filter(stats_filter).delete()
+    LeadHourSketch.objects.filter(stats_filter).delete()
+    stats = _aggregate_leads(leads_qs)
+    LeadHourStat.objects.bulk_create(stats, batch_size=1000)
+    _add_period_totals(old_stats, stats)
+    LeadHourSketch.objects.bulk_create(_sketch_leads(leads_qs), batch_size=1000)
+    _refresh_period_sketches([(pixel_ids, date_from, date_to)])
+    return len(stats)
@@ -0,0 +1,438 @@
+"""
+Synthetic leads for load tests and benchmarks
+
+generate_leads writes millions of Lead, LeadField, LeadUtm, LeadUrlLabel and
+Audit rows of synthetic users with COPY. Columns of a chunk of leads are
+sampled with NumPy and formatted as COPY text with vectorised string
+operations, no model instances are created per lead:
+
+- lead volume of users follows Zipf law, leads follow daily and weekly traffic curves
+- devices and persons (form fields) are reused with Zipf law, so leads have
+  repeated devices (consumer origin) and duplicates (audits)
+- converted leads are sold to sales users (Audit, metrik_lead_salecount)
+
+Rollups, user url labels and analytics cache of generated users are updated
+after all chunks. The generator is seeded, the same arguments generate the same
+dataset.
+"""
+import io
+import zlib
+from collections import OrderedDict
+from datetime import timedelta
+from functools import reduce
+
+import numpy
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from audit.models import Audit, DuplicationRequiredFieldSet
+from collector.analytics_cache import invalidate_users
+from collector.management.commands.fill_test_leads import AD_NETWORKS, MAX_PARTNERS
+from collector.models import Lead, LeadField, LeadUtm, LeadUrlLabel, Project, Pixel, FieldMapping, \
+    UrlLabelValue, UserUrlLabel, url_label_kind
+from collector.models.dictionaries import City, OS, BrowserVersion, Device, TrafficChannel, Field
+from collector.rollups import rebuild_lead_hour_stat, truncate_hour
+
+User = get_user_model()
+
+CHUNK_SIZE = 200000
+
+# share of leads per hour of day, utc
+HOUR_WEIGHTS = (2, 1, 1, 1, 1, 2, 3, 5, 7, 8, 9, 9, 9, 9, 9, 9, 9, 9, 10, 11, 11, 9, 6, 4)
+# share of leads per day of week, monday first
+WEEKDAY_WEIGHTS = (10, 10, 10, 10, 9, 7, 7)
+# exponents of Zipf law of users volume, device and person reuse
+USER_ZIPF = 1.0
+REUSE_ZIPF = 1.1
+# rank offset of reuse law (Zipf-Mandelbrot), flattens the head so the most
+# frequent device or person has hundredths of percent of leads, not a quarter
+REUSE_OFFSET = 100
+# log-normal session duration, median seconds
+SESSION_MEDIAN = 120
+SESSION_SIGMA = 1.0
+CONVERSION_RATE = 0.6
+# probability of each sales user to buy a converted lead
+SALE_RATE = 0.1
+UTM_RATE = 2 / 3
+UTM_CONTENT_RATE = 2 / 3
+
+FIELD_NAMES = ('email', 'phone', 'name')
+NAMES = ('anna', 'ivan', 'maria', 'sergey', 'elena', 'dmitry', 'olga', 'alexey', 'natalia', 'pavel')
+
+_HEX = None
+NULL = '\\N'
+
+
+def _hex(data):
+    """
+    :param data: uint8 array of shape (n, bytes)
+    :return: str array of hex of rows
+    """
+    global _HEX
+    if _HEX is None:
+        _HEX = numpy.array(list('0123456789abcdef'))
+    chars = numpy.empty((len(data), data.shape[1] * 2), '<U1')
+    chars[:, 0::2] = _HEX[data >> 4]
+    chars[:, 1::2] = _HEX[data & 15]
+    return numpy.ascontiguousarray(chars).view('<U{}'.format(chars.shape[1])).ravel()
+
+
+def _text(values, nulls=None):
+    """
+    :param values: array
+    :param nulls: boolean array of NULL values
+    :return: str array of COPY text values
+    """
+    values = values.astype(str)
+    if nulls is not None:
+        values = numpy.where(nulls, NULL, values)
+    return values
+
+
+def _timestamps(microseconds, nulls=None):
+    """
+    :param microseconds: int64 array of microseconds since epoch
+    """
+    values = numpy.char.add(microseconds.astype('datetime64[us]').astype(str), '+00')
+    if nulls is not None:
+        values = numpy.where(nulls, NULL, values)
+    return values
+
+
+def _ips(ip_ints):
+    """
+    >>> list(_ips(numpy.array([3232235777], 'uint32')))
+    ['192.168.1.1']
+    """
+    octets = [_text((ip_ints >> shift) & 255) for shift in (24, 16, 8, 0)]
+    return reduce(lambda a, b: numpy.char.add(numpy.char.add(a, '.'), b), octets)
+
+
+def _copy(cursor, table, columns):
+    """
+    :param columns: OrderedDict of column name: str array of COPY text values
+    """
+    lines = reduce(lambda a, b: numpy.char.add(numpy.char.add(a, '\t'), b), columns.values())
+    data = io.StringIO('\n'.join(lines.tolist()) + '\n')
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), data)
+
+
+def _reuse_weights(size):
+    """
+    >>> weights = _reuse_weights(1000)
+    >>> round(weights.sum(), 6), weights[0] > weights[1] > weights[-1]
+    (1.0, True)
+    """
+    return _weights((numpy.arange(size) + REUSE_OFFSET) ** -REUSE_ZIPF)
+
+
+def _weights(values):
+    values = numpy.array(values, 'float64')
+    return values / values.sum()
+
+
+def _person_fields(persons):
+    """
+    form fields of persons, hashes are made per unique person
+    :param persons: int array of person ids
+    :return: {field name: (data array, hash array)}
+    """
+    unique, inverse = numpy.unique(persons, return_inverse=True)
+    data = OrderedDict((
+        ('email', numpy.char.add(numpy.char.add('person', unique.astype(str)), '@example.com')),
+        ('phone', numpy.char.add('+7', (9000000000 + unique).astype(str))),
+        ('name', numpy.array(NAMES)[unique % len(NAMES)]),
+    ))
+    fields = OrderedDict()
+    for field_name, values in data.items():
+        hashes = numpy.array([LeadField.make_field_data_hash(value) for value in values.tolist()])
+        fields[field_name] = (values[inverse], hashes[inverse])
+    return fields
+
+
+class _Dictionary(object):
+    """
+    ids of dictionary rows with related filter column of Lead
+    """
+    def __init__(self, values):
+        values = list(values)
+        self.ids = numpy.array([row[0] for row in values], 'int64')
+        self.related = numpy.array([-1 if row[1] is None else row[1] for row in values], 'int64')
+
+    def sample(self, random, count):
+        """
+        :return: (id text, related id text), NULL if dictionary is empty
+        """
+        if not len(self.ids):
+            return numpy.full(count, NULL), numpy.full(count, NULL)
+        index = random.randint(0, len(self.ids), count)
+        related = self.related[index]
+        return _text(self.ids[index]), _text(related, related < 0)
+
+
+class SyntheticDataset(object):
+    """
+    synthetic users with projects and pixels, leads are added by chunks
+    """
+    def __init__(self, prefix='synthetic', users=10, sales_users=3, projects=2, pixels=3, seed=0):
+        self.prefix = prefix
+        self.random = numpy.random.RandomState()
+        self.seed(seed)
+        self.users = [self._user('{}-{}@example.com'.format(prefix, i)) for i in range(users)]
+        self.sales_users = [self._user('{}-sales-{}@example.com'.format(prefix, i))
+                            for i in range(sales_users)]
+        fields = [Field.objects.get_or_create(name=name)[0] for name in FIELD_NAMES]
+        if not DuplicationRequiredFieldSet.objects.filter(name=prefix).exists():
+            DuplicationRequiredFieldSet.objects.create(name=prefix).fields.set(fields[:2])
+        # pixels of users: (pixel id, project id, user id)
+        self.pixels = []
+        for user in self.users:
+            for i in range(projects):
+                project = Project.objects.get_or_create(user=user, title='{} {}'.format(prefix, i))[0]
+                for j in range(pixels):
+                    pixel = Pixel.objects.get_or_create(project=project, title='{} {}'.format(prefix, j))[0]
+                    for field in fields:
+                        FieldMapping.objects.get_or_create(
+                            pixel=pixel, target_field=field,
+                            defaults={'html_tag': 'input', 'html_attr_name': 'name',
+                                      'html_attr_value': field.name, 'required': True}
+                        )
+                    self.pixels.append((pixel.id, project.id, user.id))
+        self.user_weights = _weights(1 / numpy.arange(1, users + 1) ** USER_ZIPF)
+
+        self.cities = numpy.array(City.objects.values_list('id', flat=True) or [-1], 'int64')
+        self.os_versions = _Dictionary(OS.objects.values_list('id', 'family__group_id'))
+        self.browsers = _Dictionary(BrowserVersion.objects.values_list('id', 'family__group_id'))
+        self.devices = _Dictionary(Device.objects.values_list('id', 'device_type__category'))
+        self.traffic_channels = _Dictionary((channel_id, None) for channel_id in
+                                            TrafficChannel.objects.values_list('id', flat=True))
+        self.labels = {}
+        for label_name, values in (('utm_source', AD_NETWORKS),
+                                   ('utm_content', [str(i) for i in range(1, MAX_PARTNERS + 1)])):
+            label_kind = url_label_kind('utm', label_name)
+            self.labels[label_name] = (label_kind, numpy.array(values), numpy.array([
+                UrlLabelValue.objects.get_or_create(label_kind=label_kind, value=value)[0].id
+                for value in values
+            ]))
+
+    def seed(self, seed):
+        """
+        seed random state, datasets of other prefixes get other lead ids
+        """
+        self.random.seed([seed, zlib.crc32(self.prefix.encode())])
+
+    @staticmethod
+    def _user(username):
+        return User.objects.get_or_create(username=username, defaults={'email': username})[0]
+
+    @property
+    def user_ids(self):
+        return [user.id for user in self.users]
+
+    def lead_count(self):
+        return Lead.objects.filter(user__in=self.user_ids).count()
+
+    def _sample_pixels(self, count):
+        pixels_per_user = len(self.pixels) // len(self.users)
+        users = self.random.choice(len(self.users), count, p=self.user_weights)
+        index = users * pixels_per_user + self.random.randint(0, pixels_per_user, count)
+        pixel_ids, project_ids, user_ids = zip(*self.pixels)
+        pixel_ids = numpy.array([pixel_id.hex for pixel_id in pixel_ids])
+        project_ids = numpy.array([project_id.hex for project_id in project_ids])
+        return pixel_ids[index], project_ids[index], numpy.array(user_ids)[index]
+
+    def _sample_started(self, count, date_from, days):
+        """
+        :return: int64 microseconds since epoch of session start
+        """
+        first_day = date_from.replace(hour=0, minute=0, second=0, microsecond=0)
+        day_weights = _weights([WEEKDAY_WEIGHTS[(first_day + timedelta(days=day)).weekday()]
+                                for day in range(days)])
+        day = self.random.choice(days, count, p=day_weights)
+        hour = self.random.choice(24, count, p=_weights(HOUR_WEIGHTS))
+        first_us = int(first_day.timestamp()) * 10 ** 6
+        return first_us + ((day * 24 + hour) * 3600 + self.random.random_sample(count) * 3600)\
+            .astype('int64') * 10 ** 6
+
+    def add_leads(self, count, date_from, days, pool):
+        """
+        write chunk of leads
+        :param pool: count of distinct devices and persons
+        :return: {table: rows}
+        """
+        random = self.random
+        lead_ids = random.randint(0, 256, (count, 16)).astype('uint8')
+        # uuid4 version and variant bits
+        lead_ids[:, 6] = lead_ids[:, 6] & 0x0f | 0x40
+        lead_ids[:, 8] = lead_ids[:, 8] & 0x3f | 0x80
+        lead_ids = _hex(lead_ids)
+        pixel_ids, project_ids, user_ids = self._sample_pixels(count)
+
+        started = self._sample_started(count, date_from, days)
+        duration = numpy.clip(random.lognormal(numpy.log(SESSION_MEDIAN), SESSION_SIGMA, count), 5, 86400)
+        duration = duration.astype('int64')
+        ended = started + duration * 10 ** 6
+        not_converted = random.random_sample(count) >= CONVERSION_RATE
+
+        reuse_weights = _reuse_weights(pool)
+        devices = random.choice(pool, count, p=reuse_weights).astype('uint64')
+        device_hashes = (devices * numpy.uint64(0x9E3779B97F4A7C15)).view('uint8').reshape(count, 8)
+        ip_ints = (devices * numpy.uint64(2654435761) + numpy.uint64(0x5F000000)) & numpy.uint64(0xffffffff)
+        cities = self.cities[(devices % numpy.uint64(len(self.cities))).astype('int64')]
+
+        salecount = numpy.zeros(count, 'int64')
+        audit_leads = []
+        for user in self.sales_users:
+            sold = ~not_converted & (random.random_sample(count) < SALE_RATE)
+            salecount += sold
+            audit_leads.append(numpy.flatnonzero(sold))
+
+        os_versions, os_groups = self.os_versions.sample(random, count)
+        browsers, browser_groups = self.browsers.sample(random, count)
+        device_models, device_categories = self.devices.sample(random, count)
+        traffic_channels, _ = self.traffic_channels.sample(random, count)
+        now = _timestamps(numpy.full(count, int(timezone.now().timestamp() * 10 ** 6), 'int64'))
+        created = _timestamps(ended, not_converted)
+
+        rows = OrderedDict()
+        with connection.cursor() as cursor:
+            _copy(cursor, Lead._meta.db_table, OrderedDict((
+                ('id', lead_ids),
+                ('pixel_id', pixel_ids),
+                ('session_started', _timestamps(started)),
+                ('device_id', _hex(device_hashes)),
+                ('ip_addr', _ips(ip_ints)),
+                ('subnet', _ips(ip_ints & numpy.uint64(0xffffff00))),
+                ('geo_id', _text(cities, cities < 0)),
+                ('os_version_id', os_versions),
+                ('browser_id', browsers),
+                ('device_model_id', device_models),
+                ('traffic_channel_id', traffic_channels),
+                ('last_event_time', _timestamps(ended)),
+                ('created', created),
+                ('metrik_lead_duration', _text(duration)),
+                ('metrik_lead_salecount', _text(salecount)),
+                ('user_id', _text(user_ids)),
+                ('project_id', project_ids),
+                ('os_group_id', os_groups),
+                ('browser_group_id', browser_groups),
+                ('device_category', device_categories),
+                ('updated', now),
+            )))
+            rows[Lead._meta.db_table] = count
+
+            # form fields of converted leads
+            converted = numpy.flatnonzero(~not_converted)
+            persons = random.choice(pool, len(converted), p=reuse_weights)
+            fields = _person_fields(persons)
+            _copy(cursor, LeadField._meta.db_table, OrderedDict((
+                ('lead_id', numpy.tile(lead_ids[converted], len(fields))),
+                ('field_name', numpy.repeat(list(fields), len(converted))),
+                ('field_hash', numpy.concatenate([hashes for _, hashes in fields.values()])),
+                ('field_data', numpy.concatenate([values for values, _ in fields.values()])),
+            )))
+            rows[LeadField._meta.db_table] = len(converted) * len(fields)
+
+            rows.update(self._add_utm(cursor, lead_ids, user_ids, created))
+            rows.update(self._add_audits(cursor, lead_ids, ended, audit_leads))
+        return rows
+
+    def _add_utm(self, cursor, lead_ids, user_ids, created):
+        random = self.random
+        count = len(lead_ids)
+        with_utm = numpy.flatnonzero(random.random_sample(count) < UTM_RATE)
+        source_kind, source_values, source_ids = self.labels['utm_source']
+        content_kind, content_values, content_ids = self.labels['utm_content']
+        sources = random.randint(0, len(source_values), len(with_utm))
+        contents = random.randint(0, len(content_values), len(with_utm))
+        no_content = random.random_sample(len(with_utm)) >= UTM_CONTENT_RATE
+        _copy(cursor, LeadUtm._meta.db_table, OrderedDict((
+            ('lead_id', lead_ids[with_utm]),
+            ('utm_source', source_values[sources]),
+            ('utm_content', numpy.where(no_content, NULL, content_values[contents])),
+        )))
+        # inverted index of labels, see LeadUrlLabel.from_lead_label
+        with_content = ~no_content
+        labels = numpy.concatenate((with_utm, with_utm[with_content]))
+        _copy(cursor, LeadUrlLabel._meta.db_table, OrderedDict((
+            ('user_id', _text(user_ids[labels])),
+            ('label_kind', _text(numpy.repeat([source_kind, content_kind],
+                                              [len(with_utm), int(with_content.sum())]))),
+            ('label_value_id', _text(numpy.concatenate((source_ids[sources],
+                                                        content_ids[contents[with_content]])))),
+            ('created', created[labels]),
+            ('lead_id', lead_ids[labels]),
+        )))
+        return {LeadUtm._meta.db_table: len(with_utm), LeadUrlLabel._meta.db_table: len(labels)}
+
+    def _add_audits(self, cursor, lead_ids, ended, audit_leads):
+        count = sum(len(leads) for leads in audit_leads)
+        if not count:
+            return {}
+        # reserve block of audit ids
+        sequence = "pg_get_serial_sequence('{}', 'id')".format(Audit._meta.db_table)
+        cursor.execute('SELECT setval({0}, nextval({0}) + %s)'.format(sequence), [count - 1])
+        last_id = cursor.fetchone()[0]
+        audit_ids = _text(numpy.arange(last_id - count + 1, last_id + 1))
+        leads = numpy.concatenate(audit_leads)
+        user_ids = numpy.repeat([user.id for user in self.sales_users], [len(sold) for sold in audit_leads])
+        # sold in 5 days after lead
+        processed = ended[leads] + self.random.randint(0, 5 * 86400, count).astype('int64') * 10 ** 6
+        _copy(cursor, Audit._meta.db_table, OrderedDict((
+            ('id', audit_ids),
+            ('processed', _timestamps(processed)),
+            ('user_id', _text(user_ids)),
+            ('method', numpy.full(count, 'test_sale')),
+            ('input_data', numpy.full(count, '{}')),
+        )))
+        _copy(cursor, Audit.leads.through._meta.db_table, OrderedDict((
+            ('audit_id', audit_ids),
+            ('lead_id', lead_ids[leads]),
+        )))
+        return {Audit._meta.db_table: count}
+
+
+def generate_leads(dataset, leads, date_from, date_to, chunk_size=CHUNK_SIZE, stats=None):
+    """
+    add leads to synthetic dataset, every chunk is committed separately,
+    rollups, user labels and analytics cache of dataset users are updated after
+    :param dataset: SyntheticDataset
+    :param leads: count of leads
+    :param stats: collector.etl.EtlStats, stages are 'copy' and 'rollups'
+    :return: {table: rows}
+    """
+    days = max((date_to - date_from).days, 1)
+    # distinct devices and persons, about three leads per device
+    pool = max(leads // 3, 1)
+    rows = OrderedDict()
+    for chunk_from in range(0, leads, chunk_size):
+        count = min(chunk_size, leads - chunk_from)
+        with atomic():
+            if stats is not None:
+                with stats.stage('copy', count):
+                    chunk_rows = dataset.add_leads(count, date_from, days, pool)
+            else:
+                chunk_rows = dataset.add_leads(count, date_from, days, pool)
+        for table, count in chunk_rows.items():
+            rows[table] = rows.get(table, 0) + count
+
+    pixel_ids = [pixel_id for pixel_id, _, _ in dataset.pixels]
+    step_from = truncate_hour(date_from - timedelta(days=1))
+    while step_from <= date_to + timedelta(days=1):
+        step_to = step_from + timedelta(days=7) - timedelta(microseconds=1)
+        with atomic():
+            if stats is not None:
+                with stats.stage('rollups') as stage:
+                    stage['rows'] += rebuild_lead_hour_stat(step_from, step_to, pixel_ids)
+            else:
+                rebuild_lead_hour_stat(step_from, step_to, pixel_ids)
+        step_from = step_to + timedelta(microseconds=1)
+    with atomic():
+        UserUrlLabel.refresh_users(dataset.user_ids)
+        invalidate_users(dataset.user_ids + [user.id for user in dataset.sales_users])
+    with connection.cursor() as cursor:
+        for table in rows:
+            cursor.execute('ANALYZE {}'.format(table))
+    return rows
@@ -1,9 +1,17 @@
 import doctest
+from datetime import datetime, timedelta
+from unittest import mock
 
 from django.contrib.auth import get_user_model
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+import pytz
 
 import collector.analytics
+from collector.models import Lead, Project, Pixel, LeadUtm, LeadUrlLabel, UserUrlLabel
+from collector.models.dictionaries import City
+from condust.schema import schema
 
 User = get_user_model()
 
@@ -12,3 +20,206 @@ def load_tests(loader, tests, ignore):
     tests.addTest(doctest.DocTestSuite(collector.analytics))
     return tests
 
+
+class Context(object):
+    def __init__(self, user):
+        self.user = user
+
+
+
+@override_settings(ANALYTICS_CACHE=None, ANALYTICS_LEAD_ROLLUPS=False)
+class DashboardSummaryTestCase(TestCase):
+
+    def test_summary_must_be_same_as_separate_totals(self):
+        user = User.objects.create(username='summary@example.com')
+        project = Project.objects.create(user=user, title='project')
+        pixel = Pixel.objects.create(project=project, title='pixel')
+        date_from = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        date_to = datetime(2018, 3, 1, 23, 59, 59, tzinfo=timezone.utc)
+        for i, created in enumerate((date_from + timedelta(hours=1), None, date_to + timedelta(hours=1))):
+            Lead.objects.create(pixel=pixel, session_started=date_from + timedelta(minutes=i),
+                                created=created, device_id=str(i))
+
+        summary = collector.analytics.dashboard_summary(user, date_from, date_to)
+        args = (user, date_from, date_to)
+        self.assertEqual(summary['total_visits'], collector.analytics.total_visits(*args))
+        self.assertEqual(summary['total_conversions'], collector.analytics.total_conversions(*args))
+        self.assertEqual(summary['total_devices'], collector.analytics.total_devices(*args))
+        self.assertEqual(summary['browser_totals'],
+                         list(collector.analytics.lead_browser_totals(*args)))
+        self.assertEqual(summary['device_type_totals'],
+                         list(collector.analytics.lead_device_type_totals(*args)))
+        self.assertEqual(summary['mobile_os_totals'],
+                         list(collector.analytics.lead_os_totals(*args, True)))
+        self.assertEqual((summary['total_visits'], summary['total_conversions']), (3, 1))
+
+
+@override_settings(ANALYTICS_CACHE=None, ANALYTICS_LEAD_ROLLUPS=False)
+class DeviceFrequencyTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='frequency@example.com')
+        pixel = Pixel.objects.create(project=Project.objects.create(user=self.user, title='project'),
+                                     title='pixel')
+        other_pixel = Pixel.objects.create(
+            project=Project.objects.create(user=User.objects.create(username='other@example.com'), title='other'),
+            title='other'
+        )
+        self.day1 = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        self.day2 = datetime(2018, 3, 2, tzinfo=timezone.utc)
+        leads = (
+            # pixel, day, hours, minutes, device, subnet
+            (pixel, self.day1, 10, 0, 'A', '10.0.0.0'),
+            (pixel, self.day1, 10, 1, 'B', '10.0.0.0'),
+            (pixel, self.day1, 10, 2, 'A', '10.0.0.0'),
+            (pixel, self.day1, 10, 30, 'A', '10.0.0.0'),
+            (pixel, self.day1, 11, 0, 'C', '10.0.1.0'),
+            (pixel, self.day1, 14, 0, 'A', '10.0.0.0'),
+            (pixel, self.day1, 23, 0, 'B', '10.0.0.0'),
+            # leads of other users are not counted
+            (other_pixel, self.day1, 10, 3, 'A', '10.0.0.0'),
+            # previous lead of device in other day is not counted
+            (pixel, self.day2, 0, 10, 'A', '10.0.0.0'),
+            (pixel, self.day2, 0, 12, 'A', '10.0.0.0'),
+            (pixel, self.day2, 9, 0, 'B', '10.0.0.0'),
+            (pixel, self.day2, 21, 30, 'B', '10.0.0.0'),
+        )
+        for lead_pixel, day, hours, minutes, device_id, subnet in leads:
+            created = day + timedelta(hours=hours, minutes=minutes)
+            Lead.objects.create(pixel=lead_pixel, session_started=created, created=created,
+                                device_id=device_id, subnet=subnet)
+
+    def _frequencies(self, device_field):
+        by_dates = collector.analytics._device_frequency_groups_by_dates(
+            Lead.objects.filter(user=self.user), device_field=device_field)
+        return {day: dict(groups) for day, groups in by_dates.items()}
+
+    def test_repeated_devices_must_be_counted_per_day_and_group(self):
+        # first repeat counts both leads, next ones only the new lead
+        self.assertEqual(self._frequencies('device_id'), {
+            # repeats of A after 2 min, 28 min, 3.5 hours, B after 13 hours
+            self.day1: {'5_minutes': 2, '1_hour': 3, '3_hours': 3, '12_hours': 4, '1_day': 5},
+            # repeats of A after 2 min, B after 12.5 hours
+            self.day2: {'5_minutes': 2, '1_hour': 2, '3_hours': 2, '12_hours': 2, '1_day': 3},
+        })
+        by_period = collector.analytics.consumer_origin_by_period(
+            self.user, self.day1, self.day2 + timedelta(hours=23, minutes=59), groups=['1_hour', '1_day'])
+        self.assertEqual(by_period, {'01 March': {'1_hour': 3, '1_day': 5}, '02 March': {'1_hour': 2, '1_day': 3}})
+
+    def test_repeated_subnets_must_be_counted_per_day_and_group(self):
+        self.assertEqual(self._frequencies('subnet'), {
+            # repeats after 1 min, 1 min, 28 min, 3.5 hours, 9 hours
+            self.day1: {'5_minutes': 3, '1_hour': 4, '3_hours': 4, '12_hours': 6, '1_day': 6},
+            # repeats after 2 min, 8.8 hours, 12.5 hours
+            self.day2: {'5_minutes': 2, '1_hour': 2, '3_hours': 2, '12_hours': 3, '1_day': 4},
+        })
+
+
+@override_settings(ANALYTICS_CACHE=None)
+class UrlLabelIndexTestCase(TestCase):
+
+    def test_label_filter_must_use_label_index(self):
+        user = User.objects.create(username='labels@example.com')
+        project = Project.objects.create(user=user, title='project')
+        pixel = Pixel.objects.create(project=project, title='pixel')
+        date_from = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        date_to = datetime(2018, 3, 1, 23, 59, 59, tzinfo=timezone.utc)
+        url_labels = []
+        for source in ('google', 'Google', 'yandex', 'Google', None):
+            lead = Lead.objects.create(pixel=pixel, session_started=date_from,
+                                       created=date_from + timedelta(hours=1))
+            utm = LeadUtm.objects.create(lead=lead, utm_source=source or '', utm_medium='cpc')
+            url_labels.extend(LeadUrlLabel.objects.bulk_create(LeadUrlLabel.from_lead_label(utm)))
+        UserUrlLabel.add_lead_labels(url_labels)
+
+        def conversions(**label_values):
+            return collector.analytics.total_conversions(user, date_from, date_to,
+                                                         label_type='utm', label_values=label_values)
+
+        self.assertEqual(conversions(utm_source='GOOGLE'), 3)
+        self.assertEqual(conversions(utm_source='google', utm_medium='cpc'), 3)
+        self.assertEqual(conversions(utm_source='bing'), 0)
+        self.assertEqual(
+            list(collector.analytics.load_url_label_list(user, 'utm', 'utm_source', 'go')),
+            ['Google', 'google']
+        )
+        # values are ordered by count of leads
+        self.assertEqual(
+            list(collector.analytics.load_url_label_list(user, 'utm', 'utm_source', limit=2)),
+            ['Google', 'google']
+        )
+        UserUrlLabel.refresh_users([user.id])
+        self.assertEqual(
+            list(collector.analytics.load_url_label_list(user, 'utm', 'utm_source')),
+            ['Google', 'google', 'yandex']
+        )
+        # limit is clamped to 1..URL_LABEL_LIST_MAX_LIMIT
+        for limit, values in ((-5, ['Google']), (0, ['Google']), (1000, ['Google', 'google', 'yandex'])):
+            result = schema.execute('{ urlLabelList(labelType: "utm", labelName: "utm_source", limit: %d) }'
+                                    % limit, context_value=Context(user))
+            self.assertIsNone(result.errors)
+            self.assertEqual(result.data['urlLabelList'], values)
+
+
+@override_settings(ANALYTICS_CACHE=None, ANALYTICS_LEAD_ROLLUPS=False)
+class PeriodAxisTestCase(TestCase):
+
+    def test_series_must_cover_all_periods(self):
+        user = User.objects.create(username='axis@example.com')
+        pixel = Pixel.objects.create(project=Project.objects.create(user=user, title='project'),
+                                     title='pixel')
+        tz = pytz.timezone('Europe/Berlin')
+        # daylight saving time starts on 25 Mar 2018
+        for created in (datetime(2018, 3, 3, 23, 30), datetime(2018, 3, 27, 0, 30)):
+            created = tz.localize(created)
+            Lead.objects.create(pixel=pixel, session_started=created, created=created)
+
+        with timezone.override(tz):
+            date_from = tz.localize(datetime(2018, 3, 1))
+            date_to = tz.localize(datetime(2018, 3, 31, 23, 59, 59))
+            axis = collector.analytics.period_axis(date_from, date_to)
+            periods = list(collector.analytics.leads_by_period(user, date_from, date_to))
+            counts = collector.analytics.period_series(axis, periods)[None]
+
+        self.assertEqual(len(axis), 31)
+        self.assertEqual((axis[0], axis[-1]), (date_from, tz.localize(datetime(2018, 3, 31))))
+        self.assertEqual([i for i, count in enumerate(counts) if count], [2, 26])
+        self.assertEqual(sum(counts), 2)
+        hours = collector.analytics.period_axis(date_from, date_from + timedelta(hours=5, minutes=59))
+        self.assertEqual(len(hours), 6)
+
+    def test_hours_must_follow_dst_switch(self):
+        tz = pytz.timezone('Europe/Berlin')
+        utc = datetime(2018, 3, 24, 23, tzinfo=timezone.utc)
+        with timezone.override(tz):
+            # 02:00 is skipped on 25 Mar 2018
+            hours = collector.analytics.period_axis(tz.localize(datetime(2018, 3, 25, 0, 30)),
+                                                    tz.localize(datetime(2018, 3, 25, 4, 59)))
+            self.assertEqual([hour.strftime('%H %Z') for hour in hours], ['00 CET', '01 CET', '03 CEST', '04 CEST'])
+            self.assertEqual(hours, [utc + timedelta(hours=i) for i in range(4)])
+            # 02:00 is repeated on 28 Oct 2018
+            hours = collector.analytics.period_axis(tz.localize(datetime(2018, 10, 28, 1), is_dst=True),
+                                                    tz.localize(datetime(2018, 10, 28, 3, 59), is_dst=False))
+            self.assertEqual([hour.strftime('%H %Z') for hour in hours],
+                             ['01 CEST', '02 CEST', '02 CET', '03 CET'])
+            self.assertEqual(collector.analytics.period_axis(hours[0], hours[-1], 'day'),
+                             [tz.localize(datetime(2018, 10, 28))])
+
+
+class LeadLabelsTestCase(TestCase):
+
+    def test_overflowed_labels_must_keep_all_asked_ids(self):
+        pixel = Pixel.objects.create(title='pixel')
+        now = timezone.now()
+        leads = [Lead.objects.create(pixel=pixel, session_started=now, created=now,
+                                     geo=City.objects.create(country='DE', name='city {}'.format(i)))
+                 for i in range(3)]
+        with mock.patch.object(collector.analytics, 'LABELS_CACHE_SIZE', 2), \
+                mock.patch.dict(collector.analytics._CITY_LABELS, clear=True):
+            collector.analytics.fill_lead_labels(leads[:1])
+            # cached city is not loaded again, missing ones are loaded by one query and overflow the cache
+            with self.assertNumQueries(1):
+                collector.analytics.fill_lead_labels(leads)
+            self.assertEqual(len(collector.analytics._CITY_LABELS), 2)
+        self.assertEqual([(lead.city, lead.country) for lead in leads],
+                         [('city {}'.format(i), 'Germany') for i in range(3)])
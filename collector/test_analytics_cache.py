@@ -0,0 +1,61 @@
+import doctest
+from datetime import datetime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import collector.analytics_cache
+from collector.analytics import total_conversions
+from collector.analytics_cache import invalidate_users, cache_stats, reset_cache_stats
+from collector.models import Lead, Project, Pixel
+
+User = get_user_model()
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTest(doctest.DocTestSuite(collector.analytics_cache))
+    return tests
+
+
+@override_settings(ANALYTICS_LEAD_ROLLUPS=False)
+class AnalyticsCacheTestCase(TransactionTestCase):
+
+    def setUp(self):
+        caches['analytics'].clear()
+        reset_cache_stats()
+        self.user = User.objects.create(username='cache@example.com')
+        project = Project.objects.create(user=self.user, title='project')
+        self.pixel = Pixel.objects.create(project=project, title='pixel')
+        self.date_from = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        self.date_to = datetime(2018, 3, 1, 23, 59, 59, tzinfo=timezone.utc)
+
+    def _create_lead(self):
+        created = datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc)
+        Lead.objects.create(pixel=self.pixel, session_started=created - timedelta(seconds=10),
+                            created=created)
+
+    def _stat(self):
+        return [stat for stat in cache_stats() if stat['function'] == 'total_conversions'][0]
+
+    def test_result_must_be_cached_until_user_invalidated(self):
+        self._create_lead()
+        self.assertEqual(total_conversions(self.user, self.date_from, self.date_to), 1)
+        self._create_lead()
+        # filters in other order and timezone are the same key
+        date_from = self.date_from.astimezone(timezone.get_fixed_timezone(180))
+        self.assertEqual(total_conversions(self.user, date_from, self.date_to, projects=[]), 1)
+        self.assertEqual((self._stat()['hits'], self._stat()['misses']), (1, 1))
+
+        invalidate_users([self.user.id])
+        self.assertEqual(total_conversions(self.user, self.date_from, self.date_to), 2)
+        self.assertEqual((self._stat()['hits'], self._stat()['misses']), (1, 2))
+        self.assertEqual(self._stat()['hit_ratio'], 1 / 3)
+
+    def test_other_user_invalidation_must_keep_result(self):
+        self.assertEqual(total_conversions(self.user, self.date_from, self.date_to), 0)
+        invalidate_users([self.user.id + 1])
+        self.assertEqual(total_conversions(self.user, self.date_from, self.date_to), 0)
+        self.assertEqual(self._stat()['hits'], 1)
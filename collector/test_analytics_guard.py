@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from collector.analytics import consumer_origin_by_period
+from collector.analytics_guard import AnalyticsQueryRejected, statement_timeout
+from collector.models import Lead, Project, Pixel
+from condust.schema import schema
+from utils.graphene import GraphQLView
+
+User = get_user_model()
+
+
+class Context(object):
+    def __init__(self, user):
+        self.user = user
+
+
+@override_settings(ANALYTICS_CACHE=None, ANALYTICS_LEAD_ROLLUPS=False)
+class AnalyticsGuardTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='guard@example.com')
+        project = Project.objects.create(user=self.user, title='project')
+        pixel = Pixel.objects.create(project=project, title='pixel')
+        self.date_from = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        for i in range(3):
+            created = self.date_from + timedelta(hours=i)
+            Lead.objects.create(pixel=pixel, session_started=created, created=created, device_id='device')
+
+    @override_settings(ANALYTICS_MAX_RANGE_DAYS={'default': None, 'consumer_origin_by_period': 31})
+    def test_long_range_must_be_rejected_with_narrow_range_error(self):
+        result = schema.execute('''{
+            consumerOriginByPeriod(dateFrom: "2018-03-01T00:00:00+00:00", dateTo: "2018-05-01T00:00:00+00:00") {
+                created leadsCount
+            }
+            totalConversions(dateFrom: "2018-03-01T00:00:00+00:00", dateTo: "2018-05-01T00:00:00+00:00")
+        }''', context_value=Context(self.user))
+        self.assertEqual(result.data['totalConversions'], 3)
+        self.assertEqual(len(result.errors), 1)
+        error = GraphQLView.format_error(result.errors[0])
+        self.assertEqual(error['extensions'], {'code': 'NARROW_RANGE', 'reason': 'range', 'maxDays': 31})
+
+    def test_expensive_query_must_be_rejected_before_run(self):
+        date_to = self.date_from + timedelta(days=1)
+        self.assertTrue(consumer_origin_by_period(self.user, self.date_from, date_to))
+        with override_settings(ANALYTICS_MAX_QUERY_COST=0):
+            with self.assertRaises(AnalyticsQueryRejected) as rejected:
+                consumer_origin_by_period(self.user, self.date_from, date_to)
+        self.assertEqual(rejected.exception.reason, 'cost')
+
+    def test_slow_query_must_be_canceled(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SHOW statement_timeout')
+            previous = cursor.fetchone()[0]
+            with self.assertRaises(AnalyticsQueryRejected) as rejected:
+                with statement_timeout(10, using='default'):
+                    cursor.execute('SELECT pg_sleep(1)')
+            self.assertEqual(rejected.exception.reason, 'timeout')
+            cursor.execute('SHOW statement_timeout')
+            self.assertEqual(cursor.fetchone()[0], previous)
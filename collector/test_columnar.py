@@ -0,0 +1,86 @@
+import doctest
+from datetime import datetime, timedelta
+from unittest import skipIf
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import collector.analytics
+import collector.columnar
+from collector.columnar import get_lead_columns, numpy
+from collector.models import Lead, Project, Pixel
+from collector.models.dictionaries import BrowserGroup
+
+User = get_user_model()
+
+
+def load_tests(loader, tests, ignore):
+    if numpy is not None:
+        tests.addTest(doctest.DocTestSuite(collector.columnar))
+    return tests
+
+
+@skipIf(numpy is None, 'numpy is not installed')
+@override_settings(ANALYTICS_CACHE=None, ANALYTICS_LEAD_ROLLUPS=False, ANALYTICS_COLUMNAR=True)
+class LeadColumnsTestCase(TestCase):
+
+    def setUp(self):
+        collector.columnar._stores.clear()
+        self.user = User.objects.create(username='columns@example.com')
+        self.project = Project.objects.create(user=self.user, title='project')
+        self.pixel = Pixel.objects.create(project=self.project, title='pixel')
+        self.browser_group = BrowserGroup.objects.create(name='Browser')
+        self.date_from = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        self.date_to = datetime(2018, 3, 31, 23, 59, 59, tzinfo=timezone.utc)
+
+    def _create_lead(self, created, duration, device_id, browser_group=None):
+        lead = Lead.objects.create(pixel=self.pixel, session_started=created - duration,
+                                   created=created, device_id=device_id)
+        if browser_group:
+            lead.browser_group = browser_group
+            lead.save()
+        return lead
+
+    def _analytics(self, **filters):
+        args = (self.user, self.date_from, self.date_to)
+        return (
+            collector.analytics.total_conversions(*args, **filters),
+            collector.analytics.total_devices(*args, **filters),
+            [dict(row) for row in collector.analytics.leads_by_period(*args, **filters)],
+            [dict(row) for row in collector.analytics.lead_duration_totals(*args, **filters)],
+            [dict(row) for row in collector.analytics.lead_duration_totals(
+                *args, groups=['less_5_seconds'], **filters)],
+            [dict(row) for row in collector.analytics.lead_browser_totals(*args, **filters)],
+            [dict(row) for row in collector.analytics.lead_device_type_totals(*args, **filters)],
+        )
+
+    def test_columns_must_answer_same_as_sql(self):
+        for i in range(20):
+            self._create_lead(datetime(2018, 3, 1 + i, i, 30, tzinfo=timezone.utc),
+                              timedelta(seconds=4 + i * 7, microseconds=500000), 'device{}'.format(i % 7),
+                              self.browser_group if i % 3 else None)
+        self._create_lead(self.date_to + timedelta(seconds=1), timedelta(seconds=1), 'late')
+
+        totals = []
+        for filters in ({}, {'projects': [self.project.id]}, {'browser_groups': [self.browser_group.id]}):
+            with override_settings(ANALYTICS_COLUMNAR=False):
+                expected = self._analytics(**filters)
+            self.assertEqual(self._analytics(**filters), expected)
+            totals.append(expected[:2])
+        self.assertEqual(totals, [(20, 7), (20, 7), (13, 7)])
+
+        # new and changed leads are upserted on refresh
+        lead = self._create_lead(datetime(2018, 3, 5, tzinfo=timezone.utc), timedelta(seconds=1), 'new')
+        lead.created = datetime(2018, 3, 6, tzinfo=timezone.utc)
+        lead.save()
+        self.assertEqual(collector.analytics.total_devices(self.user, self.date_from, self.date_to), 8)
+        self.assertEqual(len(get_lead_columns(self.user.id)), 22)
+
+    def test_users_over_budget_must_be_answered_by_sql(self):
+        self._create_lead(datetime(2018, 3, 1, tzinfo=timezone.utc), timedelta(seconds=1), 'device')
+        with override_settings(ANALYTICS_COLUMNAR_MEMORY_BUDGET=10):
+            self.assertIsNone(get_lead_columns(self.user.id))
+            self.assertEqual(collector.analytics.total_conversions(self.user, self.date_from, self.date_to), 1)
+        self.assertEqual(len(get_lead_columns(self.user.id)), 1)
@@ -0,0 +1,100 @@
+import doctest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from collector import dashboard_warmer
+from collector.dashboard_warmer import warm_dashboards, is_stale
+from collector.management.commands import fill_leads
+from collector.models import Lead, Project, Pixel
+from condust.schema import schema
+from profiles.models import PageFilters
+
+User = get_user_model()
+
+FILTERS = 'dateFrom=2018-03-01&dateTo=2018-03-31'
+
+DASHBOARD_QUERY = '''{
+    pageDashboard(page: "dashboard") { filters result warmed stale }
+}'''
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTest(doctest.DocTestSuite(dashboard_warmer))
+    return tests
+
+
+class Context(object):
+    def __init__(self, user):
+        self.user = user
+
+
+@override_settings(ANALYTICS_CACHE=None)
+class DashboardWarmerTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='warm@example.com')
+        project = Project.objects.create(user=self.user, title='project')
+        self.pixel = Pixel.objects.create(project=project, title='pixel')
+        self._create_lead(datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc))
+        self.page_filters = PageFilters.objects.create(user=self.user, page='dashboard', filters=FILTERS,
+                                                       viewed=timezone.now())
+
+    def _create_lead(self, created, pixel=None):
+        return Lead.objects.create(pixel=pixel or self.pixel, session_started=created - timedelta(seconds=10),
+                                   created=created)
+
+    def test_stale_dashboards_of_viewed_pages_must_be_warmed(self):
+        other = User.objects.create(username='idle@example.com')
+        PageFilters.objects.create(user=other, page='dashboard', filters=FILTERS,
+                                   viewed=timezone.now() - timedelta(days=30))
+        self.assertEqual(warm_dashboards(), (1, 0))
+        self.page_filters.refresh_from_db()
+        self.assertFalse(is_stale(self.page_filters))
+        # fresh dashboards are skipped
+        self.assertEqual(warm_dashboards(), (0, 0))
+
+        self._create_lead(datetime(2018, 3, 2, 10, 5, tzinfo=timezone.utc))
+        self.assertTrue(is_stale(self.page_filters))
+        self.assertEqual(warm_dashboards(), (1, 0))
+
+        result = schema.execute(DASHBOARD_QUERY, context_value=Context(self.user))
+        self.assertIsNone(result.errors)
+        dashboard = result.data['pageDashboard']
+        self.assertFalse(dashboard['stale'])
+        self.assertIsNotNone(dashboard['warmed'])
+        self.assertEqual(dashboard['result']['widgets']['dashboard_summary']['total_conversions'], 2)
+        self.assertEqual(dashboard['result']['arguments']['date_to'], '2018-03-31T23:59:59Z')
+
+    def test_bad_filters_must_be_skipped(self):
+        PageFilters.objects.filter(pk=self.page_filters.pk).update(filters='dateFrom=yesterday')
+        self.assertEqual(warm_dashboards(), (0, 1))
+
+    def test_leads_of_other_users_must_make_lineage_stale(self):
+        self.assertEqual(warm_dashboards(), (1, 0))
+        other = User.objects.create(username='other@example.com')
+        pixel = Pixel.objects.create(project=Project.objects.create(user=other, title='other'), title='other')
+        self._create_lead(datetime(2018, 3, 2, 10, 5, tzinfo=timezone.utc), pixel)
+        self.assertTrue(is_stale(PageFilters.objects.get(pk=self.page_filters.pk)))
+
+    def test_default_range_must_be_stale_next_hour(self):
+        PageFilters.objects.filter(pk=self.page_filters.pk).update(filters='osGroups=1')
+        self.assertEqual(warm_dashboards(), (1, 0))
+        page_filters = PageFilters.objects.get(pk=self.page_filters.pk)
+        self.assertFalse(is_stale(page_filters))
+        next_hour = timezone.now() + timedelta(hours=1)
+        with mock.patch('django.utils.timezone.now', return_value=next_hour):
+            self.assertTrue(is_stale(page_filters))
+
+    def test_fill_leads_must_warm_only_invalidated_users(self):
+        command = fill_leads.Command()
+        with mock.patch.object(fill_leads, 'warm_dashboards', return_value=(1, 0)) as warm:
+            command._warm_dashboards()
+            warm.assert_not_called()
+            command.invalidated_users = {self.user.id}
+            command._warm_dashboards()
+            warm.assert_called_once_with({self.user.id})
@@ -0,0 +1,35 @@
+import doctest
+
+from django.test import TestCase
+
+import collector.etl
+from collector.etl import EtlStats
+from collector.models import EtlRun, TrafficChannel
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTest(doctest.DocTestSuite(collector.etl))
+    return tests
+
+
+class EtlStatsTestCase(TestCase):
+
+    def test_stage_must_count_queries_and_rows(self):
+        stats = EtlStats('test')
+        with stats.stage('load', rows=2):
+            list(TrafficChannel.objects.all())
+        with stats.stage('load') as stage:
+            list(TrafficChannel.objects.all())
+            stage['rows'] += 3
+        self.assertEqual(stats.stages['load']['queries'], 2)
+        self.assertEqual(stats.stages['load']['rows'], 5)
+
+    def test_save_must_create_etl_run(self):
+        stats = EtlStats('test')
+        with stats.stage('load'):
+            pass
+        stats.finish(10, 1)
+        stats.save()
+        run = EtlRun.objects.get(command='test')
+        self.assertEqual((run.rows, run.failed), (10, 1))
+        self.assertEqual(list(run.stages), ['load'])
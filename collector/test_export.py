@@ -0,0 +1,56 @@
+import csv
+import doctest
+import gzip
+import io
+import json
+from datetime import datetime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+import collector.export
+from collector.export import EXPORT_FIELDS
+from collector.models import Lead, Project, Pixel
+
+User = get_user_model()
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTest(doctest.DocTestSuite(collector.export))
+    return tests
+
+
+@override_settings(ANALYTICS_CACHE=None)
+class ExportLeadsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='export@example.com')
+        project = Project.objects.create(user=self.user, title='project')
+        pixel = Pixel.objects.create(project=project, title='pixel')
+        created = datetime(2018, 3, 1, 10, tzinfo=timezone.utc)
+        for i in range(5):
+            Lead.objects.create(pixel=pixel, session_started=created,
+                                created=created + timedelta(minutes=i))
+        self.params = {'date_from': '2018-03-01T00:00:00Z', 'date_to': '2018-03-01T23:59:59Z'}
+
+    def _export(self, **params):
+        response = self.client.get(reverse('export-leads'), dict(self.params, **params))
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_export_must_stream_all_leads_in_chunks(self):
+        self.client.force_login(self.user)
+        rows = list(csv.DictReader(io.StringIO(self._export().decode())))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(tuple(rows[0].keys()), EXPORT_FIELDS)
+        self.assertEqual(rows[0]['created'], '2018-03-01T10:04:00+00:00')
+
+        lines = gzip.decompress(self._export(format='ndjson', gzip='1')).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [row['id'] for row in rows])
+
+    def test_export_must_require_user(self):
+        response = self.client.get(reverse('export-leads'), self.params)
+        self.assertEqual(response.status_code, 401)
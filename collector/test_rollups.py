@@ -0,0 +1,173 @@
+import doctest
+from datetime import datetime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import collector.models.rollups
+import collector.rollups
+from collector.analytics import leads_by_period, lead_duration_totals, total_conversions, \
+    total_devices, other_lead_lineage_by_period, lead_age_totals
+from collector.models import Lead, LeadHourStat, LeadHourSketch, LeadPeriodSketch, Project, Pixel, \
+    LeadPeriodTotal
+from collector.rollups import refresh_lead_hour_stat, lead_pixel_hours, rebuild_lead_hour_stat
+
+User = get_user_model()
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTest(doctest.DocTestSuite(collector.rollups))
+    tests.addTest(doctest.DocTestSuite(collector.models.rollups))
+    return tests
+
+
+@override_settings(ANALYTICS_CACHE=None)
+class LeadHourStatTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='rollup@example.com')
+        project = Project.objects.create(user=self.user, title='project')
+        self.pixel = Pixel.objects.create(project=project, title='pixel')
+        self.date_from = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        self.date_to = datetime(2018, 3, 1, 23, 59, 59, tzinfo=timezone.utc)
+
+    def _create_lead(self, created, duration=10, device_id=None):
+        return Lead.objects.create(
+            pixel=self.pixel,
+            session_started=created - timedelta(seconds=duration),
+            created=created,
+            device_id=device_id
+        )
+
+    def _analytics(self):
+        return (
+            total_conversions(self.user, self.date_from, self.date_to),
+            [dict(row) for row in leads_by_period(self.user, self.date_from, self.date_to)],
+            [dict(row) for row in lead_duration_totals(self.user, self.date_from, self.date_to)],
+        )
+
+    def test_rollups_must_answer_same_as_leads(self):
+        leads = [
+            self._create_lead(datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc)),
+            self._create_lead(datetime(2018, 3, 1, 10, 55, tzinfo=timezone.utc), duration=3),
+            self._create_lead(datetime(2018, 3, 1, 15, 0, tzinfo=timezone.utc), duration=4000),
+        ]
+        refresh_lead_hour_stat(lead_pixel_hours(leads))
+        self.assertEqual(LeadHourStat.objects.filter(pixel=self.pixel).count(), 3)
+        with override_settings(ANALYTICS_LEAD_ROLLUPS=False):
+            expected = self._analytics()
+        self.assertEqual(self._analytics(), expected)
+        self.assertEqual(expected[0], 3)
+
+    def test_refresh_must_move_lead_between_hours(self):
+        lead = self._create_lead(datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc))
+        pixel_hours = lead_pixel_hours([lead])
+        refresh_lead_hour_stat(pixel_hours)
+        lead.created = datetime(2018, 3, 1, 12, 5, tzinfo=timezone.utc)
+        lead.save()
+        # old and new hour slices are refreshed
+        refresh_lead_hour_stat(pixel_hours | lead_pixel_hours([lead]))
+        self.assertEqual(
+            list(LeadHourStat.objects.filter(pixel=self.pixel).values_list('hour', 'leads')),
+            [(datetime(2018, 3, 1, 12, tzinfo=timezone.utc), 1)]
+        )
+
+    def test_rebuild_must_replace_range(self):
+        self._create_lead(datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc))
+        self._create_lead(datetime(2018, 3, 2, 10, 5, tzinfo=timezone.utc))
+        rebuild_lead_hour_stat(pixel_ids=[self.pixel.id])
+        rebuild_lead_hour_stat(self.date_from, self.date_to, pixel_ids=[self.pixel.id])
+        self.assertEqual(LeadHourStat.objects.filter(pixel=self.pixel).count(), 2)
+
+    def test_sketches_must_estimate_devices(self):
+        for i in range(30):
+            created = datetime(2018, 3, 1, i % 24, 5, tzinfo=timezone.utc)
+            self._create_lead(created, device_id='device{}'.format(i % 20))
+        rebuild_lead_hour_stat(pixel_ids=[self.pixel.id])
+        self.assertEqual(LeadHourSketch.objects.filter(pixel=self.pixel).count(), 24)
+        exact = total_devices(self.user, self.date_from, self.date_to)
+        approximate = total_devices(self.user, self.date_from, self.date_to, approximate=True)
+        self.assertEqual((exact, approximate), (20, 20))
+
+    def test_period_sketches_must_estimate_devices_of_long_range(self):
+        leads = []
+        for i in range(40):
+            created = datetime(2018, 2, 27, 10, 5, tzinfo=timezone.utc) + timedelta(hours=23 * i)
+            leads.append(self._create_lead(created, device_id='device{}'.format(i % 25)))
+        refresh_lead_hour_stat(lead_pixel_hours(leads))
+        sketch_qs = LeadPeriodSketch.objects.filter(pixel=self.pixel)
+        self.assertEqual(sketch_qs.filter(unit='month').count(), 3)
+        self.assertEqual(sketch_qs.filter(unit='day').count(),
+                         len({lead.created.date() for lead in leads}))
+        ranges = (
+            (datetime(2018, 2, 27, 10, tzinfo=timezone.utc), datetime(2018, 4, 2, 5, 59, 59, tzinfo=timezone.utc)),
+            (datetime(2018, 3, 1, tzinfo=timezone.utc), datetime(2018, 3, 31, 23, 59, 59, tzinfo=timezone.utc)),
+            (datetime(2018, 3, 3, 12, tzinfo=timezone.utc), datetime(2018, 3, 20, 11, 59, 59, tzinfo=timezone.utc)),
+        )
+        for date_from, date_to in ranges:
+            exact = total_devices(self.user, date_from, date_to)
+            self.assertEqual(total_devices(self.user, date_from, date_to, approximate=True), exact)
+
+        # leads moved out of february leave no sketches of it
+        moved = leads[:2]
+        Lead.objects.filter(pk__in=[lead.pk for lead in moved]).update(
+            device_id='moved', created=datetime(2018, 3, 5, 1, tzinfo=timezone.utc))
+        refresh_lead_hour_stat(lead_pixel_hours(moved + list(Lead.objects.filter(device_id='moved'))))
+        self.assertEqual(sketch_qs.filter(unit='month').count(), 2)
+        date_from, date_to = ranges[0]
+        exact = total_devices(self.user, date_from, date_to)
+        self.assertEqual(total_devices(self.user, date_from, date_to, approximate=True), exact)
+        rebuild_lead_hour_stat(date_from, date_to, pixel_ids=[self.pixel.id])
+        self.assertEqual(total_devices(self.user, date_from, date_to, approximate=True), exact)
+
+    def test_period_totals_must_answer_other_lineage(self):
+        other_user = User.objects.create(username='other@example.com')
+        other_pixel = Pixel.objects.create(project=Project.objects.create(user=other_user, title='other'),
+                                           title='other pixel')
+        leads = [self._create_lead(datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc))]
+        for hour in (10, 10, 15, 15, 15):
+            leads.append(Lead.objects.create(
+                pixel=other_pixel, session_started=datetime(2018, 3, 1, tzinfo=timezone.utc),
+                created=datetime(2018, 3, 1, hour, 5, tzinfo=timezone.utc), metrik_lead_salecount=hour
+            ))
+        refresh_lead_hour_stat(lead_pixel_hours(leads))
+        leads[-1].created = datetime(2018, 3, 2, 8, 5, tzinfo=timezone.utc)
+        leads[-1].save()
+        refresh_lead_hour_stat(lead_pixel_hours(leads))
+        rebuild_lead_hour_stat(self.date_from, self.date_to)
+        self.assertEqual(LeadPeriodTotal.objects.get(unit='day', started=self.date_from).leads, 5)
+
+        # the last lead of other user is moved to the next day
+        for date_to, other_leads in ((self.date_to, 4), (self.date_to + timedelta(days=1), 5)):
+            with override_settings(ANALYTICS_LEAD_ROLLUPS=False):
+                expected = [dict(row) for row in other_lead_lineage_by_period(self.user, self.date_from, date_to)]
+            self.assertEqual(other_lead_lineage_by_period(self.user, self.date_from, date_to), expected)
+            self.assertEqual(sum(row['leads_count'] for row in expected), other_leads)
+
+    def test_lead_age_must_scan_boundary_hours_only(self):
+        now = datetime(2018, 3, 2, 12, 30, 20, tzinfo=timezone.utc)
+        leads = [self._create_lead(created) for created in (
+            datetime(2018, 3, 2, 12, 28, tzinfo=timezone.utc),
+            datetime(2018, 3, 2, 12, 10, tzinfo=timezone.utc),
+            datetime(2018, 3, 2, 11, 50, tzinfo=timezone.utc),
+            datetime(2018, 3, 2, 9, 0, tzinfo=timezone.utc),
+            # the hour of 12 hours boundary
+            datetime(2018, 3, 2, 0, 40, tzinfo=timezone.utc),
+            datetime(2018, 3, 2, 0, 20, tzinfo=timezone.utc),
+            datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc),
+            datetime(2018, 3, 1, 10, 6, tzinfo=timezone.utc),
+            datetime(2018, 3, 2, 12, 45, tzinfo=timezone.utc),
+        )]
+        refresh_lead_hour_stat(lead_pixel_hours(leads))
+        date_to = self.date_to + timedelta(days=1)
+        with override_settings(ANALYTICS_LEAD_ROLLUPS=False):
+            expected = lead_age_totals(self.user, self.date_from, date_to, now=now)
+        self.assertEqual(lead_age_totals(self.user, self.date_from, date_to, now=now), expected)
+        self.assertEqual([(row['group_name'], row['leads_count']) for row in expected], [
+            ('less_5_minutes', 1), ('5_to_30_minutes', 1), ('30_to_60_minutes', 1), ('1_to_4_hours', 1),
+            ('4_to_12_hours', 1), ('12_to_24_hours', 1), ('1_to_2_days', 2), ('Others', 1),
+        ])
+        self.assertEqual(lead_age_totals(self.user, self.date_from, date_to, ['1_to_2_days'], now=now),
+                         [{'group_name': '1_to_2_days', 'leads_count': 2}, {'group_name': 'Others', 'leads_count': 7}])
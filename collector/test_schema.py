@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import urlsafe_base64_encode
+
+from collector.models import Lead, Project, Pixel
+from collector.models.dictionaries import City
+from collector.projects_schema import PixelType
+from condust.schema import schema
+
+User = get_user_model()
+
+PROJECTS_QUERY = '''{
+    allProjects { title pixels { title project { title } } }
+}'''
+
+LEADS_QUERY = '''{
+    leads(dateFrom: "2018-03-01T00:00:00+00:00", dateTo: "2018-03-31T23:59:59+00:00", limit: 100) {
+        data { id city pixel { title project { title pixels { title } } } }
+    }
+    allProjects { pixels { leads { city country } } }
+}'''
+
+
+class Context(object):
+    def __init__(self, user):
+        self.user = user
+
+
+class Info(object):
+    def __init__(self, context):
+        self.context = context
+
+
+@override_settings(ANALYTICS_CACHE=None)
+class NestedFieldsBatchingTestCase(TestCase):
+
+    def _create_projects(self, user, count):
+        city = City.objects.create(name='Berlin', country='DE')
+        created = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        for i in range(count):
+            project = Project.objects.create(user=user, title='project {}'.format(i))
+            for j in range(2):
+                pixel = Pixel.objects.create(project=project, title='pixel {}'.format(j))
+                Lead.objects.create(pixel=pixel, session_started=created, geo=city,
+                                    created=created + timedelta(minutes=i * 2 + j))
+            Pixel.objects.create(project=project, title='removed', removed=True)
+
+    def _count_queries(self, query, count):
+        user = User.objects.create(username='batch{}@example.com'.format(count))
+        self._create_projects(user, count)
+        with CaptureQueriesContext(connection) as queries:
+            result = schema.execute(query, context_value=Context(user))
+        self.assertIsNone(result.errors)
+        return len(queries), result.data
+
+    def test_queries_count_must_not_depend_on_projects_count(self):
+        small, small_data = self._count_queries(PROJECTS_QUERY, 2)
+        big, big_data = self._count_queries(PROJECTS_QUERY, 8)
+        self.assertEqual(small, big)
+        self.assertEqual(len(big_data['allProjects']), 8)
+        self.assertEqual([pixel['project']['title'] for pixel in big_data['allProjects'][0]['pixels']],
+                         ['project 0', 'project 0'])
+
+    def test_queries_count_must_not_depend_on_leads_count(self):
+        small, _ = self._count_queries(LEADS_QUERY, 2)
+        big, big_data = self._count_queries(LEADS_QUERY, 8)
+        self.assertEqual(small, big)
+        leads = big_data['leads']['data']
+        self.assertEqual(len(leads), 16)
+        self.assertEqual(leads[0]['city'], 'Berlin')
+        self.assertEqual(len(leads[0]['pixel']['project']['pixels']), 2)
+        self.assertEqual(big_data['allProjects'][0]['pixels'][0]['leads'][0]['country'], 'Germany')
+
+    def test_pixel_without_project_must_have_no_project(self):
+        pixel = Pixel.objects.create(project=None, title='orphan')
+        info = Info(Context(User.objects.create(username='orphan@example.com')))
+        self.assertIsNone(PixelType.resolve_project(pixel, info))
+
+
+PAGE_QUERY = '''query ($after: String) {
+    leads(dateFrom: "2018-03-01T00:00:00+00:00", dateTo: "2018-03-31T23:59:59+00:00", limit: 2, after: $after) {
+        total nextCursor data { id }
+    }
+}'''
+
+
+@override_settings(ANALYTICS_CACHE=None, ANALYTICS_LEAD_ROLLUPS=False)
+class LeadsCursorTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='cursor@example.com')
+        pixel = Pixel.objects.create(project=Project.objects.create(user=self.user, title='project'),
+                                     title='pixel')
+        created = datetime(2018, 3, 1, 10, 5, tzinfo=timezone.utc)
+        # leads created in the same second are ordered by id
+        self.lead_ids = {str(Lead.objects.create(pixel=pixel, session_started=created, created=created).id)
+                         for _ in range(5)}
+        self.lead_ids.add(str(Lead.objects.create(pixel=pixel, session_started=created,
+                                                  created=created + timedelta(hours=1)).id))
+
+    def _page(self, after=None):
+        result = schema.execute(PAGE_QUERY, context_value=Context(self.user), variable_values={'after': after})
+        return result.errors, result.data and result.data['leads']
+
+    def test_cursor_pages_must_have_all_leads_once(self):
+        ids = []
+        errors, page = self._page()
+        while True:
+            self.assertIsNone(errors)
+            self.assertEqual(page['total'], 6)
+            ids.extend(lead['id'] for lead in page['data'])
+            if page['nextCursor'] is None:
+                break
+            errors, page = self._page(page['nextCursor'])
+        self.assertEqual(len(ids), 6)
+        self.assertEqual(set(ids), self.lead_ids)
+
+    def test_tampered_cursor_must_be_rejected(self):
+        cursor = urlsafe_base64_encode(b'2018-03-01T10:05:00+00:00|not a lead').decode()
+        errors, _ = self._page(cursor)
+        self.assertEqual([str(error) for error in errors], ['Invalid leads cursor'])
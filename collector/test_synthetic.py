@@ -0,0 +1,58 @@
+import doctest
+from datetime import datetime, timedelta
+
+from django.db.models import Sum, Count
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from audit.lead_authenticity import check_lead_authenticity
+from audit.models import Audit
+from audit.utils import load_leads_by_fields
+from collector import synthetic
+from collector.analytics import total_conversions, lead_browser_totals
+from collector.models import Lead, LeadField, LeadUrlLabel, LeadHourStat
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTest(doctest.DocTestSuite(synthetic))
+    return tests
+
+
+@override_settings(ANALYTICS_CACHE=None)
+class SyntheticLeadsTestCase(TestCase):
+
+    def test_generated_leads_must_be_consistent(self):
+        date_from = datetime(2018, 3, 1, tzinfo=timezone.utc)
+        date_to = date_from + timedelta(days=14)
+        dataset = synthetic.SyntheticDataset('synthetic-test', users=3, sales_users=2, seed=1)
+        rows = synthetic.generate_leads(dataset, 3000, date_from, date_to, chunk_size=1000)
+
+        leads_qs = Lead.objects.filter(user__in=dataset.user_ids)
+        self.assertEqual(rows['collector_lead'], 3000)
+        self.assertEqual(leads_qs.count(), 3000)
+        self.assertFalse(leads_qs.exclude(session_started__range=(date_from, date_to)).exists())
+        converted = leads_qs.filter(created__isnull=False).count()
+        self.assertEqual(LeadField.objects.filter(lead__user__in=dataset.user_ids).count(), converted * 3)
+        self.assertEqual(LeadUrlLabel.objects.filter(user__in=dataset.user_ids).count(),
+                         rows['collector_leadurllabel'])
+        self.assertEqual(leads_qs.aggregate(sales=Sum('metrik_lead_salecount'))['sales'],
+                         Audit.leads.through.objects.filter(lead__in=leads_qs).count())
+        self.assertEqual(LeadHourStat.objects.filter(user__in=dataset.user_ids)
+                         .aggregate(leads=Sum('leads'))['leads'], converted)
+
+        # analytics of rollups and raw leads agree
+        user = dataset.users[0]
+        with override_settings(ANALYTICS_LEAD_ROLLUPS=False):
+            raw = total_conversions(user, date_from, date_to), list(lead_browser_totals(user, date_from, date_to))
+        self.assertEqual((total_conversions(user, date_from, date_to),
+                          list(lead_browser_totals(user, date_from, date_to))), raw)
+
+        # field hashes are found by audits, the most frequent person of the user has duplicates
+        email = LeadField.objects.filter(lead__user=user, field_name='email').values('field_data')\
+            .annotate(leads=Count('id')).order_by('-leads')[0]['field_data']
+        lead = leads_qs.filter(user=user, fields__field_data=email).first()
+        fields = dict(lead.fields.values_list('field_name', 'field_data'))
+        authentic, _ = check_lead_authenticity(lead.pixel, fields)
+        self.assertTrue(authentic)
+        self.assertGreater(load_leads_by_fields(fields).filter(user=user).count(), 1)
@@ -1,9 +1,62 @@
 import doctest
 
+from django.contrib.auth import get_user_model
 from django.test import TestCase
-from collector.models import analytics
+from django.utils import timezone
+
+from collector.models import analytics, Lead, LeadHourStat, LeadHourSketch, LeadUserPeriodTotal, Project, Pixel
+from collector.rollups import rebuild_lead_hour_stat
+
+User = get_user_model()
 
 
 def load_tests(loader, tests, ignore):
     tests.addTest(doctest.DocTestSuite(analytics))
     return tests
+
+
+class LeadFilterColumnsTestCase(TestCase):
+
+    def test_lead_filter_columns_must_follow_pixel_project(self):
+        user = User.objects.create(username='columns@example.com')
+        project = Project.objects.create(user=user, title='project')
+        pixel = Pixel.objects.create(project=project, title='pixel')
+        now = timezone.now()
+        lead = Lead.objects.create(pixel=pixel, session_started=now, created=now)
+        self.assertEqual((lead.user_id, lead.project_id), (user.id, project.id))
+        rebuild_lead_hour_stat(pixel_ids=[pixel.id])
+
+        other_user = User.objects.create(username='other@example.com')
+        pixel.project = Project.objects.create(user=other_user, title='other')
+        pixel.save()
+        lead.refresh_from_db()
+        self.assertEqual((lead.user_id, lead.project_id), (other_user.id, pixel.project_id))
+        for model in (LeadHourStat, LeadHourSketch):
+            self.assertEqual(list(model.objects.filter(pixel=pixel).values_list('user', 'project')),
+                             [(other_user.id, pixel.project_id)])
+        totals_qs = LeadUserPeriodTotal.objects.filter(unit='day', user__in=(user, other_user))
+        self.assertEqual(dict(totals_qs.values_list('user', 'leads')),
+                         {user.id: 0, other_user.id: 1})
+
+        pixel.project = None
+        pixel.save()
+        lead.refresh_from_db()
+        self.assertEqual((lead.user_id, lead.project_id), (None, None))
+
+    def test_lead_filter_columns_must_be_copied_for_new_lead_or_pixel(self):
+        user = User.objects.create(username='columns@example.com')
+        pixel = Pixel.objects.create(project=Project.objects.create(user=user, title='project'), title='pixel')
+        now = timezone.now()
+        lead = Lead.objects.create(pixel=Pixel.objects.create(title='no project'), session_started=now, created=now)
+        lead = Lead.objects.get(pk=lead.pk)
+        # project-less lead is saved without pixel and project queries
+        with self.assertNumQueries(1):
+            lead.save(update_fields=('metrik_lead_salecount',))
+        with self.assertNumQueries(1):
+            lead.save()
+        self.assertEqual(lead.user_id, None)
+
+        lead.pixel = pixel
+        lead.save()
+        lead.refresh_from_db()
+        self.assertEqual((lead.user_id, lead.project_id), (user.id, pixel.project_id))
@@ -1,7 +1,7 @@
 from django.conf.urls import url
 from django.views.generic.base import TemplateView
 
-from collector.views import collect_event, open_session, test_form, conduster_js
+from collector.views import collect_event, open_session, test_form, conduster_js, export_leads
 
 urlpatterns = [
     url(r'^test-form/', test_form, name="test-form"),
@@ -9,4 +9,5 @@ urlpatterns = [
     url(r'^conduster.js', conduster_js, name="conduster_js"),
     url(r'^collect-event/', collect_event, name="collect-event"),
     url(r'^open-session/', open_session, name="open-session"),
+    url(r'^export-leads/', export_leads, name="export-leads"),
 ]
@@ -1,19 +1,25 @@
 import json
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from django.db.transaction import atomic
 from django.http import JsonResponse
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.template.loader import get_template
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
 from ua_parser import user_agent_parser
 
+from collector.analytics import get_leads
+from collector.export import EXPORT_FORMATS, parse_leads_filters, stream_leads
 from collector.models import SessionStorage, Pixel, Event, OS, OSFamily, DeviceType, DeviceBrand, \
     Device, BrowserFamily, BrowserVersion, ScreenResolution, City
 from collector.models.dictionaries import Provider, OSGroup
 from utils.datetime import fromtimestamp_ms
+from utils.db import pg_notify
+from utils.db_router import replica_reads
 from utils.ua import get_os_group_by_family
 
 User = get_user_model()
@@ -99,6 +105,7 @@ def collect_event(request):
     if data.get('eventType') == 'form-submitted':
         session.submitted = finished
         session.save(force_update=True, update_fields=('submitted',))
+        pg_notify(settings.LEADS_NOTIFY_CHANNEL, str(session.id))
 
     return JsonResponse({})
 
@@ -216,3 +223,35 @@ def open_session(request):
         session.save_fonts(fonts)
 
     return JsonResponse({'sessionId': session.id})
+
+
+@require_GET
+def export_leads(request):
+    """
+    stream leads of get_leads filters (query string, see parse_leads_filters)
+    as csv or ndjson (format param), gzip=1 compresses the file
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': 'Bad format'}, status=400)
+    try:
+        filters = parse_leads_filters(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    gzip = request.GET.get('gzip') in ('1', 'true')
+    content_type, extension = EXPORT_FORMATS[export_format]
+    filename = 'leads.' + extension
+    if gzip:
+        content_type = 'application/gzip'
+        filename += '.gz'
+    # leads are streamed after the view returns, so queryset is bound to replica
+    with replica_reads() as alias:
+        leads_qs = get_leads(request.user, **filters).using(alias)
+    response = StreamingHttpResponse(
+        stream_leads(leads_qs, export_format, gzip),
+        content_type=content_type
+    )
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
@@ -136,10 +136,27 @@ import dj_database_url
 DATABASES = {'default': {}}
 DATABASES['default'] = dj_database_url.config(conn_max_age=600)
 
+# read replicas of analytics (utils.db_router.replica_reads), comma separated database urls
+DATABASE_REPLICAS = []
+for i, url in enumerate(filter(None, os.environ.get('READ_REPLICA_URLS', '').split(','))):
+    alias = 'replica{}'.format(i + 1)
+    DATABASES[alias] = dj_database_url.parse(url.strip(), conn_max_age=600)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['utils.db_router.ReplicaRouter']
+# replicas lagging more seconds are skipped, reads go to primary without replicas
+REPLICA_MAX_LAG = 30
+REPLICA_LAG_CHECK_INTERVAL = 5
+
 # Graphene schema
 GRAPHENE = {
     'SCHEMA': 'condust.schema.schema'
 }
+# parsed and validated GraphQL documents kept per process (utils.graphene.GraphQLView)
+GRAPHQL_DOCUMENT_CACHE_SIZE = 200
+# cache alias of persisted queries texts by hash, shared by web processes, None disables them
+GRAPHQL_PERSISTED_QUERY_CACHE = 'analytics'
+GRAPHQL_PERSISTED_QUERY_TIMEOUT = 30 * 24 * 60 * 60
 
 # Rest Framework settings
 REST_FRAMEWORK = {
@@ -228,6 +245,64 @@ EMAIL_HOST_PASSWORD = 'E7y8UCsM3TF2ZISJ'
 # meta stat dir
 META_STAT_ROOT = '/storage/meta_stat'
 
+# postgres channel to notify lead materializer (listen_leads) about submitted forms
+LEADS_NOTIFY_CHANNEL = 'lead_submitted'
+
+# answer dashboard widgets from hourly rollups (LeadHourStat) when possible,
+# filled for existing leads by migration 0055_fill_lead_hour_stat, `manage.py fill_lead_hour_stat` rebuilds them
+ANALYTICS_LEAD_ROLLUPS = True
+# seconds, lead ages of lead_age_totals are counted from current time truncated to the step
+ANALYTICS_LEAD_AGE_STEP = 60
+
+# dashboards of saved page filters (collector.dashboard_warmer) are warmed after fill_leads
+DASHBOARD_WARM_AFTER_FILL = True
+# pages viewed in the last days are warmed
+DASHBOARD_WARM_ACTIVE_DAYS = 7
+# page names to warm, None is all pages with saved filters
+DASHBOARD_WARM_PAGES = None
+# range of filters without saved dates
+DASHBOARD_WARM_DAYS = 30
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # shared by web, cron and leads processes, create with `manage.py createcachetable`
+    'analytics': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'analytics_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+# cache alias for results of collector.analytics functions, None disables cache
+ANALYTICS_CACHE = 'analytics'
+# results are invalidated by fill_leads, timeout only limits table size
+ANALYTICS_CACHE_TIMEOUT = 24 * 60 * 60
+
+# answer analytics of a user from in-memory NumPy columns of user leads (collector.columnar),
+# needs numpy, users whose columns do not fit the budget are answered by SQL
+ANALYTICS_COLUMNAR = False
+# bytes of columns of all users per process, about 70 bytes per lead
+ANALYTICS_COLUMNAR_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# guardrails of analytics functions (collector.analytics_guard),
+# rejected requests get 'narrow your range' error
+# milliseconds of analytics queries of one function call
+ANALYTICS_STATEMENT_TIMEOUT = 20 * 1000
+# longest range in days by analytics function name, None is unlimited
+ANALYTICS_MAX_RANGE_DAYS = {
+    'default': 5 * 366,
+    # window over raw leads per device and day, not served from rollups
+    'consumer_origin_by_period': 366,
+    # raw leads of all users with label filters
+    'other_lead_lineage_by_period': 2 * 366,
+}
+# EXPLAIN total cost of aggregates over raw leads, None disables check
+ANALYTICS_MAX_QUERY_COST = 5 * 10 ** 6
+
 if DEBUG:
     LOGGING = {
         'version': 1,
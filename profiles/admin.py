@@ -4,7 +4,8 @@ from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
-from profiles.models import Profile, Message
+from collector.dashboard_warmer import is_stale
+from profiles.models import Profile, Message, PageFilters
 
 User = get_user_model()
 
@@ -27,7 +28,19 @@ class MessageAdmin(admin.ModelAdmin):
     form = MessageAdminForm
 
 
+class PageFiltersAdmin(admin.ModelAdmin):
+    list_display = ('user', 'page', 'viewed', 'warmed', 'stale')
+    list_select_related = ('user',)
+    search_fields = ['user__username', 'page']
+    exclude = ('result',)
+
+    def stale(self, obj):
+        return is_stale(obj)
+    stale.boolean = True
+
+
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 admin.site.register(Profile)
 admin.site.register(Message, MessageAdmin)
+admin.site.register(PageFilters, PageFiltersAdmin)
@@ -0,0 +1,28 @@
+# Generated by Django 2.0.1 on 2026-10-19 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0009_auto_20180406_0730'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pagefilters',
+            name='result',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pagefilters',
+            name='viewed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pagefilters',
+            name='warmed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,5 +1,6 @@
 import hashlib
 import random
+from datetime import timedelta
 
 from ckeditor.fields import RichTextField
 from django.conf import settings
@@ -12,6 +13,7 @@ from django.db.models import Q
 from django.db.models.deletion import CASCADE
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 User = get_user_model()
@@ -175,14 +177,30 @@ class Message(models.Model):
 class PageFilters(models.Model):
     """
     Conatin get params for filters for pages for user
+    Dashboard of filters is precomputed by collector.dashboard_warmer
     """
+    # viewed is updated not more often, warmer needs days precision
+    VIEWED_PRECISION = timedelta(hours=1)
+
     user = models.ForeignKey(User, on_delete=CASCADE)
     page = models.CharField(max_length=100)
     filters = models.TextField()
+    # last time the page read its filters, dashboards of pages not viewed lately are not warmed
+    viewed = models.DateTimeField(null=True, blank=True)
+    # JSON of dashboard widgets of filters and when its computation started
+    result = models.TextField(null=True, blank=True)
+    warmed = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         unique_together = ('user', 'page')
 
+    @classmethod
+    def mark_viewed(cls, user, page):
+        now = timezone.now()
+        cls.objects.filter(user=user, page=page) \
+            .exclude(viewed__gte=now - cls.VIEWED_PRECISION) \
+            .update(viewed=now)
+
 
 @receiver(post_save, sender=User)
 def user_profile_exist(sender, instance, created, *args, **kwargs):
@@ -1,11 +1,17 @@
+import json
+
 import graphene
 from django.contrib.auth import get_user_model, authenticate
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from django_countries import countries
 from graphene_django import DjangoObjectType
 
+from collector.dashboard_warmer import is_stale
 from profiles.models import PageFilters
 from profiles.register import RegisterService, RegisterError
+from utils.dataloader import ModelLoader, get_loader
+from utils.graphene import JSONDict
 from .models import Profile, Message
 
 User = get_user_model()
@@ -34,6 +40,23 @@ class MessageType(DjangoObjectType):
             'create_at'
         )
 
+    def resolve_author(self, info):
+        return get_loader(info, 'user', lambda: ModelLoader(User.objects.all())).load(self.author_id)
+
+
+class PageDashboardType(graphene.ObjectType):
+    page = graphene.String()
+    filters = graphene.String()
+    result = JSONDict(description='dashboard widgets of filters, null until warmed')
+    warmed = graphene.types.datetime.DateTime(description='when result computation started')
+    stale = graphene.Boolean(description='leads or default range changed after warm or result is missing')
+
+    def resolve_stale(self, info):
+        return is_stale(self)
+
+    def resolve_result(self, info):
+        return json.loads(self.result) if self.result else None
+
 
 class Query(graphene.ObjectType):
     user = graphene.Field(UserType)
@@ -48,6 +71,10 @@ class Query(graphene.ObjectType):
     page_filters = graphene.String(
         page=graphene.String(required=True)
     )
+    page_dashboard = graphene.Field(
+        PageDashboardType,
+        page=graphene.String(required=True)
+    )
 
     def resolve_user(self, info):
         if info.context.user.is_authenticated:
@@ -80,9 +107,17 @@ class Query(graphene.ObjectType):
     def resolve_page_filters(self, info, page):
         user = info.context.user
         if user.is_authenticated:
+            PageFilters.mark_viewed(user, page)
             return PageFilters.objects.filter(user=user, page=page).values_list('filters', flat=True).first()
         return None
 
+    def resolve_page_dashboard(self, info, page):
+        user = info.context.user
+        if user.is_authenticated:
+            PageFilters.mark_viewed(user, page)
+            return PageFilters.objects.filter(user=user, page=page).first()
+        return None
+
 
 class UpdateUserProfile(graphene.Mutation):
     class Arguments:
@@ -272,10 +307,11 @@ class SavePageFilters(graphene.Mutation):
     def mutate(root, info, page, filters):
         user = info.context.user
         if user.is_authenticated:
+            # dashboard of previous filters is not shown
             PageFilters.objects.update_or_create(
                 user=user,
                 page=page,
-                defaults={'filters': filters}
+                defaults={'filters': filters, 'viewed': timezone.now(), 'result': None, 'warmed': None}
             )
             return SavePageFilters(success=True, error=None)
         return SavePageFilters(success=False, error=_('Authentication required'))
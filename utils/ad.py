@@ -1,19 +1,23 @@
 import re
 from collections import namedtuple
+from functools import lru_cache
 
 import binascii
-from urllib.parse import ParseResult
 
-from django.utils.http import urlsafe_base64_decode, _urlparse
+from django.utils.functional import cached_property
+from django.utils.http import urlsafe_base64_decode
 
-from utils.http import urlparse_qs_or_fragment, find_params
+from utils.http import urlparse_qs_or_fragment, ParsedUrl
+
+# distinct (referrer, landing host) pairs to remember channel for
+TRAFFIC_CHANNEL_CACHE_SIZE = 10000
 
 UTM = namedtuple('UTM', ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content'))
 
 
 def parse_url_utms(url):
     """
-    :param url:
+    :param url: url or ParsedUrl
     :return: UTM
 
     >>> parse_url_utms('http://www.example.org/path?utm_source=source&utm_medium=medium&utm_campaign=camp1&utm_term=boats&utm_content=boats+boats+boats')
@@ -50,7 +54,7 @@ def parse_url_openstat(url):
     http://wiki.openstat.ru/Openstat/OpenstatMarker
     @todo: test this http://www.example.org/path?query#_openstat_openstat=openstat.ru;camp1;ad1234;top-left-corner must return ('openstat.ru', 'camp1', 'ad1234', 'top-left-corner')
     @todo: test http://www.example.org/path?_openstat=openstat.ru;camp%1B;ad1234;top-left-corner must return None
-    :param url: url
+    :param url: url or ParsedUrl
     :type url: str
     :return: Openstat namedtuple or None
     :rtype Openstat
@@ -97,11 +101,56 @@ def parse_url_openstat(url):
     return Openstat(service, campaign, ad, source)
 
 
+class AdUrl(ParsedUrl):
+    """
+    Url with ad labels, everything is parsed once and shared by
+    LeadUtm/LeadOpenstat parsing and traffic channel detection
+    >>> url = AdUrl('https://ref-page.com/?utm_source=src&gclid=123#_openstat=begun;;;')
+    >>> url.utm
+    UTM(utm_source='src', utm_medium='', utm_campaign='', utm_term='', utm_content='')
+    >>> url.openstat
+    Openstat(service='begun', campaign='', ad='', source='')
+    >>> url.host, url.gclid, url.yclid, url.ymclid
+    ('ref-page.com', '123', None, None)
+    """
+    @cached_property
+    def utm(self):
+        return parse_url_utms(self)
+
+    @cached_property
+    def openstat(self):
+        return parse_url_openstat(self)
+
+    @property
+    def host(self):
+        return (self.hostname or '').lower()
+
+    @property
+    def gclid(self):
+        return self.query_params.get('gclid')
+
+    @property
+    def yclid(self):
+        return self.query_params.get('yclid')
+
+    @property
+    def ymclid(self):
+        return self.query_params.get('ymclid')
+
+
+def to_ad_url(url):
+    """
+    :param url: url or AdUrl
+    :rtype: AdUrl
+    """
+    return url if isinstance(url, AdUrl) else AdUrl(url)
+
+
 def parse_traffic_channel(referrer, url):
     """
 
-    :param referrer:
-    :param url:
+    :param referrer: url or AdUrl
+    :param url: url or AdUrl
     :return:
     >>> parse_traffic_channel('https://ref-page.com/?utm_source=111&utm_medium=asd-display', 'https://landing-domain.com/')
     'display'
@@ -202,233 +251,201 @@ def parse_traffic_channel(referrer, url):
     >>> parse_traffic_channel('https://ref-page.com/', 'https://landing-domain.com/')
     'referral'
     """
-    if referrer is None:
+    referrer = to_ad_url(referrer)
+    if referrer.url is None:
         return 'direct'
-    parsed = _urlparse(referrer)
-    parsed_url = _urlparse(url)
-    channel = None
-    utms = parse_url_utms(referrer)
-    openstat = parse_url_openstat(referrer)
-    if _is_display(referrer, utms):
+    return _classify_traffic_channel(referrer, to_ad_url(url).hostname)
+
+
+@lru_cache(maxsize=TRAFFIC_CHANNEL_CACHE_SIZE)
+def _classify_traffic_channel(referrer, landing_hostname):
+    """
+    memoised by referrer url and landing host: same ad links repeat a lot
+    :param referrer: referrer AdUrl
+    :param landing_hostname: hostname of landing page url
+    :return: channel name
+    """
+    params = referrer.query_params
+    hostname = referrer.host
+    utms = referrer.utm
+    openstat = referrer.openstat
+    if _is_display(referrer.url, utms):
         channel = 'display'
-    elif _is_paid(referrer, parsed, utms, openstat):
+    elif _is_paid(referrer.url, hostname, params, utms, openstat):
         channel = 'paid'
-    elif _is_affiliate(parsed, utms):
+    elif _is_affiliate(hostname, utms):
         channel = 'affiliate'
-    elif _is_social(parsed, utms):
+    elif _is_social(hostname, utms):
         channel = 'social'
-    elif _is_email(parsed, utms, openstat):
+    elif _is_email(params, utms, openstat):
         channel = 'email'
-    elif _is_organic(parsed):
+    elif _is_organic(hostname):
         channel = 'organic'
-    elif _is_direct(referrer):
+    elif _is_direct(referrer.url):
         channel = 'direct'
-    elif _is_internal(parsed, parsed_url):
+    elif _is_internal(referrer.hostname, landing_hostname):
         channel = 'internal'
     else:
         channel = 'referral'
     return channel
 
 
-def _is_display(url: str, utms: UTM):
-    if utms and any(w in utms.utm_medium.lower() for w in (
-        'display', 'cpm', 'banner', 'tgb', 'banners.adfox.ru'
-    )):
-        return True
-    elif utms and  any(w in utms.utm_source.lower() for w in (
-        'criteo', 'dvigus', 'adriver', 'advmaker'
-    )):
-        return True
-    elif re.search(r'img\d{1,}\.begun', url):
-        return True
-    else:
-        return False
+def _keywords_re(*keywords):
+    """
+    compile keywords to one alternation regex, search() is true if any keyword is substring
+    :param keywords: strings
+    :return: compiled regex
+    >>> bool(_keywords_re('cpc', 'content.adfox.ru').search('yandex-cpc'))
+    True
+    >>> bool(_keywords_re('cpc', 'content.adfox.ru').search('content-adfox-ru'))
+    False
+    """
+    return re.compile('|'.join(re.escape(w) for w in keywords))
+
+
+DISPLAY_MEDIUM_RE = _keywords_re('display', 'cpm', 'banner', 'tgb', 'banners.adfox.ru')
+DISPLAY_SOURCE_RE = _keywords_re('criteo', 'dvigus', 'adriver', 'advmaker')
+DISPLAY_BEGUN_URL_RE = re.compile(r'img\d{1,}\.begun')
+
+PAID_SOURCE_RE = _keywords_re(
+    'elama', 'content.adfox.ru', 'avitopromo',
+    'avitocontext', 'kavanga', 'marketgid', 'merchant',
+    # aport
+    'aport'
+)
+PAID_MEDIUM_RE = _keywords_re(
+    'cpc', 'ppc', 'paidsearch', 'cpv', 'cpp', 'content-text', 'cps', 'pps',
+    # aport
+    'aport'
+)
+PAID_OPENSTAT_SERVICES = frozenset(('market.yandex.ru', 'direct.yandex.ru'))
+PAID_OPENSTAT_SERVICE_RE = _keywords_re('B2BContext', 'begun')
+PAID_HOSTNAMES = frozenset((
+    'market.yandex.ru', 'm.market.yandex.ru',
+    'rmt.begun.ru', 'podarki.begun.ru',
+    'googleadservices.com'
+))
+PAID_HOSTNAME_RE = _keywords_re('yabs.yandex.ru')
+PAID_BEGUN_URL_RE = re.compile(r'click[^\.]+\.begun')
+PAID_CM_IDS = frozenset(('Google AdWords', 'Яндекс.Директ'))
+
+AFFILIATE_SOURCE_RE = _keywords_re(
+    'advertise', 'actionpay', 'kredov', 'admitad', 'gdeslon',
+    'cityads', 'qxplus', 'leadgidru', 'doubletrade', 'salesdoubler',
+    'leadssu', 'elonleads', 'adwad', 'tradetracker', 'afrek', 'sellaction'
+)
+AFFILIATE_MEDIUM_RE = _keywords_re('affiliate', 'cpa', 'cpo', 'cpl')
+AFFILIATE_HOSTNAME_RE = _keywords_re(
+    'advertise', 'actionpay', 'kredov', 'admitad', 'gdeslon',
+    'cityads', 'leadgid.ru', 'doubletrade', 'salesdoubler', 'leadssu',
+    'elonleads', 'adwad', 'tradetracker', 'afrek', '7offers',
+    'zorkanetwork.com', 'adpro.ru', 'actionads', 'lead-r'
+)
+
+SOCIAL_LABEL_RE = _keywords_re(
+    'youtube', 'vkontakte', 'facebook', 'instagram', 'twitter',
+    'mytarget', 'viber', 'linkedin', 'livejournal', 'odnoklassniki',
+    'plus.google.com', 'googleplus', 'my.mail.ru', 'mirtesen.ru',
+    'delicious', 'tumblr', 'pinterest', 'reddit', 'stumbleupon'
+)
+SOCIAL_LABELS = frozenset(('smm', 'vk', 'vk.com', 'fb', 'ask.fm', 'ok.ru', 'ok'))
+SOCIAL_HOSTNAME_RE = re.compile(
+    _keywords_re(
+        'youtube', 'facebook', 'instagram', 'livejournal', 'pinterest',
+        'soundcloud', 'tagged', 'tumblr', 'twitter', 'linkedin',
+        'plus.google.com', 'my.mail.ru', 'mirtesen.ru', 'reddit'
+    ).pattern + r'|^ok\.ru|^m\.ok\.ru'
+)
+SOCIAL_HOSTNAMES = frozenset(('ask.fm', 'last.fm', 'vk.com'))
 
+EMAIL_RE = _keywords_re('email', 'e-mail')
 
-def _is_paid(url: str, parsed: ParseResult, utms: UTM, openstat: Openstat):
-    if openstat and any(w in openstat.service for w in ('B2BContext', )):
-        return True
-    elif utms and any(w in utms.utm_source.lower() for w in (
-        'elama', 'content.adfox.ru', 'avitopromo',
-        'avitocontext', 'kavanga', 'marketgid', 'merchant'
-    )):
-        return True
-    elif utms and any(w in utms.utm_medium.lower() for w in (
-        'cpc', 'ppc', 'paidsearch', 'cpv', 'cpp', 'content-text', 'cps', 'pps'
-    )):
-        return True
-    elif _is_paid_yandex_market(parsed, openstat):
-        return True
-    elif _is_paid_aport(utms):
-        return True
-    elif _is_paid_begun(url, parsed, openstat):
-        return True
-    elif _is_paid_google_adwords(parsed):
-        return True
-    elif _is_paid_yandex_direct(parsed, openstat):
-        return True
-    else:
-        return False
+ORGANIC_HOSTNAME_RE = _keywords_re(
+    'rambler', 'bing', 'mail.ru', 'yahoo', 'nigma', 'ask.com', 'yandex', 'google'
+)
 
 
-def _is_paid_yandex_market(parsed: ParseResult, openstat: Openstat):
-    if find_params(parsed.query, ('ymclid',)).get('ymclid'):
+def _is_display(url: str, utms: UTM):
+    if utms and DISPLAY_MEDIUM_RE.search(utms.utm_medium.lower()):
         return True
-    elif openstat and openstat.service == 'market.yandex.ru':
+    elif utms and DISPLAY_SOURCE_RE.search(utms.utm_source.lower()):
         return True
-    elif parsed.hostname in ('market.yandex.ru', 'm.market.yandex.ru'):
+    elif DISPLAY_BEGUN_URL_RE.search(url):
         return True
     else:
         return False
 
 
-def _is_paid_aport(utms: UTM):
-    if utms and any(w in utms.utm_medium.lower() for w in ('aport',)):
+def _is_paid(url: str, hostname: str, params: dict, utms: UTM, openstat: Openstat):
+    """
+    context ads, yandex market, aport, begun, google adwords and yandex direct
+    """
+    if openstat and (openstat.service in PAID_OPENSTAT_SERVICES
+                     or PAID_OPENSTAT_SERVICE_RE.search(openstat.service)):
         return True
-    elif utms and any(w in utms.utm_source.lower() for w in ('aport',)):
+    elif utms and PAID_SOURCE_RE.search(utms.utm_source.lower()):
         return True
-    else:
-        return False
-
-
-def _is_paid_begun(url: str, parsed: ParseResult, openstat: Openstat):
-    if openstat and any(w in openstat.service for w in ('begun',)):
-        return True
-    elif parsed.hostname in ('rmt.begun.ru', 'podarki.begun.ru'):
+    elif utms and PAID_MEDIUM_RE.search(utms.utm_medium.lower()):
         return True
-    elif re.search(r'click[^\.]+\.begun', url):
+    elif params.get('ymclid') or params.get('gclid') or params.get('yclid'):
+        # yandex market, google adwords, yandex direct click ids
         return True
-    else:
-        return False
-
-
-def _is_paid_google_adwords(parsed: ParseResult):
-    ga = find_params(parsed.query, ('gclid', 'cm_id'))
-    if ga.get('gclid'):
+    elif params.get('cm_id') in PAID_CM_IDS:
         return True
-    elif parsed.hostname == 'googleadservices.com':
+    elif hostname in PAID_HOSTNAMES or PAID_HOSTNAME_RE.search(hostname):
         return True
-    elif ga.get('cm_id') == 'Google AdWords':
+    elif PAID_BEGUN_URL_RE.search(url):
         return True
     else:
         return False
 
 
-def _is_paid_yandex_direct(parsed: ParseResult, openstat: Openstat):
-    yd = find_params(parsed.query, ('yclid', 'cm_id'))
-    if openstat and openstat.service == 'direct.yandex.ru':
+def _is_affiliate(hostname: str, utms: UTM):
+    if utms and AFFILIATE_SOURCE_RE.search(utms.utm_source.lower()):
         return True
-    elif yd.get('yclid'):
+    elif utms and AFFILIATE_MEDIUM_RE.search(utms.utm_medium.lower()):
         return True
-    elif parsed.hostname and 'yabs.yandex.ru' in parsed.hostname:
-        return True
-    elif yd.get('cm_id') == 'Яндекс.Директ':
+    elif AFFILIATE_HOSTNAME_RE.search(hostname):
         return True
     else:
         return False
 
 
-def _is_affiliate(parsed: ParseResult, utms: UTM):
-    if utms and any(w in utms.utm_source.lower() for w in (
-        'advertise', 'actionpay', 'kredov', 'admitad', 'gdeslon',
-        'cityads', 'qxplus', 'leadgidru', 'doubletrade', 'salesdoubler',
-        'leadssu', 'elonleads', 'adwad', 'tradetracker', 'afrek', 'sellaction'
-    )):
+def _is_social(hostname: str, utms: UTM):
+    if utms and _is_social_label(utms.utm_source.lower()):
         return True
-    elif utms and any(w in utms.utm_medium.lower() for w in (
-        'affiliate', 'cpa', 'cpo', 'cpl'
-    )):
+    elif utms and _is_social_label(utms.utm_medium.lower()):
         return True
-    elif parsed.hostname and any(w in parsed.hostname.lower() for w in (
-        'advertise', 'actionpay', 'kredov', 'admitad', 'gdeslon',
-        'cityads', 'leadgid.ru', 'doubletrade', 'salesdoubler', 'leadssu',
-        'elonleads', 'adwad', 'tradetracker', 'afrek', '7offers',
-        'zorkanetwork.com', 'adpro.ru', 'actionads', 'lead-r'
-    )):
+    elif hostname in SOCIAL_HOSTNAMES or SOCIAL_HOSTNAME_RE.search(hostname):
         return True
     else:
         return False
 
 
-def _is_social(parsed: ParseResult, utms: UTM):
-    if utms and any(w in utms.utm_source.lower() for w in (
-        'youtube', 'vkontakte', 'facebook', 'instagram', 'twitter',
-        'mytarget', 'viber', 'linkedin', 'livejournal', 'odnoklassniki',
-        'plus.google.com', 'googleplus', 'my.mail.ru', 'mirtesen.ru',
-        'delicious', 'tumblr', 'pinterest', 'reddit', 'stumbleupon'
-    )):
-        return True
-    elif utms and utms.utm_source.lower() in (
-        'smm', 'vk', 'vk.com', 'fb', 'ask.fm', 'ok.ru', 'ok'
-    ):
-        return True
-    elif utms and any(w in utms.utm_medium.lower() for w in (
-        'youtube', 'vkontakte', 'facebook', 'instagram', 'twitter',
-        'mytarget', 'viber', 'linkedin', 'livejournal', 'odnoklassniki',
-        'plus.google.com', 'googleplus', 'my.mail.ru', 'mirtesen.ru',
-        'delicious', 'tumblr', 'pinterest', 'reddit', 'stumbleupon'
-    )):
-        return True
-    elif utms and utms.utm_medium.lower() in (
-        'smm', 'vk', 'vk.com', 'fb', 'ask.fm', 'ok.ru', 'ok'
-    ):
-        return True
-    elif parsed.hostname and any(w in parsed.hostname.lower() for w in (
-        'youtube', 'facebook', 'instagram', 'livejournal', 'pinterest',
-        'soundcloud', 'tagged', 'tumblr', 'twitter', 'linkedin',
-        'plus.google.com', 'my.mail.ru', 'mirtesen.ru', 'reddit'
-    )):
-        return True
-    elif parsed.hostname and parsed.hostname.lower() in  (
-        'ask.fm', 'last.fm', 'vk.com'
-    ):
-        return True
-    elif parsed.hostname and any(re.search(r, parsed.hostname.lower()) for r in (
-        r'^ok\.ru' , r'^m\.ok\.ru'
-    )):
-        return True
-    else:
-        return False
+def _is_social_label(label: str):
+    return label in SOCIAL_LABELS or bool(SOCIAL_LABEL_RE.search(label))
 
 
-def _is_email(parsed: ParseResult, utms: UTM, openstat: Openstat):
-    from_arg = find_params(parsed.query, ('from',)).get('from', '')
-    if utms and any(w in utms.utm_source.lower() for w in (
-        'email', 'e-mail'
-    )):
+def _is_email(params: dict, utms: UTM, openstat: Openstat):
+    if utms and EMAIL_RE.search(utms.utm_source.lower()):
         return True
-    elif utms and any(w in utms.utm_medium.lower() for w in (
-        'email', 'e-mail'
-    )):
+    elif utms and EMAIL_RE.search(utms.utm_medium.lower()):
         return True
-    elif openstat and any(w in openstat.service.lower() for w in (
-        'email', 'e-mail'
-    )):
+    elif openstat and EMAIL_RE.search(openstat.service.lower()):
         return True
-    elif any(w in from_arg.lower() for w in (
-        'email', 'e-mail'
-    )):
+    elif EMAIL_RE.search(params.get('from', '').lower()):
         return True
     else:
         return False
 
 
-def _is_organic(parsed: ParseResult):
-    if parsed.hostname and any(w in parsed.hostname.lower() for w in (
-        'rambler', 'bing', 'mail.ru', 'yahoo', 'nigma', 'ask.com', 'yandex', 'google'
-    )):
-        return True
-    else:
-        return False
+def _is_organic(hostname: str):
+    return bool(ORGANIC_HOSTNAME_RE.search(hostname))
 
 
 def _is_direct(url: str):
     return url is None or url == ''
 
 
-def _is_internal(parsed_referrer: ParseResult, parsed_url: ParseResult):
-    return parsed_referrer.hostname == parsed_url.hostname
-
-# 
-# def _is_referral(url: str):
-#     return url is not None and url != ''
+def _is_internal(referrer_hostname: str, url_hostname: str):
+    return referrer_hostname == url_hostname
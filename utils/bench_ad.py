@@ -0,0 +1,51 @@
+"""
+Micro-benchmark of traffic channel classification
+Referrers are taken from parse_traffic_channel doctests
+
+    python -m utils.bench_ad [rounds]
+"""
+import ast
+import doctest
+import sys
+import time
+
+from utils.ad import parse_traffic_channel, _classify_traffic_channel
+
+
+def load_doctest_calls():
+    """
+    :return: list of (referrer, url) from parse_traffic_channel doctests
+    """
+    calls = []
+    for example in doctest.DocTestParser().get_examples(parse_traffic_channel.__doc__):
+        call = ast.parse(example.source).body[0].value
+        calls.append(tuple(ast.literal_eval(arg) for arg in call.args))
+    return calls
+
+
+def bench(calls, rounds, cached=True):
+    """
+    :param calls: list of (referrer, url)
+    :param rounds: how many times to classify all calls
+    :param cached: False - clear lru cache before every call
+    :return: classifications per second
+    """
+    _classify_traffic_channel.cache_clear()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for referrer, url in calls:
+            if not cached:
+                _classify_traffic_channel.cache_clear()
+            parse_traffic_channel(referrer, url)
+    return len(calls) * rounds / (time.perf_counter() - started)
+
+
+def main(rounds=2000):
+    calls = load_doctest_calls()
+    print('{} referrers x {} rounds'.format(len(calls), rounds))
+    print('cold: {:.0f} classifications/s'.format(bench(calls, rounds, cached=False)))
+    print('warm: {:.0f} classifications/s'.format(bench(calls, rounds, cached=True)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
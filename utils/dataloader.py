@@ -0,0 +1,59 @@
+"""
+Request scoped DataLoaders of related objects for graphene resolvers
+
+Resolvers of list items return a promise of loader instead of a query per
+item, keys loaded while one level of the query is resolved are fetched in one
+query per loader. Loaders are kept on info.context (the request), so loaded
+objects are cached till the end of the request only.
+"""
+from collections import defaultdict
+
+from promise import Promise
+from promise.dataloader import DataLoader
+
+
+class ModelLoader(DataLoader):
+    """
+    objects of queryset by primary key, None for missing ones
+    """
+    def __init__(self, queryset):
+        super().__init__()
+        self.queryset = queryset
+
+    def batch_load_fn(self, keys):
+        objects = self.queryset.in_bulk(keys)
+        return Promise.resolve([objects.get(key) for key in keys])
+
+
+class RelatedLoader(DataLoader):
+    """
+    lists of objects of queryset by foreign key, for reverse relations
+    """
+    def __init__(self, queryset, field):
+        """
+        :param field: name of foreign key field of queryset model
+        """
+        super().__init__()
+        self.queryset = queryset
+        self.field = field
+        self.attname = queryset.model._meta.get_field(field).attname
+
+    def batch_load_fn(self, keys):
+        related = defaultdict(list)
+        for obj in self.queryset.filter(**{self.field + '__in': keys}):
+            related[getattr(obj, self.attname)].append(obj)
+        return Promise.resolve([related[key] for key in keys])
+
+
+def get_loader(info, name, factory):
+    """
+    :param name: loader name, unique per request
+    :param factory: callable creating loader if request has no loader with the name
+    :return: DataLoader of request
+    """
+    loaders = getattr(info.context, 'dataloaders', None)
+    if loaders is None:
+        loaders = info.context.dataloaders = {}
+    if name not in loaders:
+        loaders[name] = factory()
+    return loaders[name]
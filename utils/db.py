@@ -1,5 +1,7 @@
 from collections import namedtuple
 
+from django.db import connections
+
 
 def namedtuplefetchall(cursor):
     "Return all rows from a cursor as a namedtuple"
@@ -14,4 +16,27 @@ def dictfetchall(cursor):
     return [
         dict(zip(columns, row))
         for row in cursor.fetchall()
-    ]
\ No newline at end of file
+    ]
+
+
+def pg_notify(channel, payload, using='default'):
+    """
+    Send postgres NOTIFY, inside transaction it is delivered on commit
+    :param channel: channel name
+    :param payload: str
+    :param using: db alias
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [channel, payload])
+
+
+def pg_advisory_xact_lock(key, shared=False, using='default'):
+    """
+    Take postgres advisory lock till the end of current transaction
+    :param key: str, hashed to lock id
+    :param shared: take shared lock, it only conflicts with exclusive one
+    :param using: db alias
+    """
+    func = 'pg_advisory_xact_lock_shared' if shared else 'pg_advisory_xact_lock'
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT {}(hashtext(%s))'.format(func), [key])
@@ -0,0 +1,124 @@
+"""
+Read replica routing
+
+Reads inside replica_reads() blocks go to one of settings.DATABASE_REPLICAS
+which lags behind the primary less than settings.REPLICA_MAX_LAG seconds,
+everything else (writes, reads outside blocks and inside transactions,
+primary_reads() blocks, cache tables) goes to the default database.
+Without healthy replicas blocks read from the default database too.
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# models always read from the default database, cache entries (DatabaseCache) are
+# read right after they are written
+PRIMARY_APP_LABELS = ('django_cache',)
+
+REPLICA_LAG_SQL = """
+    SELECT CASE WHEN pg_is_in_recovery()
+        THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        ELSE 0 END
+"""
+
+_state = threading.local()
+# alias: (checked at, lag seconds or None if replica is unavailable)
+_lags = {}
+
+
+def replica_lag(alias):
+    """
+    :return: seconds since the last replayed transaction, None if replica is unavailable,
+        checked once per settings.REPLICA_LAG_CHECK_INTERVAL
+    """
+    checked, lag = _lags.get(alias, (None, None))
+    now = time.monotonic()
+    if checked is not None and now - checked < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return lag
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(REPLICA_LAG_SQL)
+            lag = float(cursor.fetchone()[0])
+    except DatabaseError:
+        logger.exception('Replica {} is unavailable'.format(alias))
+        connections[alias].close()
+        lag = None
+    _lags[alias] = (now, lag)
+    return lag
+
+
+def choose_replica():
+    """
+    :return: alias of random replica which is not lagging, default alias if there is none
+    """
+    replicas = []
+    for alias in settings.DATABASE_REPLICAS:
+        lag = replica_lag(alias)
+        if lag is not None and lag <= settings.REPLICA_MAX_LAG:
+            replicas.append(alias)
+    if not replicas:
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+
+@contextmanager
+def replica_reads():
+    """
+    route reads of the block to a replica, nested blocks use the same one
+    :return: alias of chosen database
+    """
+    outer = getattr(_state, 'replica', None)
+    if outer is None:
+        _state.replica = choose_replica()
+    try:
+        yield _state.replica
+    finally:
+        _state.replica = outer
+
+
+@contextmanager
+def primary_reads():
+    """
+    route reads of the block to the default database even inside replica_reads(),
+    for reads which must see just committed rows
+    """
+    outer = getattr(_state, 'primary', False)
+    _state.primary = True
+    try:
+        yield DEFAULT_DB_ALIAS
+    finally:
+        _state.primary = outer
+
+
+def current_read_alias():
+    """
+    :return: alias reads are routed to now
+    """
+    if getattr(_state, 'primary', False) or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return getattr(_state, 'replica', None) or DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in PRIMARY_APP_LABELS:
+            return DEFAULT_DB_ALIAS
+        return current_read_alias()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas have the same rows as primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -1,4 +1,32 @@
+"""
+Graphene helpers and GraphQL endpoint
+
+GraphQLView keeps parsed and validated documents in a bounded LRU of
+settings.GRAPHQL_DOCUMENT_CACHE_SIZE documents by sha256 of query text, so
+documents sent over and over are parsed and validated once per process.
+
+It supports persisted queries (the Apollo automatic persisted queries protocol):
+a client sends extensions {"persistedQuery": {"version": 1, "sha256Hash": hash}}
+with variables and without query text. Unknown hash gets PersistedQueryNotFound
+error and the client sends query with hash once, the text is kept in
+settings.GRAPHQL_PERSISTED_QUERY_CACHE shared by all processes.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import graphene_django.views
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponseBadRequest, HttpResponseNotAllowed
 from graphene.types.scalars import Scalar
+from graphql import parse, validate, Source
+from graphql.execution import ExecutionResult
+from graphql.utils.get_operation_ast import get_operation_ast
+
+_documents = OrderedDict()
+_documents_lock = threading.Lock()
 
 
 class JSONDict(Scalar):
@@ -15,3 +43,138 @@ class JSONDict(Scalar):
     @staticmethod
     def parse_value(value):
         return value
+
+
+class PersistedQueryError(Exception):
+
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.extensions = {'code': code}
+
+
+def query_hash(query):
+    """
+    >>> query_hash('{ user { id } }')[:16]
+    '4fde0939ccf99237'
+    """
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def get_document(schema, query):
+    """
+    parsed and validated document of query, kept in bounded LRU
+    :raise GraphQLSyntaxError: query is not parsed, such queries are not kept
+    :return: (document ast, list of validation errors)
+    """
+    key = (id(schema), query_hash(query))
+    with _documents_lock:
+        if key in _documents:
+            _documents.move_to_end(key)
+            return _documents[key]
+    document_ast = parse(Source(query, name='GraphQL request'))
+    document = (document_ast, validate(schema, document_ast))
+    with _documents_lock:
+        _documents[key] = document
+        while len(_documents) > settings.GRAPHQL_DOCUMENT_CACHE_SIZE:
+            _documents.popitem(last=False)
+    return document
+
+
+def _persisted_query_key(sha256_hash):
+    return 'graphql:query:{}'.format(sha256_hash)
+
+
+def get_persisted_query(query, extensions):
+    """
+    :param query: query text of request, None if client sent hash only
+    :param extensions: dict of request extensions
+    :raise PersistedQueryError: hash is unknown or does not match query
+    :return: query text
+    """
+    persisted = (extensions or {}).get('persistedQuery')
+    if not persisted:
+        return query
+    if not settings.GRAPHQL_PERSISTED_QUERY_CACHE:
+        raise PersistedQueryError('PersistedQueryNotSupported', 'PERSISTED_QUERY_NOT_SUPPORTED')
+    sha256_hash = persisted.get('sha256Hash')
+    cache = caches[settings.GRAPHQL_PERSISTED_QUERY_CACHE]
+    if query:
+        if query_hash(query) != sha256_hash:
+            raise PersistedQueryError('provided sha does not match query', 'BAD_PERSISTED_QUERY_HASH')
+        cache.set(_persisted_query_key(sha256_hash), query, settings.GRAPHQL_PERSISTED_QUERY_TIMEOUT)
+        return query
+    query = cache.get(_persisted_query_key(sha256_hash)) if sha256_hash else None
+    if query is None:
+        raise PersistedQueryError('PersistedQueryNotFound', 'PERSISTED_QUERY_NOT_FOUND')
+    return query
+
+
+class GraphQLView(graphene_django.views.GraphQLView):
+    """
+    GraphQLView with document cache and persisted queries,
+    adds extensions attribute of exceptions to errors
+    """
+
+    @staticmethod
+    def get_extensions(request, data):
+        extensions = request.GET.get('extensions') or data.get('extensions')
+        if extensions and isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise graphene_django.views.HttpError(HttpResponseBadRequest(
+                    'Extensions are invalid JSON.'))
+        return extensions
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        try:
+            query = get_persisted_query(query, self.get_extensions(request, data))
+        except PersistedQueryError as e:
+            # 200 with error, so the client sends query with hash
+            return ExecutionResult(errors=[e])
+        if not query:
+            return super().execute_graphql_request(
+                request, data, query, variables, operation_name, show_graphiql)
+
+        try:
+            document_ast, validation_errors = get_document(self.schema, query)
+            if validation_errors:
+                return ExecutionResult(
+                    errors=validation_errors,
+                    invalid=True,
+                )
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+        if request.method.lower() == 'get':
+            operation_ast = get_operation_ast(document_ast, operation_name)
+            if operation_ast and operation_ast.operation != 'query':
+                if show_graphiql:
+                    return None
+
+                raise graphene_django.views.HttpError(HttpResponseNotAllowed(
+                    ['POST'], 'Can only perform a {} operation from a POST request.'.format(
+                        operation_ast.operation)
+                ))
+
+        try:
+            return self.execute(
+                document_ast,
+                root_value=self.get_root_value(request),
+                variable_values=variables,
+                operation_name=operation_name,
+                context_value=self.get_context(request),
+                middleware=self.get_middleware(request),
+                executor=self.executor,
+            )
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+    @staticmethod
+    def format_error(error):
+        formatted = graphene_django.views.GraphQLView.format_error(error)
+        extensions = getattr(error, 'extensions', None) or \
+            getattr(getattr(error, 'original_error', None), 'extensions', None)
+        if extensions:
+            formatted['extensions'] = extensions
+        return formatted
@@ -0,0 +1,123 @@
+"""
+HyperLogLog sketch for approximate distinct counting
+
+Standard error of count is 1.04 / sqrt(2 ** precision), 1.6% for default
+precision 12. Sketches with the same precision are merged without loss,
+so sketch of a range is a merge of sketches of its parts.
+"""
+import math
+
+import mmh3
+
+DEFAULT_PRECISION = 12
+
+_SPARSE = b'S'
+_DENSE = b'D'
+
+
+class HyperLogLog(object):
+    """
+    >>> hll = HyperLogLog()
+    >>> hll.update(str(i) for i in range(10000))
+    >>> abs(hll.count() - 10000) < 10000 * 0.05
+    True
+    >>> other = HyperLogLog.from_bytes(hll.to_bytes())
+    >>> other.count() == hll.count()
+    True
+    >>> small = HyperLogLog()
+    >>> small.update(['a', 'b', 'b', None])
+    >>> small.count()
+    2
+    >>> small.merge(HyperLogLog.from_bytes(small.to_bytes())).count()
+    2
+    """
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    @property
+    def error(self):
+        """
+        :return: relative standard error of count
+        """
+        return 1.04 / math.sqrt(self.size)
+
+    def add(self, value):
+        if value is None:
+            return
+        value_hash = mmh3.hash64(str(value), signed=False)[0]
+        index = value_hash >> (64 - self.precision)
+        rest_bits = 64 - self.precision
+        rest = value_hash & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """
+        :param other: HyperLogLog with the same precision
+        :return: self
+        """
+        if other.precision != self.precision:
+            raise ValueError('Can not merge sketches with different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def merge_bytes(self, data):
+        """
+        merge serialized sketch, sparse ones are merged without unpacking
+        :param data: bytes from to_bytes
+        :return: self
+        """
+        data = bytes(data)
+        if data[:1] == _DENSE:
+            return self.merge(self.from_bytes(data))
+        registers = self.registers
+        for i in range(1, len(data), 3):
+            index = (data[i] << 8) | data[i + 1]
+            if data[i + 2] > registers[index]:
+                registers[index] = data[i + 2]
+        return self
+
+    def count(self):
+        """
+        :return: estimated count of distinct values
+        """
+        zeros = self.registers.count(0)
+        if zeros == self.size:
+            return 0
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / sum(2.0 ** -rank for rank in self.registers)
+        if estimate <= 2.5 * self.size and zeros:
+            # linear counting is more precise for small cardinalities
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        """
+        sparse (index, rank) pairs while they are shorter than registers
+        :return: bytes
+        """
+        pairs = [(index, rank) for index, rank in enumerate(self.registers) if rank]
+        if len(pairs) * 3 < self.size:
+            data = bytearray(_SPARSE)
+            for index, rank in pairs:
+                data.extend((index >> 8, index & 0xff, rank))
+            return bytes(data)
+        return _DENSE + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data, precision=DEFAULT_PRECISION):
+        hll = cls(precision)
+        data = bytes(data)
+        if data[:1] == _DENSE:
+            if len(data) - 1 != hll.size:
+                raise ValueError('Sketch precision mismatch')
+            hll.registers = bytearray(data[1:])
+            return hll
+        return hll.merge_bytes(data)
@@ -3,10 +3,95 @@ from urllib.parse import _coerce_args, unquote
 from django.utils.http import _urlparse
 
 
+class ParsedUrl(object):
+    """
+    Url parsed once: query and fragment params are parsed on first access and cached
+    Equal and hashable by url string, so can be used as cache key
+    >>> url = ParsedUrl('http://Example.com/path?q1=q&q2=&q3=1&q3=2#q1=f&f1=f')
+    >>> url.hostname
+    'example.com'
+    >>> sorted(url.query_params.items())
+    [('q1', 'q'), ('q3', '1')]
+    >>> url.qs_or_fragment(['q1', 'f1'])
+    {'q1': 'q'}
+    >>> url.qs_or_fragment(['f1'])
+    {'f1': 'f'}
+    >>> url == ParsedUrl('http://Example.com/path?q1=q&q2=&q3=1&q3=2#q1=f&f1=f')
+    True
+    >>> ParsedUrl(None).qs_or_fragment(['q1'])
+    {}
+    """
+    def __init__(self, url):
+        self.url = url
+        self._parsed = None
+        self._query_params = None
+        self._fragment_params = None
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedUrl) and self.url == other.url
+
+    def __hash__(self):
+        return hash(self.url)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.url)
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = _urlparse(self.url)
+        return self._parsed
+
+    @property
+    def hostname(self):
+        return self.parsed.hostname
+
+    @property
+    def query_params(self):
+        """
+        :return: dict of first values of query params
+        """
+        if self._query_params is None:
+            self._query_params = self._first_values(self.parsed.query)
+        return self._query_params
+
+    @property
+    def fragment_params(self):
+        """
+        :return: dict of first values of fragment params
+        """
+        if self._fragment_params is None:
+            self._fragment_params = self._first_values(self.parsed.fragment)
+        return self._fragment_params
+
+    def qs_or_fragment(self, param_names):
+        """
+        :param param_names: list of parameters to find
+        :return: params from query if any of them found there else from fragment
+        """
+        res = {}
+        if self.parsed.query:
+            res = {name: self.query_params[name]
+                   for name in param_names if name in self.query_params}
+            if res:
+                return res
+
+        if self.parsed.fragment:
+            res = {name: self.fragment_params[name]
+                   for name in param_names if name in self.fragment_params}
+        return res
+
+    @staticmethod
+    def _first_values(querystring):
+        if not querystring:
+            return {}
+        return {name: values[0] for name, values in parse_qs(querystring).items()}
+
+
 def urlparse_qs_or_fragment(url, param_names):
     """
 
-    :param url:
+    :param url: url or ParsedUrl
     :param param_names: list of parameters to find
     :return: parset args from query or fragment? default form query
     >>> urlparse_qs_or_fragment(b'http://example.com?q1=1',[b'q1'])
@@ -23,17 +108,12 @@ def urlparse_qs_or_fragment(url, param_names):
     {'q1': 'f'}
     >>> urlparse_qs_or_fragment('http://example.com?q1=q#q1=f', ['q1'])
     {'q1': 'q'}
+    >>> urlparse_qs_or_fragment(ParsedUrl('http://example.com?q1=q#q1=f'), ['q1'])
+    {'q1': 'q'}
     """
-    parsed = _urlparse(url)
-    res = {}
-    if parsed.query:
-        res = find_params(parsed.query, param_names)
-        if res:
-            return res
-
-    if parsed.fragment:
-        res = find_params(parsed.fragment, param_names)
-    return res
+    if not isinstance(url, ParsedUrl):
+        url = ParsedUrl(url)
+    return url.qs_or_fragment(param_names)
 
 
 def find_params(querystring, param_names):
@@ -0,0 +1,43 @@
+from unittest import mock
+
+from django.core.cache.backends.db import DatabaseCache
+from django.db import transaction
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+
+from collector.models import Lead
+from utils import db_router
+from utils.db_router import ReplicaRouter, replica_reads, primary_reads
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'], REPLICA_MAX_LAG=30)
+class ReplicaRouterTestCase(TransactionTestCase):
+
+    def _read_alias(self):
+        return ReplicaRouter().db_for_read(Lead)
+
+    def test_reads_must_go_to_fresh_replica(self):
+        lags = {'replica1': 120.0, 'replica2': 0.5}
+        with mock.patch.object(db_router, 'replica_lag', lags.get):
+            self.assertEqual(self._read_alias(), 'default')
+            with replica_reads() as alias:
+                self.assertEqual((alias, self._read_alias()), ('replica2', 'replica2'))
+                with primary_reads():
+                    self.assertEqual(self._read_alias(), 'default')
+                # just written rows are read from primary
+                with transaction.atomic():
+                    self.assertEqual(self._read_alias(), 'default')
+            self.assertEqual(ReplicaRouter().db_for_write(Lead), 'default')
+
+    def test_reads_must_fall_back_to_primary(self):
+        lags = {'replica1': 120.0, 'replica2': None}
+        with mock.patch.object(db_router, 'replica_lag', lags.get):
+            with replica_reads() as alias:
+                self.assertEqual((alias, self._read_alias()), ('default', 'default'))
+
+    def test_cache_must_be_read_from_primary(self):
+        cache_model = DatabaseCache('analytics_cache', {}).cache_model_class
+        lags = {'replica1': 0.5, 'replica2': 0.5}
+        with mock.patch.object(db_router, 'replica_lag', lags.get):
+            with replica_reads():
+                self.assertEqual(ReplicaRouter().db_for_read(cache_model), 'default')
@@ -0,0 +1,48 @@
+import doctest
+import json
+from unittest import mock
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from utils import graphene
+from utils.graphene import query_hash
+
+QUERY = '{ leadAgeGroups { groupName } }'
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTest(doctest.DocTestSuite(graphene))
+    return tests
+
+
+@override_settings(GRAPHQL_PERSISTED_QUERY_CACHE='default')
+class GraphQLViewTestCase(TestCase):
+
+    def _post(self, **body):
+        response = self.client.post('/graphql', json.dumps(body), content_type='application/json')
+        return response.status_code, json.loads(response.content.decode())
+
+    def test_document_must_be_parsed_once(self):
+        query = QUERY + ' # parsed once'
+        with mock.patch.object(graphene, 'parse', wraps=graphene.parse) as parse:
+            for _ in range(3):
+                status, result = self._post(query=query)
+                self.assertEqual(status, 200)
+                self.assertTrue(result['data']['leadAgeGroups'])
+        self.assertEqual(parse.call_count, 1)
+
+    def test_persisted_query_must_be_run_by_hash(self):
+        query = QUERY + ' # persisted'
+        extensions = {'persistedQuery': {'version': 1, 'sha256Hash': query_hash(query)}}
+        status, result = self._post(extensions=extensions)
+        self.assertEqual(status, 200)
+        self.assertEqual(result['errors'][0]['extensions'], {'code': 'PERSISTED_QUERY_NOT_FOUND'})
+
+        status, result = self._post(query=query, extensions=extensions)
+        self.assertTrue(result['data']['leadAgeGroups'])
+        status, by_hash = self._post(extensions=extensions)
+        self.assertEqual(by_hash, result)
+
+        status, result = self._post(query=QUERY, extensions=extensions)
+        self.assertEqual(result['errors'][0]['extensions'], {'code': 'BAD_PERSISTED_QUERY_HASH'})
@@ -0,0 +1,9 @@
+import doctest
+
+from django.test import TestCase
+from utils import hll
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTest(doctest.DocTestSuite(hll))
+    return tests